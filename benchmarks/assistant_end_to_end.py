@@ -0,0 +1,120 @@
+"""latency of whole assistant requests against the local llm and mcp stand-ins, so the overhead of the assistant loop
+itself (context assembly, json parsing, tool dispatch, history writes) is measured instead of mocked away
+
+usage: python -m benchmarks.assistant_end_to_end [requests] [concurrency] [llm latency ms] [tool rounds]
+"""
+import asyncio
+import statistics
+import sys
+import time
+from typing import List
+from unittest.mock import AsyncMock
+from unittest.mock import MagicMock
+
+from benchmarks.standins import MCPStandin
+from benchmarks.standins import OpenAIStandin
+from lotb.plugins.llm import Plugin
+
+
+class Config:
+  def __init__(self, values):
+    self.values = values
+
+  def get(self, key, default=None):
+    return self.values.get(key, default)
+
+
+def make_plugin(llm: OpenAIStandin, mcp: MCPStandin, streaming: bool, concurrency: int) -> Plugin:
+  plugin = Plugin()
+  plugin.set_config(
+    Config(
+      {
+        "plugins.llm": {
+          "model": "openai/standin",
+          "apikey": "standin",
+          "api_base": llm.api_base,
+          "assistant": True,
+          "mcpservers": [mcp.server_cfg],
+          "streaming": streaming,
+          "stream_edit_interval": 0,
+          "prompt_caching": False,
+          "max_concurrent_requests": concurrency,
+          "user_concurrency": concurrency,
+          "chat_concurrency": concurrency,
+          "queue_size": 0,
+        },
+        "core.database": ":memory:",
+      }
+    )
+  )
+  plugin.initialize()
+  return plugin
+
+
+def make_update(index: int) -> MagicMock:
+  update = MagicMock()
+  update.effective_user.id = 1000 + index
+  update.effective_chat.id = 2000 + index
+  update.message.text = f"/llm what is the status of order {index}?"
+  update.message.reply_text = AsyncMock(return_value=MagicMock(edit_text=AsyncMock()))
+  return update
+
+
+async def measure(plugin: Plugin, requests: int, concurrency: int) -> List[float]:
+  context = MagicMock()
+  context.bot.send_chat_action = AsyncMock()
+  latencies: List[float] = []
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def timed(index: int):
+    async with semaphore:
+      update = make_update(index)
+      started = time.perf_counter()
+      await plugin.execute(update, context)
+      latencies.append((time.perf_counter() - started) * 1000)
+      answer = update.message.reply_text.call_args.args[0]
+      if "something went wrong" in answer or "failed" in answer:
+        raise RuntimeError(f"request {index} failed: {answer}")
+
+  await asyncio.gather(*(timed(i) for i in range(requests)))
+  return latencies
+
+
+def report(label: str, latencies: List[float], overhead: float):
+  latencies = sorted(latencies)
+  p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+  mean = statistics.mean(latencies)
+  print(
+    f"{label:<14} mean {mean:7.2f} ms  p50 {statistics.median(latencies):7.2f} ms  p95 {p95:7.2f} ms  "
+    f"assistant overhead {mean - overhead:7.2f} ms"
+  )
+
+
+async def main(requests: int, concurrency: int, llm_latency: float, tool_rounds: int):
+  async with (
+    OpenAIStandin(latency=llm_latency, tool_rounds=tool_rounds) as llm,
+    MCPStandin(tools=20, resources=2) as mcp,
+  ):
+    # every round trip to the stand-in waits llm_latency, whatever is left is spent in the bot
+    overhead = (tool_rounds + 1) * llm_latency * 1000
+    print(
+      f"{requests} requests, concurrency {concurrency}, llm latency {llm_latency * 1000:.0f} ms, {tool_rounds} tool rounds"
+    )
+    for streaming in (False, True):
+      plugin = make_plugin(llm, mcp, streaming, concurrency)
+      await measure(plugin, 1, 1)
+      report("streaming" if streaming else "non-streaming", await measure(plugin, requests, concurrency), overhead)
+      await plugin.shutdown()
+      await plugin.handler.mcp.session_manager.close()
+    print(f"{llm.requests} completions, {mcp.calls} tool calls served")
+
+
+if __name__ == "__main__":
+  asyncio.run(
+    main(
+      int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+      int(sys.argv[2]) if len(sys.argv) > 2 else 4,
+      float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.05,
+      int(sys.argv[4]) if len(sys.argv) > 4 else 1,
+    )
+  )
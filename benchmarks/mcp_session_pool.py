@@ -0,0 +1,75 @@
+"""per-call latency of a fresh mcp session per call versus the pooled session
+
+usage: python -m benchmarks.mcp_session_pool [calls] [concurrency]
+"""
+import asyncio
+import statistics
+import sys
+import time
+from typing import Awaitable
+from typing import Callable
+from typing import List
+from unittest.mock import MagicMock
+
+from mcp import ClientSession
+
+from benchmarks.standins import MCPStandin
+from lotb.plugins._llm.mcp_manager import MCPManager
+from lotb.plugins._llm.mcp_manager import MCPSessionManager
+from lotb.plugins._llm.tool_handler import ToolHandler
+
+
+async def call_with_fresh_session(server_cfg, tool_name: str) -> str:
+  async with MCPSessionManager.get_mcp_session(server_cfg) as (read, write, _):
+    async with ClientSession(read, write) as session:
+      await session.initialize()
+      result = await session.call_tool(tool_name, {"query": "ping"})
+      return str(result)
+
+
+async def measure(call: Callable[[], Awaitable[str]], calls: int, concurrency: int) -> List[float]:
+  latencies: List[float] = []
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def timed():
+    async with semaphore:
+      started = time.perf_counter()
+      await call()
+      latencies.append((time.perf_counter() - started) * 1000)
+
+  await asyncio.gather(*(timed() for _ in range(calls)))
+  return latencies
+
+
+def report(label: str, latencies: List[float]):
+  latencies = sorted(latencies)
+  p95 = latencies[int(len(latencies) * 0.95) - 1]
+  print(
+    f"{label:<16} mean {statistics.mean(latencies):7.2f} ms  p50 {statistics.median(latencies):7.2f} ms  p95 {p95:7.2f} ms"
+  )
+
+
+async def main(calls: int, concurrency: int):
+  async with MCPStandin(tools=3) as standin:
+    server_cfg = standin.server_cfg
+    tool_name = f"{standin.name}_tool_0"
+
+    fresh = await measure(lambda: call_with_fresh_session(server_cfg, tool_name), calls, concurrency)
+
+    plugin = MagicMock()
+    manager = MCPManager(plugin, [server_cfg])
+    handler = ToolHandler(plugin, manager)
+    await handler.call_tool_from_session(server_cfg, tool_name, {"query": "warmup"})
+    pooled = await measure(
+      lambda: handler.call_tool_from_session(server_cfg, tool_name, {"query": "ping"}), calls, concurrency
+    )
+    await manager.session_manager.close()
+
+  print(f"{calls} tool calls, concurrency {concurrency}")
+  report("fresh session", fresh)
+  report("pooled session", pooled)
+  print(f"speedup {statistics.mean(fresh) / statistics.mean(pooled):.1f}x")
+
+
+if __name__ == "__main__":
+  asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[2]) if len(sys.argv) > 2 else 1))
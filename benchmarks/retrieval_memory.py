@@ -0,0 +1,53 @@
+"""search latency and memory of the retrieval memory index
+
+usage: python -m benchmarks.retrieval_memory [turns] [chats] [dimensions]
+"""
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from lotb.plugins._llm.memory import ChatIndex
+from lotb.plugins._llm.memory import normalize
+
+
+def main(turns: int, chats: int, dimensions: int, queries: int = 200):
+  rng = np.random.default_rng(0)
+  per_chat = turns // chats
+  indexes = []
+  started = time.perf_counter()
+  for chat in range(chats):
+    index = ChatIndex(dimensions)
+    # turns arrive a few at a time, like the bot appends them after every answer
+    for offset in range(0, per_chat, 1000):
+      batch = min(1000, per_chat - offset)
+      index.add(
+        np.arange(offset, offset + batch), normalize(rng.standard_normal((batch, dimensions), dtype=np.float32))
+      )
+    indexes.append(index)
+  build = time.perf_counter() - started
+
+  query_vectors = normalize(rng.standard_normal((queries, dimensions), dtype=np.float32))
+  latencies = []
+  for i, query in enumerate(query_vectors):
+    index = indexes[i % chats]
+    started = time.perf_counter()
+    index.search(query, top_k=3, exclude_recent=6)
+    latencies.append((time.perf_counter() - started) * 1000)
+
+  latencies.sort()
+  size = sum(index.nbytes for index in indexes) / 1024 / 1024
+  print(f"{turns} turns in {chats} chats, {dimensions} dimensions, built in {build:.1f}s, {size:.0f} MiB")
+  print(
+    f"search  mean {statistics.mean(latencies):6.2f} ms  p50 {statistics.median(latencies):6.2f} ms  "
+    f"p95 {latencies[int(len(latencies) * 0.95) - 1]:6.2f} ms"
+  )
+
+
+if __name__ == "__main__":
+  main(
+    int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000,
+    int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+    int(sys.argv[3]) if len(sys.argv) > 3 else 256,
+  )
@@ -0,0 +1,68 @@
+"""input and tool name validation: one regex per rule versus the compiled alternation and the cached verdicts
+
+usage: python -m benchmarks.security_validator [input kib] [repeats]
+"""
+import re
+import statistics
+import sys
+import time
+from typing import Callable
+from typing import List
+
+from lotb.common.security import DEFAULT_BLOCKED_TOOL_PATTERNS
+from lotb.common.security import DEFAULT_SUSPICIOUS_CONTENT_PATTERNS
+from lotb.common.security import SecurityValidator
+
+# the rules as they were checked before, one pattern at a time
+PER_RULE_CONTENT = [re.compile(pattern, re.IGNORECASE) for pattern in DEFAULT_SUSPICIOUS_CONTENT_PATTERNS]
+PER_RULE_TOOLS = [re.compile(f".*{pattern}.*", re.IGNORECASE) for pattern in DEFAULT_BLOCKED_TOOL_PATTERNS]
+
+
+def per_rule_input(text: str) -> bool:
+  return not any(pattern.search(text) for pattern in PER_RULE_CONTENT)
+
+
+def per_rule_tool(name: str) -> bool:
+  return not any(pattern.match(name) for pattern in PER_RULE_TOOLS)
+
+
+def measure(call: Callable[[], object], repeats: int) -> List[float]:
+  latencies = []
+  for _ in range(repeats):
+    started = time.perf_counter()
+    call()
+    latencies.append((time.perf_counter() - started) * 1000)
+  return latencies
+
+
+def report(label: str, latencies: List[float]):
+  latencies = sorted(latencies)
+  p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+  print(
+    f"{label:<28} mean {statistics.mean(latencies):8.3f} ms  p50 {statistics.median(latencies):8.3f} ms  p95 {p95:8.3f} ms"
+  )
+
+
+def main(kib: int, repeats: int):
+  validator = SecurityValidator()
+  words = "please summarize the onboarding notes of the operations team and the open questions on them ".split()
+  clean = " ".join(words[i % len(words)] for i in range(kib * 1024 // 6))[: kib * 1024]
+  # the worst case for the per rule scan, the only match is at the very end
+  tail = clean + " <script>alert(1)</script>"
+  assert per_rule_input(clean) and validator.validate_user_input(clean)[0]
+  assert not per_rule_input(tail) and not validator.validate_user_input(tail)[0]
+
+  print(f"{kib} KiB prompts, {repeats} repeats")
+  report("clean input, per rule", measure(lambda: per_rule_input(clean), repeats))
+  report("clean input, compiled", measure(lambda: validator.validate_user_input(clean), repeats))
+  report("match at the end, per rule", measure(lambda: per_rule_input(tail), repeats))
+  report("match at the end, compiled", measure(lambda: validator.validate_user_input(tail), repeats))
+
+  names = [f"server_{i}_get_record_{i}" for i in range(200)]
+  validator.validate_catalog(names)
+  report("200 tool names, per rule", measure(lambda: [per_rule_tool(name) for name in names], repeats))
+  report("200 tool names, cached", measure(lambda: [validator.llm_validate_tool_name(name) for name in names], repeats))
+
+
+if __name__ == "__main__":
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 256, int(sys.argv[2]) if len(sys.argv) > 2 else 50)
@@ -0,0 +1,217 @@
+"""local stand-in servers used by the benchmarks and the integration tests, nothing here talks to the internet"""
+import asyncio
+import itertools
+import json
+import time
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import uvicorn
+from mcp.server.fastmcp import FastMCP
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+
+class StandinServer:
+  """asgi app served in-process by uvicorn on a random port"""
+
+  def __init__(self):
+    self.port = 0
+    self._server: Optional[uvicorn.Server] = None
+    self._task: Optional[asyncio.Task] = None
+
+  @property
+  def url(self) -> str:
+    return f"http://127.0.0.1:{self.port}"
+
+  def app(self):
+    raise NotImplementedError
+
+  async def start(self):
+    config = uvicorn.Config(self.app(), host="127.0.0.1", port=0, log_level="warning", lifespan="on")
+    self._server = uvicorn.Server(config)
+    self._task = asyncio.create_task(self._server.serve())
+    while not self._server.started:
+      await asyncio.sleep(0.01)
+    self.port = self._server.servers[0].sockets[0].getsockname()[1]
+
+  async def stop(self):
+    if self._server and self._task:
+      self._server.should_exit = True
+      await self._task
+
+  async def __aenter__(self):
+    await self.start()
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.stop()
+
+
+class MCPStandin(StandinServer):
+  """streamable http mcp server with synthetic tools and resources, served in-process on a random port"""
+
+  def __init__(self, tools: int = 5, resources: int = 2, latency: float = 0.0, name: str = "standin"):
+    super().__init__()
+    self.tools = tools
+    self.resources = resources
+    self.latency = latency
+    self.name = name
+    self.calls = 0
+
+  @property
+  def server_cfg(self):
+    return {"name": self.name, "url": self.url, "auth_value": "standin"}
+
+  def build(self) -> FastMCP:
+    mcp = FastMCP(self.name, log_level="WARNING")
+
+    for i in range(self.tools):
+      mcp.add_tool(self._make_tool(i), name=f"{self.name}_tool_{i}", description=f"synthetic tool number {i}")
+
+    for i in range(self.resources):
+      mcp.resource(f"standin://{self.name}/resource_{i}", name=f"resource_{i}", description=f"synthetic resource {i}")(
+        self._make_resource(i)
+      )
+    return mcp
+
+  def _make_tool(self, index: int):
+    async def tool(query: str = "") -> str:
+      self.calls += 1
+      if self.latency:
+        await asyncio.sleep(self.latency)
+      return f"tool {index} answered: {query}"
+
+    return tool
+
+  def _make_resource(self, index: int):
+    async def resource() -> str:
+      self.calls += 1
+      if self.latency:
+        await asyncio.sleep(self.latency)
+      return f"content of resource {index}"
+
+    return resource
+
+  def app(self):
+    return self.build().streamable_http_app()
+
+  async def __aenter__(self) -> "MCPStandin":
+    await self.start()
+    return self
+
+
+class OpenAIStandin(StandinServer):
+  """openai compatible chat completion server: fixed latency, word by word streaming and scripted tool calls
+
+  each turn of the script is {"content": str} or {"tool_calls": [{"name": str, "arguments": dict}]} and is picked by
+  the number of assistant messages already in the request. without a script the first tool offered is called
+  tool_rounds times, with the user message as query, then the answer is returned.
+  """
+
+  def __init__(
+    self,
+    latency: float = 0.0,
+    token_delay: float = 0.0,
+    script: Optional[List[Dict[str, Any]]] = None,
+    tool_rounds: int = 1,
+    answer: str = "the answer is 42",
+  ):
+    super().__init__()
+    self.latency = latency
+    self.token_delay = token_delay
+    self.script = script
+    self.tool_rounds = tool_rounds
+    self.answer = answer
+    self.requests = 0
+    self._ids = itertools.count()
+
+  @property
+  def api_base(self) -> str:
+    return f"{self.url}/v1"
+
+  def app(self):
+    return Starlette(routes=[Route("/v1/chat/completions", self.chat_completions, methods=["POST"])])
+
+  def turn(self, body: Dict[str, Any]) -> Dict[str, Any]:
+    messages = body.get("messages", [])
+    index = sum(1 for message in messages if message.get("role") == "assistant")
+    if self.script is not None:
+      return self.script[min(index, len(self.script) - 1)]
+
+    tools = body.get("tools") or []
+    if tools and index < self.tool_rounds:
+      query = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+      return {"tool_calls": [{"name": tools[0]["function"]["name"], "arguments": {"query": str(query)}}]}
+    return {"content": self.answer}
+
+  def _tool_calls(self, turn: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+      {
+        "index": i,
+        "id": f"call_{next(self._ids)}",
+        "type": "function",
+        "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}))},
+      }
+      for i, call in enumerate(turn.get("tool_calls", []))
+    ]
+
+  @staticmethod
+  def _usage(body: Dict[str, Any], content: str) -> Dict[str, int]:
+    prompt = len(json.dumps(body.get("messages", []))) // 4
+    completion = len(content.split()) + 1
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+  async def chat_completions(self, request: Request):
+    body = await request.json()
+    self.requests += 1
+    if self.latency:
+      await asyncio.sleep(self.latency)
+
+    turn = self.turn(body)
+    content = turn.get("content") or ""
+    tool_calls = self._tool_calls(turn)
+    finish_reason = "tool_calls" if tool_calls else "stop"
+    base = {"id": f"chatcmpl-{next(self._ids)}", "created": int(time.time()), "model": body.get("model", "standin")}
+    if body.get("stream"):
+      chunks = self._stream(body, base, content, tool_calls, finish_reason)
+      return StreamingResponse(chunks, media_type="text/event-stream")
+
+    message: Dict[str, Any] = {"role": "assistant", "content": content or None}
+    if tool_calls:
+      message["tool_calls"] = [{k: v for k, v in call.items() if k != "index"} for call in tool_calls]
+    return JSONResponse(
+      {
+        **base,
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": self._usage(body, content),
+      }
+    )
+
+  async def _stream(
+    self, body: Dict[str, Any], base: Dict[str, Any], content: str, tool_calls: List[Dict[str, Any]], finish: str
+  ) -> AsyncIterator[str]:
+    def event(delta: Dict[str, Any], finish_reason: Optional[str] = None, **extra) -> str:
+      chunk = {**base, "object": "chat.completion.chunk", **extra}
+      chunk["choices"] = [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+      return f"data: {json.dumps(chunk)}\n\n"
+
+    yield event({"role": "assistant", "content": ""})
+    for i, word in enumerate(content.split(" ") if content else []):
+      if self.token_delay:
+        await asyncio.sleep(self.token_delay)
+      yield event({"content": word if i == 0 else f" {word}"})
+    if tool_calls:
+      yield event({"tool_calls": tool_calls})
+    yield event({}, finish)
+    if (body.get("stream_options") or {}).get("include_usage"):
+      chunk = {**base, "object": "chat.completion.chunk", "choices": [], "usage": self._usage(body, content)}
+      yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import re
+import sqlite3
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import litellm
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# request parameters that never change the answer
+IGNORED_PARAMS = ("api_key", "stream", "cache")
+
+
+def normalize_content(content: Any) -> Any:
+  if isinstance(content, str):
+    # only the spacing, case can change the answer (names, code, acronyms)
+    return WHITESPACE_PATTERN.sub(" ", content).strip()
+  return content
+
+
+def response_cache_key(model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+  """model, messages with whitespace normalized, tool set and sampling parameters"""
+  normalized = [{"role": m.get("role"), "content": normalize_content(m.get("content"))} for m in messages]
+  tools = sorted(params.get("tools") or [], key=lambda tool: tool.get("function", {}).get("name", ""))
+  other = {k: v for k, v in params.items() if k not in IGNORED_PARAMS and k != "tools"}
+  payload = json.dumps(
+    {"model": model, "messages": normalized, "tools": tools, "params": other}, sort_keys=True, default=str
+  )
+  return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LLMResponseCache:
+  """exact match cache of completions stored in sqlite, entries expire after ttl and the least used are trimmed"""
+
+  def __init__(self, connection: sqlite3.Connection, ttl: float = 3600, max_entries: int = 1000):
+    self.connection = connection
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.saved_tokens = 0
+
+  def create_table(self):
+    self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS llm_response_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT NOT NULL,
+            total_tokens INTEGER DEFAULT 0,
+            hits INTEGER DEFAULT 0,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+    self.connection.commit()
+
+  def get(self, key: str) -> Optional[litellm.ModelResponse]:
+    row = self.connection.execute(
+      "SELECT response, total_tokens FROM llm_response_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+    ).fetchone()
+    if row is None:
+      self.misses += 1
+      return None
+
+    self.connection.execute(
+      "UPDATE llm_response_cache SET hits = hits + 1, last_used = ? WHERE key = ?", (time.time(), key)
+    )
+    self.connection.commit()
+    self.hits += 1
+    self.saved_tokens += row[1]
+    response = litellm.ModelResponse(**json.loads(row[0]))
+    response._hidden_params["cache_hit"] = True
+    return response
+
+  def set(self, key: str, model: str, response: litellm.ModelResponse):
+    usage = getattr(response, "usage", None)
+    total_tokens = getattr(usage, "total_tokens", 0) or 0
+    now = time.time()
+    self.connection.execute(
+      "INSERT OR REPLACE INTO llm_response_cache (key, model, response, total_tokens, expires_at, last_used) "
+      "VALUES (?, ?, ?, ?, ?, ?)",
+      # litellm declares choices as a union with the streaming types, which only makes pydantic warn
+      (key, model, response.model_dump_json(warnings=False), total_tokens, now + self.ttl, now),
+    )
+    self.connection.execute("DELETE FROM llm_response_cache WHERE expires_at <= ?", (now,))
+    self.connection.execute(
+      "DELETE FROM llm_response_cache WHERE key NOT IN "
+      "(SELECT key FROM llm_response_cache ORDER BY last_used DESC LIMIT ?)",
+      (self.max_entries,),
+    )
+    self.connection.commit()
+
+  @property
+  def hit_rate(self) -> float:
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+  def stats(self) -> Dict[str, Any]:
+    entries = self.connection.execute("SELECT COUNT(*) FROM llm_response_cache").fetchone()[0]
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hit_rate,
+      "saved_tokens": self.saved_tokens,
+      "entries": entries,
+    }
+
+  def describe(self) -> str:
+    stats = self.stats()
+    return (
+      f"{stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+      f"{stats['saved_tokens']} tokens saved, {stats['entries']} entries"
+    )
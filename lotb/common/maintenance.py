@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import re
+import sqlite3
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from telegram.ext import ContextTypes
+from telegram.ext import JobQueue
+
+logger = logging.getLogger("lotb")
+
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+# seconds between two delete batches
+BATCH_PAUSE = 0.01
+
+
+class RetentionPolicy:
+  """rows in `table` older than `days` (compared on `column`) are pruned by the maintenance job"""
+
+  def __init__(self, table: str, column: str = "timestamp", days: int = 30):
+    if not IDENTIFIER_PATTERN.match(table) or not IDENTIFIER_PATTERN.match(column):
+      raise ValueError(f"invalid retention policy identifiers: {table}.{column}")
+    self.table = table
+    self.column = column
+    self.days = days
+
+  def __repr__(self) -> str:
+    return f"RetentionPolicy(table={self.table!r}, column={self.column!r}, days={self.days})"
+
+
+class DatabaseMaintenance:
+  def __init__(self, config, plugins: Dict[str, Any]):
+    maintenance_config = config.get("core.maintenance", {}) or {}
+    self.database = config.get("core.database", ":memory:")
+    self.plugins = plugins
+    self.enabled = str(maintenance_config.get("enabled", True)).lower() not in ("false", "0", "no")
+    self.interval = int(maintenance_config.get("interval", 24))
+    self.batch_size = int(maintenance_config.get("batch_size", 500))
+    self.vacuum_pages = int(maintenance_config.get("vacuum_pages", 0))
+    self.retention: Dict[str, Any] = maintenance_config.get("retention", {}) or {}
+    self.connection: Optional[sqlite3.Connection] = None
+
+  def connect(self) -> sqlite3.Connection:
+    if self.connection is None:
+      self.connection = sqlite3.connect(self.database, timeout=30)
+    return self.connection
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+  def collect_policies(self) -> List[RetentionPolicy]:
+    policies: Dict[str, RetentionPolicy] = {}
+    for plugin in list(self.plugins.values()):
+      if not hasattr(plugin, "retention_policies"):
+        continue
+      for policy in plugin.retention_policies():
+        policies[policy.table] = policy
+
+    for policy in policies.values():
+      if policy.table in self.retention:
+        policy.days = int(self.retention[policy.table])
+
+    return [policy for policy in policies.values() if policy.days > 0]
+
+  def table_exists(self, table: str) -> bool:
+    cursor = self.connect().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+  def database_size(self) -> int:
+    connection = self.connect()
+    page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+    page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
+
+  def ensure_incremental_vacuum(self):
+    connection = self.connect()
+    mode = connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if mode != SQLITE_AUTO_VACUUM_INCREMENTAL:
+      # switching auto_vacuum mode on an existing database only takes effect after a full VACUUM,
+      # so this is paid once and every later run only releases the free pages
+      logger.info("[maintenance] converting database to incremental auto vacuum")
+      connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+      connection.execute("VACUUM")
+
+  def prune_table(self, policy: RetentionPolicy) -> int:
+    connection = self.connect()
+    if not self.table_exists(policy.table):
+      logger.debug(f"[maintenance] skipping {policy.table}: table does not exist")
+      return 0
+
+    query = (
+      f"DELETE FROM {policy.table} WHERE rowid IN ("
+      f"SELECT rowid FROM {policy.table} WHERE {policy.column} < datetime('now', ?) LIMIT ?)"
+    )
+    deleted = 0
+    while True:
+      cursor = connection.execute(query, (f"-{policy.days} days", self.batch_size))
+      connection.commit()
+      deleted += cursor.rowcount
+      if cursor.rowcount < self.batch_size:
+        break
+      # short transactions, the plugins writing to the same database get the lock between batches
+      time.sleep(BATCH_PAUSE)
+    return deleted
+
+  def run_sync(self, policies: List[RetentionPolicy]) -> Dict[str, Any]:
+    """the whole maintenance on one connection, blocking, meant to run in a worker thread"""
+    report: Dict[str, Any] = {"deleted": {}, "size_before": 0, "size_after": 0, "reclaimed": 0}
+    try:
+      connection = self.connect()
+      self.ensure_incremental_vacuum()
+      report["size_before"] = self.database_size()
+
+      for policy in policies:
+        deleted = self.prune_table(policy)
+        report["deleted"][policy.table] = deleted
+        if deleted:
+          logger.info(f"[maintenance] pruned {deleted} rows from {policy.table} older than {policy.days} days")
+
+      connection.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})")
+      connection.execute("PRAGMA optimize")
+      connection.commit()
+
+      report["size_after"] = self.database_size()
+      report["reclaimed"] = max(report["size_before"] - report["size_after"], 0)
+      logger.info(
+        f"[maintenance] completed: {sum(report['deleted'].values())} rows deleted, "
+        f"{report['reclaimed']} bytes reclaimed, database size {report['size_after']} bytes"
+      )
+    except sqlite3.Error as e:
+      logger.error(f"[maintenance] database maintenance failed: {e}")
+    finally:
+      # sqlite connections belong to the thread that opened them, the next run may get another worker
+      self.close()
+    return report
+
+  async def run(self, context: Optional[ContextTypes.DEFAULT_TYPE] = None) -> Dict[str, Any]:
+    # the one time VACUUM and the DELETE batches can take seconds on a large database, keep them off the event loop
+    return await asyncio.to_thread(self.run_sync, self.collect_policies())
+
+  def set_job_queue(self, job_queue: JobQueue):
+    if not self.enabled:
+      logger.info("[maintenance] database maintenance disabled in config")
+      return
+    if self.database == ":memory:":
+      logger.info("[maintenance] in-memory database, skipping database maintenance")
+      return
+    job_queue.run_repeating(self.run, interval=self.interval * 3600, first=60)
+    logger.info(f"[maintenance] database maintenance scheduled every {self.interval} hours")
@@ -5,6 +5,7 @@ from contextlib import contextmanager
 from typing import Callable
 from typing import Dict
 from typing import List
+from typing import Optional
 
 import httpx
 import litellm
@@ -13,37 +14,10 @@ from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
 from telegram.ext import JobQueue
 
-
-class SecurityValidator:
-  def __init__(self):
-    self.max_tool_arg_size = 10000
-    self.blocked_tool_patterns = [
-      re.compile(pattern, re.IGNORECASE)
-      for pattern in [r".*exec.*", r".*eval.*", r".*shell.*", r".*cmd.*", r".*rm\s+.*", r".*delete.*", r".*drop.*"]
-    ]
-    self.suspicious_content_patterns = [
-      re.compile(pattern, re.IGNORECASE)
-      for pattern in [
-        r"<script[\s\S]*?>.*?</script>",
-        r"javascript:",
-        r"on\w+=",
-        r"data:text/html",
-        r"data:text/javascript",
-        r"data:text/css",
-      ]
-    ]
-
-  def validate_user_input(self, text: str) -> tuple[bool, str]:
-    for pattern in self.suspicious_content_patterns:
-      if pattern.search(text):
-        return False, f"Input contains suspicious content matching pattern: {pattern.pattern}"
-    return True, ""
-
-  def llm_validate_tool_name(self, tool_name: str) -> tuple[bool, str]:
-    for pattern in self.blocked_tool_patterns:
-      if pattern.match(tool_name):
-        return False, f"tool '{tool_name}' matches blocked pattern"
-    return True, ""
+from lotb.common.llm_cache import LLMResponseCache
+from lotb.common.llm_cache import response_cache_key
+from lotb.common.maintenance import RetentionPolicy
+from lotb.common.security import SecurityValidator
 
 
 class PluginBase:
@@ -58,7 +32,8 @@ class PluginBase:
     self.pattern_actions: Dict[str, Callable] = {}
     self.auth_group_ids: List[int] = []
     self.auth_group_enabled = False
-    self.security_validator = SecurityValidator()
+    self.security_validator = SecurityValidator.shared()
+    self.llm_cache: Optional[LLMResponseCache] = None
 
   def initialize_plugin(self):
     if self.config is None:
@@ -86,8 +61,9 @@ class PluginBase:
     self.db_cursor = self.connection.cursor()
     self.log_info(f"Database connection established for {self.name}")
 
-    if self.require_auth:
-      self.admin_ids = [int(admin_id) for admin_id in self.config.get("core.admins", [])]
+    # also loaded for plugins without auth, some commands show more to the admins
+    self.admin_ids = [int(admin_id) for admin_id in self.config.get("core.admins", [])]
+    self.security_validator = SecurityValidator.from_config(self.config.get("core.security", {}))
 
     self.auth_group_ids = [int(group_id) for group_id in plugin_config.get("auth_groups_ids", [])]
     self.auth_group_enabled = plugin_config.get("auth_group_enabled", False)
@@ -146,6 +122,14 @@ class PluginBase:
   def set_job_queue(self, job_queue: JobQueue):
     pass
 
+  async def shutdown(self):
+    """override to persist buffered state before the bot stops"""
+    pass
+
+  def retention_policies(self) -> List[RetentionPolicy]:
+    """override to let the core maintenance job prune old rows from the plugin tables"""
+    return []
+
   def escape_markdown(self, text):
     special_chars = ["_", "*", "[", "]", "(", ")", "~", "`", ">", "#", "+", "-", "=", "|", "{", "}", ".", "!"]
     return "".join("\\" + char if char in special_chars else char for char in str(text))
@@ -176,8 +160,15 @@ class PluginBase:
       logging.getLogger("LiteLLM").setLevel(original_level)
       self.log_info(f"Completed llm completion with model: {model_name}")
 
+  def enable_llm_cache(self, ttl: float = 3600, max_entries: int = 1000):
+    """opt in to the response cache, only llm_completion calls made with cache=True use it"""
+    if not self.connection:
+      return
+    self.llm_cache = LLMResponseCache(self.connection, ttl, max_entries)
+    self.llm_cache.create_table()
+
   async def llm_completion(
-    self, messages: list, model: str | None = None, api_key: str | None = None, **kwargs
+    self, messages: list, model: str | None = None, api_key: str | None = None, cache: bool = False, **kwargs
   ) -> litellm.ModelResponse:
     try:
       if not model:
@@ -196,8 +187,17 @@ class PluginBase:
         if k != "model" and v is not None:
           filtered_params[k] = v
 
+      key = None
+      if cache and self.llm_cache and not kwargs.get("stream"):
+        key = response_cache_key(model, messages, params)
+        if cached := self.llm_cache.get(key):
+          self.log_info(f"llm response served from cache: {self.llm_cache.describe()}")
+          return cached
+
       with self._wrap_llm_logging(model):
         response = await litellm.acompletion(**filtered_params)
+      if key and self.llm_cache:
+        self.llm_cache.set(key, model, response)
       return response
     except httpx.HTTPError as e:
       self.log_error(f"llm completion failed: {str(e)}")
@@ -0,0 +1,96 @@
+import re
+from functools import lru_cache
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+# rules are searched anywhere in the lowercased text or tool name, so they are written in lowercase
+DEFAULT_BLOCKED_TOOL_PATTERNS = (r"exec", r"eval", r"shell", r"cmd", r"rm\s+", r"delete", r"drop")
+DEFAULT_SUSPICIOUS_CONTENT_PATTERNS = (
+  r"<script[\s\S]*?>.*?</script>",
+  r"javascript:",
+  r"on\w+=",
+  r"data:text/html",
+  r"data:text/javascript",
+  r"data:text/css",
+)
+
+
+class RuleSet:
+  """all the rules in one alternation scanned once over the lowercased text, the rule that matched is only looked
+  up on a hit. without capture groups or ignorecase re keeps its first character prefilter, which makes one pass over
+  the alternation several times faster than one pass per rule"""
+
+  def __init__(self, patterns: Sequence[str]):
+    self.patterns = tuple(patterns)
+    self.rules = [re.compile(pattern) for pattern in self.patterns]
+    self.combined = re.compile("|".join(f"(?:{pattern})" for pattern in self.patterns)) if self.patterns else None
+
+  def search(self, text: str) -> Optional[str]:
+    """the first rule matching at the leftmost match, none if the text is clean"""
+    if self.combined is None:
+      return None
+    lowered = text.lower()
+    match = self.combined.search(lowered)
+    if match is None:
+      return None
+    return next((rule.pattern for rule in self.rules if rule.match(lowered, match.start())), self.patterns[0])
+
+
+class SecurityValidator:
+  def __init__(
+    self,
+    blocked_tool_patterns: Sequence[str] = DEFAULT_BLOCKED_TOOL_PATTERNS,
+    suspicious_content_patterns: Sequence[str] = DEFAULT_SUSPICIOUS_CONTENT_PATTERNS,
+    max_cached_verdicts: int = 1024,
+  ):
+    self.max_tool_arg_size = 10000
+    self.blocked_tool_patterns = tuple(blocked_tool_patterns)
+    self.suspicious_content_patterns = tuple(suspicious_content_patterns)
+    self._blocked_tools = RuleSet(self.blocked_tool_patterns)
+    self._suspicious_content = RuleSet(self.suspicious_content_patterns)
+    self.max_cached_verdicts = max_cached_verdicts
+    self._tool_verdicts: Dict[str, Tuple[bool, str]] = {}
+
+  @classmethod
+  def from_config(cls, security_config: Optional[Dict[str, Any]] = None) -> "SecurityValidator":
+    security_config = security_config or {}
+    return cls.shared(
+      tuple(security_config.get("blocked_tool_patterns", DEFAULT_BLOCKED_TOOL_PATTERNS)),
+      tuple(security_config.get("suspicious_content_patterns", DEFAULT_SUSPICIOUS_CONTENT_PATTERNS)),
+    )
+
+  @classmethod
+  @lru_cache(maxsize=8)
+  def shared(
+    cls,
+    blocked_tool_patterns: Tuple[str, ...] = DEFAULT_BLOCKED_TOOL_PATTERNS,
+    suspicious_content_patterns: Tuple[str, ...] = DEFAULT_SUSPICIOUS_CONTENT_PATTERNS,
+  ) -> "SecurityValidator":
+    """one validator per rule set, shared by every plugin"""
+    return cls(blocked_tool_patterns, suspicious_content_patterns)
+
+  def validate_user_input(self, text: str) -> tuple[bool, str]:
+    if pattern := self._suspicious_content.search(text):
+      return False, f"Input contains suspicious content matching pattern: {pattern}"
+    return True, ""
+
+  def llm_validate_tool_name(self, tool_name: str) -> tuple[bool, str]:
+    if verdict := self._tool_verdicts.get(tool_name):
+      return verdict
+    verdict = (True, "")
+    if self._blocked_tools.search(tool_name):
+      verdict = (False, f"tool '{tool_name}' matches blocked pattern")
+    if len(self._tool_verdicts) >= self.max_cached_verdicts:
+      # names outside the catalog come from the model, do not let them grow the cache forever
+      self._tool_verdicts.clear()
+    self._tool_verdicts[tool_name] = verdict
+    return verdict
+
+  def validate_catalog(self, tool_names: Iterable[str]) -> List[str]:
+    """check the whole catalog once when it loads, the verdicts are cached for the tool calls, blocked names returned"""
+    return [name for name in tool_names if not self.llm_validate_tool_name(name)[0]]
@@ -13,6 +13,7 @@ from telegram.ext import filters
 from telegram.ext import MessageHandler
 
 from lotb.common.config import Config
+from lotb.common.maintenance import DatabaseMaintenance
 
 # see: https://github.com/encode/httpx/discussions/2765
 httpx_logger = logging.getLogger("httpx")
@@ -178,6 +179,14 @@ async def post_init(application: Application) -> None:
   await application.bot.set_my_commands(commands)
 
 
+async def post_shutdown(application: Application) -> None:
+  for plugin in plugins.values():
+    try:
+      await plugin.shutdown()
+    except Exception as e:
+      logger.error(f"Failed to shut down plugin {plugin.name}: {e}")
+
+
 def main():
   parser = argparse.ArgumentParser(description="LOTB Bot")
   parser.add_argument("--config", required=True, help="Path to the configuration file")
@@ -194,7 +203,15 @@ def main():
     return
 
   global application
-  application = Application.builder().token(token).post_init(post_init).build()
+  application = (
+    Application.builder()
+    .token(token)
+    # updates are handled one at a time unless configured, plugins such as llm queue their own work
+    .concurrent_updates(int(config.get("core.concurrent_updates", 1)))
+    .post_init(post_init)
+    .post_shutdown(post_shutdown)
+    .build()
+  )
 
   default_plugins_dir = Path(__file__).parent / "plugins"
   load_plugins(default_plugins_dir, config)
@@ -211,6 +228,9 @@ def main():
     if hasattr(plugin, "set_job_queue"):
       plugin.set_job_queue(job_queue)
 
+  maintenance = DatabaseMaintenance(config, plugins)
+  maintenance.set_job_queue(job_queue)
+
   application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
   application.add_handler(MessageHandler(filters.PHOTO | filters.ANIMATION, handle_media))
   application.add_handler(CommandHandler("help", help_command))
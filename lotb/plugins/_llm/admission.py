@@ -0,0 +1,134 @@
+import asyncio
+from collections import deque
+from typing import Awaitable
+from typing import Callable
+from typing import Deque
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+
+
+class Ticket:
+  def __init__(self, user_id: int, chat_id: int):
+    self.user_id = user_id
+    self.chat_id = chat_id
+    self.admitted: asyncio.Future = asyncio.get_running_loop().create_future()
+    self.task: Optional[asyncio.Task] = asyncio.current_task()
+    self.superseded = False
+
+
+class AdmissionController:
+  """global, per user and per chat limits on the llm requests running at once, the rest waits in a bounded queue"""
+
+  def __init__(
+    self,
+    plugin: "PluginBase",
+    max_concurrent: int = 4,
+    per_user: int = 1,
+    per_chat: int = 2,
+    max_queue: int = 16,
+    supersede: bool = False,
+  ):
+    self.plugin = plugin
+    self.max_concurrent = max_concurrent
+    self.per_user = per_user
+    self.per_chat = per_chat
+    self.max_queue = max_queue
+    self.supersede = supersede
+    self.running: List[Ticket] = []
+    self.waiting: Deque[Ticket] = deque()
+    self.queued_total = 0
+    self.rejected = 0
+    self.superseded = 0
+
+  @property
+  def depth(self) -> int:
+    return len(self.waiting)
+
+  def _can_run(self, ticket: Ticket) -> bool:
+    return (
+      len(self.running) < self.max_concurrent
+      and sum(t.user_id == ticket.user_id for t in self.running) < self.per_user
+      and sum(t.chat_id == ticket.chat_id for t in self.running) < self.per_chat
+    )
+
+  def _admit_waiting(self):
+    # a waiting request blocked by its own user or chat limit does not hold back the ones behind it
+    for ticket in list(self.waiting):
+      if self._can_run(ticket):
+        self.waiting.remove(ticket)
+        self.running.append(ticket)
+        ticket.admitted.set_result(None)
+
+  def _release(self, ticket: Ticket):
+    if ticket in self.waiting:
+      self.waiting.remove(ticket)
+    if ticket in self.running:
+      self.running.remove(ticket)
+    self._admit_waiting()
+
+  def _supersede(self, user_id: int, chat_id: int):
+    for ticket in [*self.running, *self.waiting]:
+      if ticket.user_id == user_id and ticket.chat_id == chat_id:
+        # the slot is freed right away so the newer request does not queue behind the one it replaces
+        ticket.superseded = True
+        self.superseded += 1
+        if ticket in self.waiting:
+          self.waiting.remove(ticket)
+        else:
+          self.running.remove(ticket)
+        if ticket.task:
+          ticket.task.cancel()
+
+  async def run(self, update: Update, context: ContextTypes.DEFAULT_TYPE, work: Callable[[], Awaitable[None]]):
+    if not update.effective_user or not update.effective_chat:
+      await work()
+      return
+
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    if self.supersede:
+      self._supersede(user_id, chat_id)
+
+    ticket = Ticket(user_id, chat_id)
+    if self._can_run(ticket):
+      self.running.append(ticket)
+    elif len(self.waiting) >= self.max_queue:
+      self.rejected += 1
+      self.plugin.log_warning(f"llm queue full ({self.depth} waiting), rejecting request of user {user_id}")
+      await self.plugin.reply_message(update, context, "too many requests right now, try again in a moment")
+      return
+    else:
+      self.waiting.append(ticket)
+      self.queued_total += 1
+      self.plugin.log_info(f"llm request of user {user_id} queued, queue depth {self.depth}")
+
+    try:
+      if not ticket.admitted.done() and ticket in self.waiting:
+        await self.plugin.reply_message(update, context, f"queued, position {self.waiting.index(ticket) + 1}")
+        await ticket.admitted
+      await work()
+      if ticket.superseded:
+        # superseded right as it finished, take the pending cancellation here instead of in the caller
+        await asyncio.sleep(0)
+    except asyncio.CancelledError:
+      if not ticket.superseded:
+        raise
+      # the cancellation was ours, the task itself goes on
+      if ticket.task:
+        ticket.task.uncancel()
+      self.plugin.log_info(f"llm request of user {user_id} superseded by a newer one")
+    finally:
+      self._release(ticket)
+
+  def describe(self) -> str:
+    return (
+      f"{len(self.running)} running, {self.depth} waiting (max {self.max_queue}), "
+      f"{self.queued_total} queued, {self.rejected} rejected, {self.superseded} superseded"
+    )
@@ -1,32 +1,79 @@
+import asyncio
 import re
 from typing import Any
 from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import TYPE_CHECKING
 
+import litellm
 from telegram import Update
 from telegram.ext import ContextTypes
+from telegram.ext import JobQueue
 
+from .admission import AdmissionController
+from .budget import LoopBudget
+from .cache import ResultCache
+from .compaction import HistoryCompactor
+from .context import ContextBuilder
 from .history import ConversationHistory
 from .mcp_manager import MCPManager
+from .memory import RetrievalMemory
+from .prompt_cache import canonical_resources
+from .prompt_cache import canonical_tools
+from .prompt_cache import PromptCacheStats
+from .prompt_cache import supports_cache_control
+from .prompt_cache import with_cache_control
 from .prompts import ASSISTANT_DEFAULT_PROMPT
+from .prompts import PARTIAL_ANSWER_PROMPT
 from .prompts import SystemPromptBuilder
+from .router import ModelRouter
+from .streaming import StreamingReply
 from .tool_handler import ToolHandler
+from .tool_ranker import estimate_tokens
+from .tool_ranker import ToolRanker
+from .usage import usage_scope
+from .usage import UsageTracker
 
 if TYPE_CHECKING:
   from lotb.common.plugin_class import PluginBase
   from .config import LLMConfig
 
+# tool output returned as is when the budget runs out before the model could answer
+PARTIAL_RESULTS_CHARS = 1500
+
 
 class AssistantHandler:
   def __init__(self, plugin: "PluginBase", config: "LLMConfig"):
     self.plugin = plugin
     self.config = config
-    self.history = ConversationHistory(plugin, config.max_history)
-    self.mcp = MCPManager(plugin, config.mcp_servers)
-    self.tool_handler = ToolHandler(plugin, self.mcp)
+    self.history = ConversationHistory(
+      plugin,
+      config.history_limit,
+      max_conversations=config.history_cache_size,
+      flush_interval=config.history_flush_interval,
+    )
+    self.mcp = MCPManager(plugin, config.mcp_servers, config.discovery_timeout)
+    self.tool_handler = ToolHandler(
+      plugin,
+      self.mcp,
+      ResultCache(ttl=config.cache_ttl, max_entries=config.cache_max_entries, max_bytes=config.cache_max_bytes),
+    )
+    self.usage = UsageTracker(plugin, flush_interval=config.history_flush_interval)
+    self.router = ModelRouter(plugin, config, self.usage)
+    self.admission = AdmissionController(
+      plugin,
+      max_concurrent=config.max_concurrent_requests,
+      per_user=config.user_concurrency,
+      per_chat=config.chat_concurrency,
+      max_queue=config.queue_size,
+      supersede=config.supersede,
+    )
+    self.context_builder = ContextBuilder(plugin, config, self.router)
+    self.memory = RetrievalMemory(plugin, config) if config.memory else None
+    self.compactor = HistoryCompactor(plugin, config, self.history, self.router) if config.compaction else None
     self.pattern_actions: Dict[str, Callable] = {}
 
     system_prompt_template = config.system_prompt or ASSISTANT_DEFAULT_PROMPT
@@ -35,9 +82,16 @@ class AssistantHandler:
     self.tools: Optional[List[Dict[str, Any]]] = None
     self.resources: Optional[List[Dict[str, Any]]] = None
     self.capabilities_summary: Optional[str] = None
+    self._system_prompt_memo: Optional[Tuple[int, str]] = None
+    self.prompt_cache = PromptCacheStats()
+    self._discovery_task: Optional[asyncio.Task] = None
+    self.ranker: Optional[ToolRanker] = None
 
   def initialize(self):
     self.history.create_table()
+    if self.memory:
+      self.memory.create_table()
+    self.usage.create_table()
 
     if self.config.friendly_name:
       trigger_pattern = rf"(?i)^\b{re.escape(self.config.friendly_name)}\b[\s,:!?]*"
@@ -61,32 +115,115 @@ class AssistantHandler:
 
     await self.process_query(update, context, text)
 
-  async def _ensure_tools_loaded(self) -> List[Dict[str, Any]]:
-    if self.tools is None and self.config.mcp_servers:
-      self.plugin.log_info("starting lazy loading of tools and resources")
-      regular_tools = await self.mcp.load_all_tools()
-      self.plugin.log_info(f"loaded {len(regular_tools)} regular tools")
-
-      if self.resources is None:
-        self.resources = await self.mcp.load_all_resources()
-        self.plugin.log_info(f"loaded {len(self.resources)} resources")
+  def set_job_queue(self, job_queue: JobQueue):
+    self.history.set_job_queue(job_queue)
+    self.usage.set_job_queue(job_queue)
+    if self.compactor:
+      self.compactor.set_job_queue(job_queue)
+    if not self.config.mcp_servers:
+      return
+    job_queue.run_once(self._start_discovery_job, when=0)
+    if self.config.catalog_refresh_interval > 0:
+      interval = self.config.catalog_refresh_interval * 60
+      job_queue.run_repeating(self.refresh_catalog, interval=interval, first=interval)
+      self.plugin.log_info(f"mcp catalog refreshed every {self.config.catalog_refresh_interval} minutes")
+
+  async def _start_discovery_job(self, context: ContextTypes.DEFAULT_TYPE):
+    self.start_discovery()
+
+  def start_discovery(self) -> asyncio.Task:
+    if self._discovery_task is None:
+      self.plugin.log_info(f"starting background discovery of {len(self.config.mcp_servers)} mcp servers")
+      self._discovery_task = asyncio.create_task(self._discover())
+    return self._discovery_task
+
+  async def _discover(self):
+    try:
+      await self.mcp.discover(on_server_changed=self._on_server_changed)
+      if self.tools is None:
+        await self._rebuild_catalog()
+    except Exception as e:
+      self.plugin.log_error(f"mcp discovery failed: {e}")
+      # let the next request try again
+      self._discovery_task = None
+      return
 
-      resource_tools = await self.tool_handler.create_resource_tools(self.resources)
-      self.plugin.log_info(f"created {len(resource_tools)} resource tools")
+    tool_names = [tool["function"]["name"] for tool in self.tools or [] if tool.get("type") == "function"]
+    self.plugin.log_info(f"available tool names: {tool_names}")
+    self.plugin.log_info(f"resource-to-server mappings: {list(self.mcp.resource_to_server_map.keys())}")
 
-      self.tools = regular_tools + resource_tools
-      self.plugin.log_info("generating capabilities summary...")
-      self.capabilities_summary = await self._generate_capabilities_summary()
-      self.plugin.log_info(f"capabilities summary generated ({len(self.capabilities_summary)} chars)")
-      self.plugin.log_info(f"total tools available: {len(self.tools)}")
+  async def refresh_catalog(self, context: ContextTypes.DEFAULT_TYPE):
+    if self.discovery_in_progress:
+      self.plugin.log_debug("discovery still running, skipping catalog refresh")
+      return
+    self._discovery_task = asyncio.create_task(self.mcp.discover(on_server_changed=self._on_server_changed))
+    try:
+      changed = await self._discovery_task
+    except Exception as e:
+      self.plugin.log_error(f"mcp catalog refresh failed: {e}")
+      return
+    if changed:
+      self.plugin.log_info(f"mcp catalog changed on: {', '.join(changed)}")
+
+  async def _on_server_changed(self, server: Dict[str, Any]):
+    await self._rebuild_catalog()
+    self.plugin.log_info(
+      f"server '{server.get('name', 'unknown')}' discovered, {len(self.tools or [])} tools available"
+    )
+
+  async def _rebuild_catalog(self):
+    regular_tools, resources = self.mcp.catalog()
+    resource_tools = await self.tool_handler.create_resource_tools(resources)
+    # names are validated once per catalog, blocked tools are never offered and the verdicts serve the tool calls
+    tools = regular_tools + resource_tools
+    names = [tool.get("function", {}).get("name", "") for tool in tools]
+    blocked = set(self.plugin.security_validator.validate_catalog(names))
+    if blocked:
+      self.plugin.log_warning(f"tools blocked by security, hidden from the model: {sorted(blocked)}")
+      tools = [tool for tool, name in zip(tools, names) if name not in blocked]
+    # canonical order, the tools and the capabilities in the system prompt only change with the catalog itself
+    self.resources = canonical_resources(resources)
+    self.tools = canonical_tools(tools)
+    self.ranker = ToolRanker(self.tools)
+    self.capabilities_summary = await self._generate_capabilities_summary()
+    self._system_prompt_memo = None
+
+  @property
+  def discovery_in_progress(self) -> bool:
+    return self._discovery_task is not None and not self._discovery_task.done()
 
-      tool_names = [tool["function"]["name"] for tool in self.tools if tool.get("type") == "function"]
-      self.plugin.log_info(f"available tool names: {tool_names}")
-      self.plugin.log_info(f"tool-to-server mappings: {list(self.mcp.tool_to_server_map.keys())}")
-      self.plugin.log_info(f"resource-to-server mappings: {list(self.mcp.resource_to_server_map.keys())}")
+  async def _ensure_tools_loaded(self) -> List[Dict[str, Any]]:
+    if self.tools is None and self.config.mcp_servers:
+      # discovery normally runs at startup, only wait briefly and answer with whatever servers already replied
+      task = self.start_discovery()
+      await asyncio.wait([task], timeout=self.config.discovery_wait)
+      if not task.done():
+        self.plugin.log_warning(f"mcp discovery still running, using {len(self.tools or [])} tools discovered so far")
 
     return self.tools or []
 
+  def caches_prompt(self) -> bool:
+    return self.config.prompt_caching and supports_cache_control(self.config.model)
+
+  def select_tools(self, query: str, tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    if self.config.tool_top_k <= 0 or len(tools) <= self.config.tool_top_k:
+      return tools
+    if self.caches_prompt():
+      # the cache breakpoint sits on the last tool, a subset per query would make every request miss the cache,
+      # the whole canonical catalog is a stable prefix billed at the cached rate after the first request
+      return tools
+    if self.ranker is None or self.ranker.tools is not tools:
+      self.ranker = ToolRanker(tools)
+
+    selected = self.ranker.select(query, self.config.tool_top_k)
+    if selected is not tools:
+      self.plugin.log_info(
+        f"selected {len(selected)}/{len(tools)} tools, "
+        f"~{estimate_tokens(tools) - estimate_tokens(selected)} prompt tokens saved: "
+        f"{[tool['function']['name'] for tool in selected]}"
+      )
+    return selected
+
   async def _generate_capabilities_summary(self) -> str:
     if not self.tools and not self.resources:
       return "no capabilities available at the moment"
@@ -114,60 +251,164 @@ class AssistantHandler:
 
     return "\n\n".join(summary_parts) if summary_parts else "no capabilities available at the moment"
 
+  def _system_prompt(self) -> str:
+    # memoized per catalog version, an identical prefix lets the provider reuse its prompt cache
+    version = self.mcp.catalog_version
+    if self._system_prompt_memo is None or self._system_prompt_memo[0] != version:
+      capabilities = self.capabilities_summary or "loading capabilities..."
+      self._system_prompt_memo = (version, self.system_prompt_builder.with_capabilities(capabilities).build())
+    return self._system_prompt_memo[1]
+
   async def _ensure_system_message(self, messages: List[Dict[str, Any]]):
-    system_content = self.system_prompt_builder.with_capabilities(
-      self.capabilities_summary or "loading capabilities..."
-    ).build()
+    system_content = self._system_prompt()
     if not messages or messages[0].get("role") != "system":
       messages.insert(0, {"role": "system", "content": system_content})
     else:
       messages[0]["content"] = system_content
 
-  async def _get_llm_response(self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None):
-    kwargs: Dict[str, Any] = {"messages": messages, "model": self.config.model, "api_key": self.config.apikey}
+  async def _get_llm_response(
+    self,
+    messages: List[Dict[str, Any]],
+    tools: Optional[List[Dict[str, Any]]] = None,
+    reply: Optional[StreamingReply] = None,
+    budget: Optional[LoopBudget] = None,
+  ):
+    kwargs: Dict[str, Any] = {"messages": messages}
     if tools:
       kwargs["tools"] = tools
-    response = await self.plugin.llm_completion(**kwargs)
+    if self.caches_prompt():
+      kwargs["messages"], kwargs["tools"] = with_cache_control(messages, tools)
+      if not tools:
+        del kwargs["tools"]
+    if reply:
+      response = await self._stream_llm_response(kwargs, reply)
+    else:
+      response = await self.router.completion(**kwargs)
+    if budget:
+      budget.record_completion(response)
+    cached, prompt = self.prompt_cache.record(response)
+    if prompt:
+      self.plugin.log_info(f"prompt cache: {cached}/{prompt} tokens cached, {self.prompt_cache.describe()} overall")
     if not response.choices or not hasattr(response.choices[0], "message"):
       return None, "llm error: invalid response"
 
     return response.choices[0].message, None
 
+  async def _stream_llm_response(self, kwargs: Dict[str, Any], reply: StreamingReply):
+    # text deltas go straight to the chat, the chunks are rebuilt afterwards to recover the tool calls
+    chunks = []
+    stream: Any = await self.router.completion(**kwargs, stream=True)
+    async for chunk in stream:
+      chunks.append(chunk)
+      if chunk.choices and (content := getattr(chunk.choices[0].delta, "content", None)):
+        await reply.append(content)
+    return litellm.stream_chunk_builder(chunks, messages=kwargs["messages"])
+
   async def _handle_llm_conversation(
-    self, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None
+    self,
+    messages: List[Dict[str, Any]],
+    tools: Optional[List[Dict[str, Any]]] = None,
+    reply: Optional[StreamingReply] = None,
   ) -> str:
     await self._ensure_system_message(messages)
-
-    max_iterations = 3
-    iteration = 0
-
-    while iteration < max_iterations:
-      iteration += 1
-      content, error = await self._get_llm_response(messages, tools)
+    budget = LoopBudget.from_config(self.config)
+
+    while not (reason := budget.exhausted()):
+      # the last completion the budget allows answers from the tool results instead of asking for more tools
+      final = budget.iterations + 1 == budget.max_iterations and budget.tool_calls > 0
+      budget.iterations += 1
+      try:
+        content, error = await asyncio.wait_for(
+          self._get_llm_response(*self._final_turn(messages) if final else (messages, tools), reply, budget),
+          timeout=budget.remaining(),
+        )
+      except asyncio.TimeoutError:
+        reason = f"time budget of {budget.max_seconds:g}s spent"
+        break
       if error:
         return error
 
       if not (hasattr(content, "tool_calls") and content.tool_calls):
         return content.content or ""
 
+      if reply:
+        # text streamed before a tool call is only a preamble, the next turn replaces it
+        reply.reset()
+      if final:
+        reason = "max tool call iterations reached"
+        break
+
+      offered = {tool["function"]["name"] for tool in tools or [] if tool.get("type") == "function"}
+      missing = [tool_call.function.name for tool_call in content.tool_calls if tool_call.function.name not in offered]
+      if missing and self.tools and tools is not self.tools:
+        # the model asked for a tool outside the selected subset, ask again with the whole catalog
+        self.plugin.log_info(f"model requested unselected tools {missing}, retrying with all {len(self.tools)} tools")
+        tools = self.tools
+        continue
+
+      if not budget.allows_tool_calls(len(content.tool_calls)):
+        reason = f"tool call budget of {budget.max_tool_calls} spent"
+        break
+
       messages.append({"role": "assistant", "content": content.content or "", "tool_calls": content.tool_calls})
+      budget.tool_calls += len(content.tool_calls)
+      results = await self.tool_handler.execute_tool_calls(
+        content.tool_calls,
+        messages,
+        tools or [],
+        max_concurrency=self.config.tool_concurrency,
+        timeout=self.config.tool_timeout,
+        retries=self.config.tool_retries,
+        budget=budget,
+      )
+      failed = [call.function.name for call, result in zip(content.tool_calls, results) if result in ("failed", None)]
+      if failed:
+        # the errors are in the tool messages, the model answers without those tools or tries another one
+        self.plugin.log_warning(f"skipping failed tools {failed}")
 
-      all_successful = True
-      for tool_call in content.tool_calls:
-        result = await self.tool_handler.execute_tool_call(tool_call, messages, tools or [])
-        if result == "failed" or result is None:
-          all_successful = False
+    self.plugin.log_warning(f"agent loop stopped early, {reason}: {budget.describe()}")
+    return await self._partial_answer(messages, reason, budget, reply)
 
-      if not all_successful:
-        return "tool execution failed"
+  @staticmethod
+  def _final_turn(messages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], None]:
+    return [*messages, {"role": "user", "content": PARTIAL_ANSWER_PROMPT}], None
 
-    return "max tool call iterations reached"
+  async def _partial_answer(
+    self, messages: List[Dict[str, Any]], reason: str, budget: LoopBudget, reply: Optional[StreamingReply] = None
+  ) -> str:
+    """out of budget: a completion left in the budget answers from what was gathered, without one the tool results
+    are returned as they are"""
+    if reply:
+      reply.reset()
+    has_time = budget.remaining() != 0
+    has_tokens = budget.max_tokens is None or budget.tokens < budget.max_tokens
+    if budget.iterations < budget.max_iterations and has_time and has_tokens:
+      budget.iterations += 1
+      try:
+        content, error = await asyncio.wait_for(
+          self._get_llm_response(*self._final_turn(messages), reply, budget), timeout=budget.remaining()
+        )
+        if not error and content is not None and not getattr(content, "tool_calls", None) and content.content:
+          return content.content
+      except asyncio.TimeoutError:
+        pass
+      if reply:
+        reply.reset()
+
+    results = [m["content"] for m in messages if m.get("role") == "tool" and isinstance(m.get("content"), str)]
+    if not results:
+      return f"{reason} before an answer was found"
+    gathered = "\n".join(results)
+    if len(gathered) > PARTIAL_RESULTS_CHARS:
+      gathered = gathered[:PARTIAL_RESULTS_CHARS] + "…"
+    return f"{reason}, partial results:\n{gathered}"
 
   def _get_special_command_handler(self, text: str) -> Optional[Callable]:
     commands = {
       ("tools", "tool"): self.show_tools,
       ("help",): self.show_help,
       ("status",): self.show_status,
+      ("stats",): self.show_stats,
     }
 
     text_lower = text.lower()
@@ -213,10 +454,19 @@ Commands:
 • /llm <prompt> - ask something using available tools
 • /llm tools - show available mcp tools and resources
 • /llm status - show plugin status
+• /llm stats - show token, cost and latency usage
 • /llm help - show this help
 """
     await self.plugin.reply_message(update, context, help_text)
 
+  async def show_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not update.effective_chat:
+      return
+    user_id = update.effective_user.id
+    # totals of other users and chats are only shown to the admins
+    report = self.usage.report(user_id, update.effective_chat.id, include_top=user_id in self.plugin.admin_ids)
+    await self.plugin.reply_message(update, context, report)
+
   async def show_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
     tools = await self._ensure_tools_loaded()
     status = f"""🔧 Assistant status
@@ -230,6 +480,17 @@ Loaded:
 • tools: {len(tools)}
 • resources: {len(self.resources or [])}
 • server mappings: {len(self.mcp.tool_to_server_map)}
+• discovery: {"in progress" if self.discovery_in_progress else "done"}
+• cache: {self.tool_handler.cache.describe() if self.tool_handler.cache.enabled else "disabled"}
+• response cache: {self.plugin.llm_cache.describe() if self.plugin.llm_cache else "disabled"}
+• memory: {self.memory.describe() if self.memory else "disabled"}
+• compaction: {self.compactor.describe() if self.compactor else "disabled"}
+• prompt cache: {self.prompt_cache.describe()}
+• requests: {self.admission.describe()}
+• loop budget: {LoopBudget.from_config(self.config).describe_limits()}
+
+Models:
+{self.router.describe()}
 
 Servers:
 {chr(10).join(f"• {s.get('name', 'unknown')}" for s in self.config.mcp_servers) if self.config.mcp_servers else "❌"}
@@ -247,6 +508,11 @@ Servers:
       await handler(update, context)
       return
 
+    user, chat = update.effective_user, update.effective_chat
+    with usage_scope(user.id if user else None, chat.id if chat else None):
+      await self.admission.run(update, context, lambda: self._answer(update, context, text))
+
+  async def _answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     self.plugin.log_info(f"processing user request: '{text[:50]}...'")
 
     try:
@@ -255,16 +521,34 @@ Servers:
       if user and chat:
         user_id = user.id
         chat_id = chat.id
-        tools = await self._ensure_tools_loaded()
+        tools = self.select_tools(text, await self._ensure_tools_loaded())
         self.plugin.log_info(f"using {len(tools)} tools for this request")
         history = self.history.get_conversation_history(user_id, chat_id)
-        messages = [*history, {"role": "user", "content": text}]
-        await self.plugin.send_typing_action(update, context)
-        response = await self._handle_llm_conversation(messages, tools)
+        recalled = await self.memory.recall(chat_id, text, self.config.max_history) if self.memory else []
+        messages = await self.context_builder.assemble(
+          self._system_prompt(),
+          history,
+          text,
+          reserved=estimate_tokens(tools),
+          recalled=recalled,
+          compacted=self.history.get_memory(user_id, chat_id),
+        )
+        if self.config.streaming:
+          async with StreamingReply(self.plugin, update, context, self.config.stream_edit_interval) as reply:
+            response = await self._handle_llm_conversation(messages, tools, reply)
+            await reply.finish(response)
+        else:
+          await self.plugin.send_typing_action(update, context)
+          response = await self._handle_llm_conversation(messages, tools)
         self.plugin.log_info(f"responding with: '{response[:100]}...'")
         self.history.save_message(user_id, chat_id, "user", text)
         self.history.save_message(user_id, chat_id, "assistant", response)
-        await self.plugin.reply_message(update, context, response)
+        if self.compactor:
+          self.compactor.schedule(user_id, chat_id)
+        if not self.config.streaming:
+          await self.plugin.reply_message(update, context, response)
+        if self.memory:
+          await self.memory.remember(user_id, chat_id, [("user", text), ("assistant", response)])
     except Exception as e:
       await self.plugin.reply_message(
         update, context, f"sorry, something went wrong while processing your request: {str(e)}"
@@ -0,0 +1,72 @@
+import time
+from typing import Any
+from typing import Optional
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from .config import LLMConfig
+
+
+class LoopBudget:
+  """limits of one agent loop: completions, wall time, tokens and tool calls, none means unlimited"""
+
+  def __init__(
+    self,
+    max_iterations: int = 3,
+    max_seconds: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    max_tool_calls: Optional[int] = None,
+  ):
+    self.max_iterations = max_iterations
+    self.max_seconds = max_seconds
+    self.max_tokens = max_tokens
+    self.max_tool_calls = max_tool_calls
+    self.started = time.monotonic()
+    self.deadline = self.started + max_seconds if max_seconds else None
+    self.iterations = 0
+    self.tokens = 0
+    self.tool_calls = 0
+
+  @classmethod
+  def from_config(cls, config: "LLMConfig") -> "LoopBudget":
+    return cls(config.max_iterations, config.max_loop_seconds, config.max_loop_tokens, config.max_tool_calls)
+
+  def remaining(self) -> Optional[float]:
+    return max(0.0, self.deadline - time.monotonic()) if self.deadline else None
+
+  def clip(self, timeout: float) -> float:
+    """a timeout that does not outlive the loop"""
+    remaining = self.remaining()
+    return timeout if remaining is None else min(timeout, remaining)
+
+  def record_completion(self, response: Any):
+    total = getattr(getattr(response, "usage", None), "total_tokens", None)
+    self.tokens += total if isinstance(total, int) else 0
+
+  def allows_tool_calls(self, count: int) -> bool:
+    return self.max_tool_calls is None or self.tool_calls + count <= self.max_tool_calls
+
+  def exhausted(self) -> Optional[str]:
+    """why the loop has to stop, none while there is budget left"""
+    if self.iterations >= self.max_iterations:
+      return "max tool call iterations reached"
+    if self.deadline and time.monotonic() >= self.deadline:
+      return f"time budget of {self.max_seconds:g}s spent"
+    if self.max_tokens is not None and self.tokens >= self.max_tokens:
+      return f"token budget of {self.max_tokens} spent"
+    return None
+
+  def describe_limits(self) -> str:
+    limits = [
+      f"{self.max_iterations} completions",
+      f"{self.max_seconds:g}s" if self.max_seconds else None,
+      f"{self.max_tokens} tokens" if self.max_tokens is not None else None,
+      f"{self.max_tool_calls} tool calls" if self.max_tool_calls is not None else None,
+    ]
+    return ", ".join(limit for limit in limits if limit)
+
+  def describe(self) -> str:
+    return (
+      f"{self.iterations} completions, {self.tool_calls} tool calls, {self.tokens} tokens "
+      f"in {time.monotonic() - self.started:.1f}s"
+    )
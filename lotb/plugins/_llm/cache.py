@@ -0,0 +1,75 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+CacheKey = Tuple[str, str, str]
+
+
+def cache_key(server_name: str, name: str, args: Optional[Dict[str, Any]] = None) -> CacheKey:
+  """server, tool (or resource uri) and the arguments serialized canonically so key order does not matter"""
+  return server_name, name, json.dumps(args or {}, sort_keys=True, separators=(",", ":"), default=str)
+
+
+class ResultCache:
+  """lru cache with a ttl, bounded both by entry count and by the total size of the cached strings"""
+
+  def __init__(self, ttl: float = 300.0, max_entries: int = 256, max_bytes: int = 1024 * 1024):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.entries: "OrderedDict[CacheKey, Tuple[float, str]]" = OrderedDict()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @property
+  def enabled(self) -> bool:
+    return self.ttl > 0 and self.max_entries > 0
+
+  def get(self, key: CacheKey) -> Optional[str]:
+    entry = self.entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+
+    expires_at, value = entry
+    if expires_at <= time.monotonic():
+      self._remove(key)
+      self.misses += 1
+      return None
+
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return value
+
+  def set(self, key: CacheKey, value: str, ttl: Optional[float] = None):
+    size = len(value.encode())
+    if not self.enabled or size > self.max_bytes:
+      return
+
+    if key in self.entries:
+      self._remove(key)
+    self.entries[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+    self.size += size
+
+    while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+      self._remove(next(iter(self.entries)))
+      self.evictions += 1
+
+  def _remove(self, key: CacheKey):
+    _, value = self.entries.pop(key)
+    self.size -= len(value.encode())
+
+  def clear(self):
+    self.entries.clear()
+    self.size = 0
+
+  def describe(self) -> str:
+    total = self.hits + self.misses
+    hit_rate = f"{self.hits / total:.0%}" if total else "n/a"
+    return f"{self.hits} hits, {self.misses} misses ({hit_rate}), {len(self.entries)} entries, {self.size} bytes"
@@ -0,0 +1,105 @@
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+from telegram.ext import ContextTypes
+from telegram.ext import JobQueue
+
+from .context import message_tokens
+from .context import truncate_to_tokens
+from .history import ConversationHistory
+from .prompts import CONVERSATION_SUMMARY_PROMPT
+from .router import ModelRouter
+from .usage import usage_scope
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+  from .config import LLMConfig
+
+
+class HistoryCompactor:
+  """folds the oldest turns of long conversations into one memory per (user, chat), in a background job so the
+  summary completion never delays an answer"""
+
+  def __init__(self, plugin: "PluginBase", config: "LLMConfig", history: ConversationHistory, router: ModelRouter):
+    self.plugin = plugin
+    self.config = config
+    self.history = history
+    self.router = router
+    self.pending: Set[Tuple[int, int]] = set()
+    self.compactions = 0
+    self.failures = 0
+
+  def set_job_queue(self, job_queue: JobQueue):
+    interval = self.config.compaction_interval
+    job_queue.run_repeating(self._compact_job, interval=interval, first=interval)
+
+  def schedule(self, user_id: int, chat_id: int):
+    """mark a conversation that just grew, its size is only measured by the job"""
+    self.pending.add((user_id, chat_id))
+
+  async def _compact_job(self, context: ContextTypes.DEFAULT_TYPE):
+    await self.compact_pending()
+
+  async def compact_pending(self):
+    pending, self.pending = self.pending, set()
+    for user_id, chat_id in pending:
+      with usage_scope(user_id, chat_id):
+        await self.compact(user_id, chat_id)
+
+  def split(self, turns: List[Dict[str, Any]]) -> int:
+    """how many of the oldest turns to fold, zero while the conversation is within compaction_tokens"""
+    model = self.config.model
+    costs = [message_tokens(model, turn) for turn in turns]
+    if sum(costs) <= self.config.compaction_tokens:
+      return 0
+
+    kept, index = 0, len(turns)
+    while index > 0 and kept + costs[index - 1] <= self.config.compaction_keep_tokens:
+      index -= 1
+      kept += costs[index]
+    # fold whole exchanges, the kept turns start with a question
+    while index > 0 and turns[index - 1]["role"] != "assistant":
+      index -= 1
+    return index
+
+  async def compact(self, user_id: int, chat_id: int) -> bool:
+    turns = self.history.get_conversation_history(user_id, chat_id)
+    count = self.split(turns)
+    if not count:
+      return False
+
+    older = turns[:count]
+    transcript = "\n".join(f"{turn['role']}: {turn.get('content') or ''}" for turn in older)
+    if previous := self.history.get_memory(user_id, chat_id):
+      transcript = f"summary so far: {previous}\n{transcript}"
+    try:
+      response = await self.router.completion(
+        messages=[
+          {"role": "system", "content": CONVERSATION_SUMMARY_PROMPT},
+          {"role": "user", "content": truncate_to_tokens(self.config.model, transcript, self.config.context_budget)},
+        ],
+        prefer_cheap=True,
+        compaction=True,
+        max_tokens=self.config.compaction_summary_tokens,
+      )
+      choice = response.choices[0]
+      memory = (choice.message.content if hasattr(choice, "message") else "") or ""
+    except Exception as e:
+      self.failures += 1
+      self.plugin.log_warning(f"failed to compact {count} turns of chat {chat_id}, keeping them: {e}")
+      return False
+
+    memory = truncate_to_tokens(self.config.model, memory.strip(), self.config.compaction_summary_tokens)
+    if not memory or not self.history.compact(user_id, chat_id, older, memory):
+      # an empty summary or a conversation cleared meanwhile, the next save schedules it again
+      return False
+    self.compactions += 1
+    self.plugin.log_info(f"compacted {count} turns of chat {chat_id} into a {len(memory)} chars memory")
+    return True
+
+  def describe(self) -> str:
+    return f"{self.compactions} compactions, {self.failures} failures, {len(self.pending)} pending"
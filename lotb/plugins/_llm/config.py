@@ -8,11 +8,87 @@ class LLMConfig:
     plugin_cfg = config_dict.get("plugins.llm", {}) if config_dict else {}
     self.apikey = plugin_cfg.get("apikey")
     self.model = plugin_cfg.get("model")
+    # openai compatible endpoint, for self hosted models and the local stand-in used by the benchmarks
+    self.api_base = plugin_cfg.get("api_base")
     self.max_history = plugin_cfg.get("maxhistory", 3)
+    temperature = plugin_cfg.get("temperature")
+    self.temperature = float(temperature) if temperature is not None else None
+    timeout = plugin_cfg.get("timeout")
+    self.timeout = float(timeout) if timeout is not None else None
+    self.retries = int(plugin_cfg.get("retries", 0))
+    self.retry_backoff = float(plugin_cfg.get("retry_backoff", 1.0))
+    # entries are model names or tables with model, apikey, api_base, timeout and retries
+    self.fallback_models = [self._model_entry(entry) for entry in plugin_cfg.get("fallback_models", [])]
+    cheap_model = plugin_cfg.get("cheap_model")
+    self.cheap_model = self._model_entry(cheap_model) if cheap_model else None
+    self.cheap_max_chars = int(plugin_cfg.get("cheap_max_chars", 200))
+    self.hedge = str(plugin_cfg.get("hedge", False)).lower() in ("true", "1", "yes")
+    self.hedge_min_samples = int(plugin_cfg.get("hedge_min_samples", 20))
+    self.history_cache_size = int(plugin_cfg.get("history_cache_size", 256))
+    self.history_flush_interval = float(plugin_cfg.get("history_flush_interval", 10))
+    self.context_budget = int(plugin_cfg.get("context_budget", 8000))
+    self.context_summarize = str(plugin_cfg.get("context_summarize", True)).lower() not in ("false", "0", "no")
+    self.context_summary_tokens = int(plugin_cfg.get("context_summary_tokens", 300))
+    # background compaction folds old turns into a stored memory once a conversation outgrows compaction_tokens
+    self.compaction = str(plugin_cfg.get("compaction", False)).lower() in ("true", "1", "yes")
+    compaction_model = plugin_cfg.get("compaction_model")
+    self.compaction_model = self._model_entry(compaction_model) if compaction_model else None
+    self.compaction_tokens = int(plugin_cfg.get("compaction_tokens", 2000))
+    self.compaction_keep_tokens = int(plugin_cfg.get("compaction_keep_tokens", 800))
+    self.compaction_summary_tokens = int(plugin_cfg.get("compaction_summary_tokens", 400))
+    self.compaction_interval = float(plugin_cfg.get("compaction_interval", 60))
+    self.compaction_max_messages = int(plugin_cfg.get("compaction_max_messages", 200))
+    # with compaction the stored turns are bounded by tokens, the message count is only a safeguard
+    self.history_limit = self.compaction_max_messages if self.compaction else self.max_history
+    self.max_concurrent_requests = int(plugin_cfg.get("max_concurrent_requests", 4))
+    self.user_concurrency = int(plugin_cfg.get("user_concurrency", 1))
+    self.chat_concurrency = int(plugin_cfg.get("chat_concurrency", 2))
+    self.queue_size = int(plugin_cfg.get("queue_size", 16))
+    self.supersede = str(plugin_cfg.get("supersede", False)).lower() in ("true", "1", "yes")
+    self.memory = str(plugin_cfg.get("memory", False)).lower() in ("true", "1", "yes")
+    self.memory_embedding_model = plugin_cfg.get("memory_embedding_model")
+    self.memory_dimensions = int(plugin_cfg.get("memory_dimensions", 256))
+    self.memory_top_k = int(plugin_cfg.get("memory_top_k", 3))
+    self.memory_min_score = float(plugin_cfg.get("memory_min_score", 0.2))
+    self.memory_tokens = int(plugin_cfg.get("memory_tokens", 500))
+    self.memory_max_chats = int(plugin_cfg.get("memory_max_chats", 64))
+    self.vision = str(plugin_cfg.get("vision", True)).lower() not in ("false", "0", "no")
+    vision_model = plugin_cfg.get("vision_model")
+    self.vision_model = self._model_entry(vision_model) if vision_model else None
+    self.vision_max_side = int(plugin_cfg.get("vision_max_side", 1024))
+    self.vision_quality = int(plugin_cfg.get("vision_quality", 85))
+    self.media_cache_bytes = int(plugin_cfg.get("media_cache_bytes", 32 * 1024 * 1024))
     self.assistant_mode = plugin_cfg.get("assistant", False)
     self.friendly_name = plugin_cfg.get("friendlyname")
     self.system_prompt = plugin_cfg.get("system_prompt")
     self.mcp_servers = plugin_cfg.get("mcpservers", [])
+    self.response_cache = str(plugin_cfg.get("response_cache", False)).lower() in ("true", "1", "yes")
+    self.response_cache_ttl = float(plugin_cfg.get("response_cache_ttl", 3600))
+    self.response_cache_max_entries = int(plugin_cfg.get("response_cache_max_entries", 1000))
+    self.streaming = str(plugin_cfg.get("streaming", False)).lower() in ("true", "1", "yes")
+    self.stream_edit_interval = float(plugin_cfg.get("stream_edit_interval", 1.5))
+    self.discovery_timeout = float(plugin_cfg.get("discovery_timeout", 30))
+    self.discovery_wait = float(plugin_cfg.get("discovery_wait", 5))
+    self.catalog_refresh_interval = float(plugin_cfg.get("catalog_refresh_interval", 10))
+    self.tool_concurrency = int(plugin_cfg.get("tool_concurrency", 4))
+    self.tool_timeout = float(plugin_cfg.get("tool_timeout", 30))
+    self.tool_retries = int(plugin_cfg.get("tool_retries", 1))
+    self.max_iterations = int(plugin_cfg.get("max_iterations", 3))
+    max_loop_seconds = plugin_cfg.get("max_loop_seconds")
+    self.max_loop_seconds = float(max_loop_seconds) if max_loop_seconds is not None else None
+    max_loop_tokens = plugin_cfg.get("max_loop_tokens")
+    self.max_loop_tokens = int(max_loop_tokens) if max_loop_tokens is not None else None
+    max_tool_calls = plugin_cfg.get("max_tool_calls")
+    self.max_tool_calls = int(max_tool_calls) if max_tool_calls is not None else None
+    self.prompt_caching = str(plugin_cfg.get("prompt_caching", True)).lower() not in ("false", "0", "no")
+    self.tool_top_k = int(plugin_cfg.get("tool_top_k", 8))
+    self.cache_ttl = float(plugin_cfg.get("cache_ttl", 300))
+    self.cache_max_entries = int(plugin_cfg.get("cache_max_entries", 256))
+    self.cache_max_bytes = int(plugin_cfg.get("cache_max_bytes", 1024 * 1024))
+
+  @staticmethod
+  def _model_entry(entry: Any) -> Dict[str, Any]:
+    return entry if isinstance(entry, dict) else {"model": entry}
 
   def validate(self) -> List[str]:
     warnings = []
@@ -22,6 +98,10 @@ class LLMConfig:
     if not self.model:
       warnings.append("missing model in configuration")
 
+    for entry in self.fallback_models:
+      if not entry.get("model"):
+        warnings.append("fallback model missing model field")
+
     if self.assistant_mode:
       if not self.mcp_servers:
         warnings.append("no mcp servers configured")
@@ -0,0 +1,187 @@
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+
+import litellm
+
+from .prompts import CONVERSATION_SUMMARY_PROMPT
+from .router import ModelRouter
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+  from .config import LLMConfig
+
+# chat formats add a few tokens of framing around every message
+MESSAGE_OVERHEAD = 4
+MIN_QUERY_TOKENS = 256
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(model: Optional[str], text: str) -> int:
+  """tokens of a message content with the tokenizer of the model, cached since history is recounted every turn"""
+  try:
+    return litellm.token_counter(model=model or "", text=text)
+  except Exception:
+    return len(text) // 4 + 1
+
+
+def message_tokens(model: Optional[str], message: Dict[str, Any]) -> int:
+  return count_tokens(model, str(message.get("content") or "")) + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(model: Optional[str], text: str, budget: int) -> str:
+  if budget <= 0:
+    return ""
+  tokens = count_tokens(model, text)
+  while tokens > budget and text:
+    text = text[: max(0, int(len(text) * budget / tokens) - 1)]
+    tokens = count_tokens(model, text)
+  return text
+
+
+class ContextBuilder:
+  """fill the token budget by priority: system prompt, the new message, the quoted message, then recent history"""
+
+  def __init__(
+    self, plugin: "PluginBase", config: "LLMConfig", router: Optional[ModelRouter] = None, max_summaries: int = 128
+  ):
+    self.plugin = plugin
+    self.config = config
+    self.router = router or ModelRouter(plugin, config)
+    self.max_summaries = max_summaries
+    self.summaries: "OrderedDict[str, str]" = OrderedDict()
+
+  async def assemble(
+    self,
+    system_prompt: str,
+    history: List[Dict[str, Any]],
+    query: str,
+    quoted: str = "",
+    reserved: int = 0,
+    recalled: Optional[List[str]] = None,
+    images: Optional[List[str]] = None,
+    compacted: str = "",
+  ) -> List[Dict[str, Any]]:
+    model = self.config.model
+    budget = self.config.context_budget - reserved
+    system = {"role": "system", "content": system_prompt}
+    budget -= message_tokens(model, system)
+
+    # the new message is never cut below MIN_QUERY_TOKENS, even with an oversized system prompt
+    user_content = truncate_to_tokens(model, query, max(budget - MESSAGE_OVERHEAD, MIN_QUERY_TOKENS))
+    budget -= count_tokens(model, user_content) + MESSAGE_OVERHEAD
+    if quoted:
+      quoted_text = truncate_to_tokens(model, quoted, budget - self._summary_reserve(history))
+      if quoted_text:
+        user_content = f"{user_content}\n\nQuoted message:\n{quoted_text}"
+        budget -= count_tokens(model, quoted_text)
+
+    earlier = None
+    if compacted:
+      # the stored memory of the compacted turns, the history that follows continues where it ends
+      earlier_text = truncate_to_tokens(model, compacted, budget - self._summary_reserve(history))
+      if earlier_text:
+        earlier = {"role": "system", "content": f"Memory of the earlier conversation: {earlier_text}"}
+        budget -= message_tokens(model, earlier)
+
+    memory = None
+    if recalled:
+      # older turns recalled from the long term memory come right after the new message
+      memory_text = truncate_to_tokens(
+        model, "\n".join(recalled), min(self.config.memory_tokens, budget - self._summary_reserve(history))
+      )
+      if memory_text:
+        memory = {"role": "system", "content": f"Relevant earlier messages of this chat:\n{memory_text}"}
+        budget -= message_tokens(model, memory)
+
+    kept: List[Dict[str, Any]] = []
+    summary_reserve = self._summary_reserve(history)
+    for index in range(len(history) - 1, -1, -1):
+      cost = message_tokens(model, history[index])
+      # the reserve is only needed when something older has to be summarized
+      if cost > budget - (summary_reserve if index > 0 else 0):
+        break
+      kept.insert(0, history[index])
+      budget -= cost
+
+    messages = [system]
+    if earlier:
+      messages.append(earlier)
+    older = history[: len(history) - len(kept)]
+    if older and (summary := await self.summarize(older)):
+      messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+    if memory:
+      messages.append(memory)
+
+    messages.extend(kept)
+    if images:
+      # the images are not counted here, the caller reserves their tokens
+      content: Any = [{"type": "text", "text": user_content}]
+      content.extend({"type": "image_url", "image_url": {"url": url}} for url in images)
+      messages.append({"role": "user", "content": content})
+    else:
+      messages.append({"role": "user", "content": user_content})
+    self.plugin.log_info(
+      f"context: {self.config.context_budget - reserved - budget}/{self.config.context_budget - reserved} tokens, "
+      f"{len(kept)} turns kept, {len(older)} summarized"
+    )
+    return messages
+
+  def _summary_reserve(self, history: List[Dict[str, Any]]) -> int:
+    return self.config.context_summary_tokens + MESSAGE_OVERHEAD if self.config.context_summarize and history else 0
+
+  @staticmethod
+  def _prefix_keys(turns: List[Dict[str, Any]]) -> List[str]:
+    """rolling hash of every prefix of the turns, keys[i] identifies turns[: i + 1]"""
+    keys = []
+    digest = hashlib.sha256()
+    for turn in turns:
+      digest.update(f"{turn['role']}\0{turn.get('content') or ''}\0".encode())
+      keys.append(digest.copy().hexdigest())
+    return keys
+
+  async def summarize(self, turns: List[Dict[str, Any]]) -> Optional[str]:
+    if not self.config.context_summarize:
+      return None
+
+    keys = self._prefix_keys(turns)
+    if keys[-1] in self.summaries:
+      self.summaries.move_to_end(keys[-1])
+      return self.summaries[keys[-1]]
+
+    # the window slides one turn at a time, extend the longest summary already computed instead of starting over
+    previous, start = "", 0
+    for index in range(len(keys) - 2, -1, -1):
+      if keys[index] in self.summaries:
+        previous, start = self.summaries[keys[index]], index + 1
+        break
+
+    transcript = "\n".join(f"{turn['role']}: {turn.get('content') or ''}" for turn in turns[start:])
+    if previous:
+      transcript = f"summary so far: {previous}\n{transcript}"
+    try:
+      # summarizing is an easy task, the cheap model handles it when one is configured
+      response = await self.router.completion(
+        messages=[
+          {"role": "system", "content": CONVERSATION_SUMMARY_PROMPT},
+          {"role": "user", "content": truncate_to_tokens(self.config.model, transcript, self.config.context_budget)},
+        ],
+        prefer_cheap=True,
+        max_tokens=self.config.context_summary_tokens,
+      )
+      choice = response.choices[0]
+      summary = (choice.message.content if hasattr(choice, "message") else "") or ""
+    except Exception as e:
+      self.plugin.log_warning(f"failed to summarize {len(turns)} older turns, dropping them: {e}")
+      return None
+
+    summary = truncate_to_tokens(self.config.model, summary, self.config.context_summary_tokens)
+    self.summaries[keys[-1]] = summary
+    while len(self.summaries) > self.max_summaries:
+      self.summaries.popitem(last=False)
+    return summary
@@ -1,16 +1,45 @@
+import sqlite3
+from collections import deque
+from collections import OrderedDict
 from typing import Any
+from typing import Deque
 from typing import Dict
 from typing import List
+from typing import Set
+from typing import Tuple
 from typing import TYPE_CHECKING
 
+from telegram.ext import ContextTypes
+from telegram.ext import JobQueue
+
 if TYPE_CHECKING:
   from lotb.common.plugin_class import PluginBase
 
 
 class ConversationHistory:
-  def __init__(self, plugin: "PluginBase", max_history: int):
+  """recent turns per (user, chat) kept in memory, sqlite is written behind in batches"""
+
+  def __init__(
+    self,
+    plugin: "PluginBase",
+    max_history: int,
+    max_conversations: int = 256,
+    flush_batch: int = 32,
+    flush_interval: float = 10.0,
+    max_chars: int = 16000,
+  ):
     self.plugin = plugin
     self.max_history = max_history
+    self.max_conversations = max_conversations
+    self.flush_batch = flush_batch
+    self.flush_interval = flush_interval
+    # only a storage safeguard, what reaches the model is decided by the token budget
+    self.max_chars = max_chars
+    self.conversations: "OrderedDict[Tuple[int, int], Deque[Dict[str, Any]]]" = OrderedDict()
+    # the compacted summary of the turns before the kept ones, loaded and evicted with the conversation
+    self.memories: Dict[Tuple[int, int], str] = {}
+    self._pending: List[Tuple[int, int, str, str]] = []
+    self._dirty: Set[Tuple[int, int]] = set()
 
   def create_table(self):
     self.plugin.create_table("""
@@ -29,45 +58,165 @@ class ConversationHistory:
             ON llm (user_id, chat_id)
         """)
 
+    self.plugin.execute_query("CREATE INDEX IF NOT EXISTS llm_history_timestamp_idx ON llm (timestamp)")
+
+    self.plugin.create_table("""
+            CREATE TABLE IF NOT EXISTS llm_compacted (
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, chat_id)
+            )
+        """)
+
+  def set_job_queue(self, job_queue: JobQueue):
+    if self.flush_interval > 0:
+      job_queue.run_repeating(self._flush_job, interval=self.flush_interval, first=self.flush_interval)
+
+  async def _flush_job(self, context: ContextTypes.DEFAULT_TYPE):
+    self.flush()
+
+  def _conversation(self, user_id: int, chat_id: int) -> Deque[Dict[str, Any]]:
+    key = (user_id, chat_id)
+    if key in self.conversations:
+      self.conversations.move_to_end(key)
+      return self.conversations[key]
+
+    conversation: Deque[Dict[str, Any]] = deque(self._load(user_id, chat_id), maxlen=self.max_history)
+    self.conversations[key] = conversation
+    self.memories[key] = self._load_memory(user_id, chat_id)
+    while len(self.conversations) > self.max_conversations:
+      # safe even with pending rows, they are flushed before a conversation is loaded again
+      evicted, _ = self.conversations.popitem(last=False)
+      self.memories.pop(evicted, None)
+    return conversation
+
+  def _load(self, user_id: int, chat_id: int) -> List[Dict[str, Any]]:
+    if not self.plugin.db_cursor or self.max_history <= 0:
+      return []
+
+    self.flush()
+    self.plugin.db_cursor.execute(
+      """
+      SELECT role, content FROM (
+          SELECT id, role, content FROM llm
+          WHERE user_id = ? AND chat_id = ?
+          ORDER BY id DESC
+          LIMIT ?
+      ) ORDER BY id ASC
+      """,
+      (user_id, chat_id, self.max_history),
+    )
+    return [{"role": row[0], "content": row[1]} for row in self.plugin.db_cursor.fetchall()]
+
+  def _load_memory(self, user_id: int, chat_id: int) -> str:
+    if not self.plugin.db_cursor:
+      return ""
+
+    self.plugin.db_cursor.execute(
+      "SELECT content FROM llm_compacted WHERE user_id = ? AND chat_id = ?",
+      (user_id, chat_id),
+    )
+    row = self.plugin.db_cursor.fetchone()
+    return row[0] if row else ""
+
   def save_message(self, user_id: int, chat_id: int, role: str, content: str) -> None:
+    truncated_content = content[: self.max_chars]
+    self._conversation(user_id, chat_id).append({"role": role, "content": truncated_content})
+
     if not self.plugin.db_cursor:
       return
+    self._pending.append((user_id, chat_id, role, truncated_content))
+    self._dirty.add((user_id, chat_id))
+    if len(self._pending) >= self.flush_batch:
+      self.flush()
 
-    count = self.plugin.db_cursor.execute(
-      "SELECT COUNT(*) FROM llm WHERE user_id = ? AND chat_id = ?", (user_id, chat_id)
-    ).fetchone()[0]
+  def flush(self) -> None:
+    """write the buffered messages in insertion order and trim every touched conversation, in one transaction"""
+    if not self._pending or not self.plugin.connection:
+      return
 
-    if count >= self.max_history:
-      self.plugin.execute_query(
+    pending, dirty = self._pending, self._dirty
+    self._pending, self._dirty = [], set()
+    try:
+      cursor = self.plugin.connection.cursor()
+      cursor.executemany("INSERT INTO llm (user_id, chat_id, role, content) VALUES (?, ?, ?, ?)", pending)
+      cursor.executemany(
         """
         DELETE FROM llm
-        WHERE id IN (
+        WHERE user_id = ? AND chat_id = ? AND id NOT IN (
             SELECT id FROM llm
             WHERE user_id = ? AND chat_id = ?
-            ORDER BY timestamp ASC
-            LIMIT 1
+            ORDER BY id DESC
+            LIMIT ?
         )
         """,
-        (user_id, chat_id),
+        [(user_id, chat_id, user_id, chat_id, self.max_history) for user_id, chat_id in dirty],
       )
-
-    truncated_content = content[:2000] if len(content) > 2000 else content
-    self.plugin.execute_query(
-      "INSERT INTO llm (user_id, chat_id, role, content) VALUES (?, ?, ?, ?)",
-      (user_id, chat_id, role, truncated_content),
-    )
+      self.plugin.connection.commit()
+    except sqlite3.Error as e:
+      self.plugin.log_error(f"failed to persist conversation history: {e}")
+      self.plugin.connection.rollback()
+      self._pending = pending + self._pending
+      self._dirty |= dirty
 
   def get_conversation_history(self, user_id: int, chat_id: int) -> List[Dict[str, Any]]:
-    if self.plugin.db_cursor:
-      self.plugin.db_cursor.execute(
-        "SELECT role, content FROM llm WHERE user_id = ? AND chat_id = ? ORDER BY timestamp ASC",
-        (user_id, chat_id),
-      )
-      return [{"role": row[0], "content": row[1]} for row in self.plugin.db_cursor.fetchall()]
-    return []
+    return list(self._conversation(user_id, chat_id))
+
+  def get_memory(self, user_id: int, chat_id: int) -> str:
+    key = (user_id, chat_id)
+    self._conversation(user_id, chat_id)
+    return self.memories.get(key, "")
+
+  def compact(self, user_id: int, chat_id: int, turns: List[Dict[str, Any]], memory: str) -> bool:
+    """replace the oldest turns with the memory summarizing them, false when the conversation moved on meanwhile"""
+    conversation = self._conversation(user_id, chat_id)
+    # the summary was computed in the background, the turns must still be the oldest ones to be replaced
+    if len(turns) > len(conversation) or any(conversation[i] is not turn for i, turn in enumerate(turns)):
+      return False
+
+    if self.plugin.connection:
+      self.flush()
+      if self._pending:
+        return False
+      try:
+        cursor = self.plugin.connection.cursor()
+        # after the flush the stored rows are the turns held in memory, the oldest ones go
+        cursor.execute(
+          """
+          DELETE FROM llm WHERE id IN (
+              SELECT id FROM llm
+              WHERE user_id = ? AND chat_id = ?
+              ORDER BY id ASC
+              LIMIT ?
+          )
+          """,
+          (user_id, chat_id, len(turns)),
+        )
+        cursor.execute(
+          "INSERT OR REPLACE INTO llm_compacted (user_id, chat_id, content) VALUES (?, ?, ?)",
+          (user_id, chat_id, memory),
+        )
+        self.plugin.connection.commit()
+      except sqlite3.Error as e:
+        self.plugin.log_error(f"failed to persist compacted conversation: {e}")
+        self.plugin.connection.rollback()
+        return False
+
+    for _ in turns:
+      conversation.popleft()
+    self.memories[(user_id, chat_id)] = memory
+    return True
 
   def clear_history(self, user_id: int, chat_id: int) -> None:
+    key = (user_id, chat_id)
+    self.conversations.pop(key, None)
+    self.memories.pop(key, None)
+    self._pending = [row for row in self._pending if row[:2] != key]
+    self._dirty.discard(key)
     if not self.plugin.db_cursor:
       return
 
     self.plugin.execute_query("DELETE FROM llm WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+    self.plugin.execute_query("DELETE FROM llm_compacted WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
@@ -1,55 +1,210 @@
+import asyncio
+import hashlib
+import json
+import time
 from contextlib import asynccontextmanager
 from functools import wraps
 from typing import Any
+from typing import Awaitable
 from typing import Callable
 from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import TYPE_CHECKING
 
+import anyio
+import httpx
 from litellm.experimental_mcp_client import load_mcp_tools
 from mcp import ClientSession
 from mcp.client.streamable_http import streamablehttp_client
+from mcp.shared.exceptions import McpError
 
 if TYPE_CHECKING:
   from lotb.common.plugin_class import PluginBase
 
 
-class MCPSessionManager:
-  def __init__(self, plugin: "PluginBase"):
+# only a broken transport closes the pooled session, any other failure belongs to the single call that raised it,
+# a stream dying silently is caught by the keepalive ping
+TRANSPORT_ERRORS = (
+  ConnectionError,
+  OSError,
+  httpx.TransportError,
+  anyio.ClosedResourceError,
+  anyio.BrokenResourceError,
+  anyio.EndOfStream,
+)
+
+
+class MCPConnection:
+  """long lived session to one mcp server, owned by a dedicated task so the transport scopes open and close together"""
+
+  def __init__(self, plugin: "PluginBase", server_cfg: Dict[str, Any], connect_timeout: float = 15.0):
     self.plugin = plugin
+    self.server_cfg = server_cfg
+    self.connect_timeout = connect_timeout
+    self.session: Optional[ClientSession] = None
+    self.last_used = 0.0
+    self.reconnects = 0
+    self._task: Optional[asyncio.Task] = None
+    self._ready = asyncio.Event()
+    self._closing = asyncio.Event()
+    self._error: Optional[BaseException] = None
+    self._lock = asyncio.Lock()
 
-  @asynccontextmanager
-  async def session_context(self, server_cfg: Dict[str, Any]):
+  @property
+  def name(self) -> str:
+    return self.server_cfg.get("name", "unknown")
+
+  @property
+  def alive(self) -> bool:
+    return self.session is not None and self._task is not None and not self._task.done()
+
+  async def acquire(self) -> ClientSession:
+    if not self.alive:
+      async with self._lock:
+        if not self.alive:
+          await self._connect()
+    self.last_used = time.monotonic()
+    assert self.session is not None
+    return self.session
+
+  async def _connect(self):
+    if self._task is not None:
+      self.reconnects += 1
+      await self.close()
+    self._ready = asyncio.Event()
+    self._closing = asyncio.Event()
+    self._error = None
+    self._task = asyncio.create_task(self._run(), name=f"mcp-session-{self.name}")
+    try:
+      await asyncio.wait_for(self._ready.wait(), timeout=self.connect_timeout)
+    except asyncio.TimeoutError:
+      await self.close()
+      raise ConnectionError(f"timeout connecting to mcp server {self.name}")
+    if self.session is None:
+      raise ConnectionError(f"cannot connect to mcp server {self.name}: {self._error}")
+    self.plugin.log_info(f"mcp session established with {self.name}")
+
+  async def _run(self):
     try:
-      async with self.get_mcp_session(server_cfg) as ctx:
-        read, write, _ = ctx
+      async with MCPSessionManager.get_mcp_session(self.server_cfg) as (read, write, _):
         async with ClientSession(read, write) as session:
           await session.initialize()
-          yield session
+          self.session = session
+          self._ready.set()
+          await self._closing.wait()
+    except Exception as e:
+      self._error = e
+      self.plugin.log_warning(f"mcp session with {self.name} closed: {e}")
+    finally:
+      self.session = None
+      self._ready.set()
+
+  async def ping(self, timeout: float) -> bool:
+    if not self.alive or self.session is None:
+      return False
+    try:
+      await asyncio.wait_for(self.session.send_ping(), timeout=timeout)
+      return True
     except Exception as e:
+      self.plugin.log_warning(f"mcp keepalive failed for {self.name}: {e}")
+      await self.close()
+      return False
+
+  async def close(self):
+    task, self._task = self._task, None
+    self.session = None
+    if task is None or task.done():
+      return
+    self._closing.set()
+    try:
+      await asyncio.wait_for(task, timeout=5)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+      task.cancel()
+    except Exception:
+      pass
+
+
+class MCPSessionManager:
+  """pool of persistent sessions, one per configured server, concurrent calls are multiplexed on the same session"""
+
+  def __init__(self, plugin: "PluginBase", keepalive_interval: float = 60.0, ping_timeout: float = 10.0):
+    self.plugin = plugin
+    self.keepalive_interval = keepalive_interval
+    self.ping_timeout = ping_timeout
+    self.connections: Dict[str, MCPConnection] = {}
+    self._keepalive_task: Optional[asyncio.Task] = None
+
+  def connection_for(self, server_cfg: Dict[str, Any]) -> MCPConnection:
+    key = server_cfg["url"]
+    if key not in self.connections:
+      self.connections[key] = MCPConnection(self.plugin, server_cfg)
+    return self.connections[key]
+
+  @asynccontextmanager
+  async def session_context(self, server_cfg: Dict[str, Any]):
+    connection = self.connection_for(server_cfg)
+    try:
+      session = await connection.acquire()
+      self._ensure_keepalive()
+      yield session
+    except (McpError, asyncio.TimeoutError):
+      # an error answer or a slow call, the session is shared with other calls and still healthy
+      raise
+    except TRANSPORT_ERRORS as e:
       self.plugin.log_warning(f"MCP session failed for {server_cfg.get('name', 'unknown')}: {e}")
+      await connection.close()
       raise
 
-  def get_mcp_session(self, server_cfg: Dict[str, Any]):
+  def _ensure_keepalive(self):
+    if self.keepalive_interval > 0 and (self._keepalive_task is None or self._keepalive_task.done()):
+      self._keepalive_task = asyncio.create_task(self._keepalive(), name="mcp-keepalive")
+
+  async def _keepalive(self):
+    while any(connection.alive for connection in self.connections.values()):
+      await asyncio.sleep(self.keepalive_interval)
+      idle = [
+        c for c in self.connections.values() if c.alive and time.monotonic() - c.last_used >= self.keepalive_interval
+      ]
+      await asyncio.gather(*(connection.ping(self.ping_timeout) for connection in idle))
+
+  async def close(self):
+    if self._keepalive_task:
+      self._keepalive_task.cancel()
+      self._keepalive_task = None
+    await asyncio.gather(*(connection.close() for connection in self.connections.values()))
+
+  @staticmethod
+  def get_mcp_session(server_cfg: Dict[str, Any]):
     return streamablehttp_client(
       url=server_cfg["url"] + "/mcp", headers={"Authorization": f"Bearer {server_cfg['auth_value']}"}
     )
 
   @staticmethod
-  def with_session(operation_name: str, default_return=None):
+  def with_session(operation_name: str, default_return=None, retries: int = 1):
+    """run the operation on the pooled session, read-only operations are retried once on a fresh session"""
+
     def decorator(func):
       @wraps(func)
       async def wrapper(plugin_self, server_cfg: Dict[str, Any], *args, **kwargs):
-        session_manager = MCPSessionManager(plugin_self.plugin)
-        try:
-          async with session_manager.session_context(server_cfg) as session:
-            plugin_self.plugin.log_info(f"executing {operation_name} on {server_cfg['name']}")
-            result = await func(plugin_self, session, server_cfg, *args, **kwargs)
-            plugin_self.plugin.log_info(f"{operation_name} completed on {server_cfg['name']}")
-            return result
-        except Exception as e:
-          plugin_self.plugin.log_warning(f"failed {operation_name} on {server_cfg['name']}: {e}")
-          return default_return if default_return is not None else []
+        session_manager = plugin_self.session_manager
+        for attempt in range(retries + 1):
+          try:
+            async with session_manager.session_context(server_cfg) as session:
+              plugin_self.plugin.log_info(f"executing {operation_name} on {server_cfg['name']}")
+              result = await func(plugin_self, session, server_cfg, *args, **kwargs)
+              plugin_self.plugin.log_info(f"{operation_name} completed on {server_cfg['name']}")
+              return result
+          except McpError as e:
+            plugin_self.plugin.log_warning(f"failed {operation_name} on {server_cfg['name']}: {e}")
+            break
+          except Exception as e:
+            plugin_self.plugin.log_warning(
+              f"failed {operation_name} on {server_cfg['name']} (attempt {attempt + 1}/{retries + 1}): {e}"
+            )
+        return default_return
 
       return wrapper
 
@@ -57,15 +212,22 @@ class MCPSessionManager:
 
 
 class MCPManager:
-  def __init__(self, plugin: "PluginBase", servers: List[Dict[str, Any]]):
+  def __init__(self, plugin: "PluginBase", servers: List[Dict[str, Any]], discovery_timeout: float = 30.0):
     self.plugin = plugin
     self.servers = servers
+    self.discovery_timeout = discovery_timeout
     self.session_manager = MCPSessionManager(plugin)
     self.tool_to_server_map: Dict[str, Dict[str, Any]] = {}
     self.resource_to_server_map: Dict[str, Dict[str, Any]] = {}
+    self.server_tools: Dict[str, List[Dict[str, Any]]] = {}
+    self.server_resources: Dict[str, List[Dict[str, Any]]] = {}
+    self.server_signatures: Dict[str, str] = {}
+    # bumped whenever any server catalog changes, consumers can use it to invalidate derived data
+    self.catalog_version = 0
 
-  @MCPSessionManager.with_session("loading tools", [])
-  async def list_tools(self, session: ClientSession, server_cfg: Dict[str, Any]) -> List[Any]:
+  # listings return None when the server could not be reached, discovery keeps the last known catalog then
+  @MCPSessionManager.with_session("loading tools", None)
+  async def list_tools(self, session: ClientSession, server_cfg: Dict[str, Any]) -> Optional[List[Any]]:
     tools = await load_mcp_tools(session=session, format="openai")
     self.plugin.log_info(
       f"loaded {len(tools)} tools from {server_cfg['name']}: "
@@ -73,9 +235,14 @@ class MCPManager:
     )
     return tools
 
-  @MCPSessionManager.with_session("loading resources", [])
-  async def list_resources(self, session: ClientSession, server_cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
-    resources_response = await session.list_resources()
+  @MCPSessionManager.with_session("loading resources", None)
+  async def list_resources(self, session: ClientSession, server_cfg: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    try:
+      resources_response = await session.list_resources()
+    except McpError as e:
+      # resources are optional in the protocol, a server without them still contributes its tools
+      self.plugin.log_info(f"server {server_cfg['name']} does not list resources: {e}")
+      return []
     resources = []
 
     if hasattr(resources_response, "resources"):
@@ -95,16 +262,24 @@ class MCPManager:
     )
     return resources
 
+  async def _load_with_timeout(self, loader_func: Callable, server: Dict[str, Any], label: str) -> Optional[List[Any]]:
+    try:
+      return await asyncio.wait_for(loader_func(server), timeout=self.discovery_timeout)
+    except asyncio.TimeoutError:
+      self.plugin.log_warning(
+        f"timeout loading {label} from {server.get('name', 'unknown')} after {self.discovery_timeout}s"
+      )
+      return None
+
   async def load_all_items(self, item_type: str, loader_func: Callable, mapper_func: Callable) -> List[Dict[str, Any]]:
     self.plugin.log_info(f"loading all {item_type} from {len(self.servers)} servers")
     all_items = []
     server_map = getattr(self, f"{item_type[:-1]}_to_server_map")
 
-    for i, server in enumerate(self.servers):
-      self.plugin.log_info(f"processing server {i + 1}/{len(self.servers)}: {server.get('name', 'unknown')}")
-      items = await loader_func(server)
+    results = await asyncio.gather(*(self._load_with_timeout(loader_func, s, item_type) for s in self.servers))
+    for server, loaded in zip(self.servers, results):
+      items = loaded or []
       mapped_count = mapper_func(items, server, server_map)
-
       self.plugin.log_info(
         f"server '{server.get('name', 'unknown')}' contributed {len(items)} {item_type} ({mapped_count} mapped)"
       )
@@ -113,6 +288,77 @@ class MCPManager:
     self.plugin.log_info(f"total {item_type} loaded: {len(all_items)}, total mappings: {len(server_map)}")
     return all_items
 
+  @staticmethod
+  def catalog_signature(tools: List[Dict[str, Any]], resources: List[Dict[str, Any]]) -> str:
+    payload = json.dumps({"tools": tools, "resources": resources}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+  def _replace_server_entries(self, server: Dict[str, Any], server_map: Dict[str, Dict[str, Any]], keys: Set[str]):
+    name = server.get("name", "unknown")
+    for key in [key for key, owner in server_map.items() if owner.get("name") == name and key not in keys]:
+      del server_map[key]
+      self.plugin.log_info(f"'{key}' is no longer provided by server '{name}'")
+
+  async def discover_server(self, server: Dict[str, Any]) -> bool:
+    """list the catalog of one server and apply it to the maps, returns true when it changed"""
+    name = server.get("name", "unknown")
+    tools, resources = await asyncio.gather(
+      self._load_with_timeout(self.list_tools, server, "tools"),
+      self._load_with_timeout(self.list_resources, server, "resources"),
+    )
+    # an unreachable server keeps its last known catalog, it is retried on the next refresh
+    if tools is None or resources is None:
+      self.plugin.log_warning(f"server '{name}' unavailable, keeping its last known catalog")
+      return False
+
+    signature = self.catalog_signature(tools, resources)
+    if self.server_signatures.get(name) == signature:
+      self.plugin.log_debug(f"catalog of server '{name}' unchanged")
+      return False
+
+    self.server_tools[name] = tools
+    self.server_resources[name] = resources
+    self.server_signatures[name] = signature
+    self._replace_server_entries(
+      server, self.tool_to_server_map, {t["function"]["name"] for t in tools if t.get("type") == "function"}
+    )
+    self._replace_server_entries(server, self.resource_to_server_map, {r["uri"] for r in resources if r.get("uri")})
+    self._map_tools(tools, server, self.tool_to_server_map)
+    self._map_resources(resources, server, self.resource_to_server_map)
+    self.catalog_version += 1
+    self.plugin.log_info(f"catalog of server '{name}' updated: {len(tools)} tools, {len(resources)} resources")
+    return True
+
+  async def discover(
+    self, on_server_changed: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+  ) -> List[str]:
+    """discover every server concurrently, on_server_changed runs as soon as a server reports a new catalog"""
+    started = time.monotonic()
+    changed: List[str] = []
+
+    async def discover_one(server: Dict[str, Any]):
+      if await self.discover_server(server):
+        changed.append(server.get("name", "unknown"))
+        if on_server_changed:
+          await on_server_changed(server)
+
+    await asyncio.gather(*(discover_one(server) for server in self.servers))
+    self.plugin.log_info(
+      f"discovery completed on {len(self.servers)} servers in {time.monotonic() - started:.2f}s, "
+      f"{len(changed)} changed: {len(self.tool_to_server_map)} tools, {len(self.resource_to_server_map)} resources"
+    )
+    return changed
+
+  def catalog(self) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """tools and resources discovered so far, in server configuration order"""
+    tools: List[Dict[str, Any]] = []
+    resources: List[Dict[str, Any]] = []
+    for server in self.servers:
+      name = server.get("name", "unknown")
+      tools.extend(self.server_tools.get(name, []))
+      resources.extend(self.server_resources.get(name, []))
+    return tools, resources
+
   def _map_tools(self, tools: List[Dict[str, Any]], server: Dict[str, Any], server_map: Dict[str, Any]) -> int:
     count = 0
     for tool in tools:
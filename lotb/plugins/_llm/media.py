@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import io
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import TYPE_CHECKING
+
+from litellm.utils import supports_vision
+from PIL import Image
+from PIL import UnidentifiedImageError
+from telegram import Message
+from telegram.error import TelegramError
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+
+# rough prompt cost of one image reserved in the context budget, providers bill a resized image in this range
+IMAGE_TOKENS = 800
+
+
+@lru_cache(maxsize=64)
+def model_supports_vision(model: Optional[str]) -> bool:
+  try:
+    return bool(model) and supports_vision(model or "")
+  except Exception:
+    return False
+
+
+def shrink_image(data: bytes, max_side: int, quality: int) -> bytes:
+  """jpeg no larger than max_side on its longest side, only the bytes sent to the model are kept"""
+  with Image.open(io.BytesIO(data)) as opened:
+    opened.thumbnail((max_side, max_side))
+    image = opened.convert("RGB") if opened.mode != "RGB" else opened
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def image_file(message: Optional[Message], max_side: int) -> Optional[Any]:
+  """the photo size or image document of a message, the smallest photo size still covering max_side is enough"""
+  if message is None:
+    return None
+  sizes = sorted(message.photo or (), key=lambda size: size.width * size.height)
+  if sizes:
+    return next((size for size in sizes if max(size.width, size.height) >= max_side), sizes[-1])
+  document = message.document
+  if document and (document.mime_type or "").startswith("image/"):
+    return document
+  return None
+
+
+class MediaCache:
+  """telegram images downloaded, resized and recompressed once, kept by file_unique_id within max_bytes"""
+
+  def __init__(self, plugin: "PluginBase", max_bytes: int = 32 * 1024 * 1024, max_side: int = 1024, quality: int = 85):
+    self.plugin = plugin
+    self.max_bytes = max_bytes
+    self.max_side = max_side
+    self.quality = quality
+    self.images: "OrderedDict[str, bytes]" = OrderedDict()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self._downloads: Dict[str, asyncio.Task] = {}
+
+  def _store(self, key: str, data: bytes):
+    if len(data) > self.max_bytes:
+      return
+    self.images[key] = data
+    self.size += len(data)
+    while self.size > self.max_bytes:
+      _, evicted = self.images.popitem(last=False)
+      self.size -= len(evicted)
+
+  async def _download(self, bot: Any, file: Any) -> bytes:
+    telegram_file = await bot.get_file(file.file_id)
+    data = bytes(await telegram_file.download_as_bytearray())
+    # decoding and encoding are cpu bound, keep them off the event loop
+    return await asyncio.to_thread(shrink_image, data, self.max_side, self.quality)
+
+  async def get(self, bot: Any, file: Any) -> Optional[bytes]:
+    key = file.file_unique_id
+    if key in self.images:
+      self.hits += 1
+      self.images.move_to_end(key)
+      return self.images[key]
+
+    self.misses += 1
+    # concurrent questions about the same image share one download
+    task = self._downloads.get(key)
+    if task is None:
+      task = self._downloads[key] = asyncio.create_task(self._download(bot, file))
+      task.add_done_callback(lambda _: self._downloads.pop(key, None))
+    try:
+      data = await asyncio.shield(task)
+    except (TelegramError, UnidentifiedImageError, OSError) as e:
+      self.plugin.log_warning(f"failed to fetch image {key}: {e}")
+      return None
+    if key not in self.images:
+      self._store(key, data)
+    return data
+
+  async def data_url(self, bot: Any, message: Optional[Message]) -> Optional[str]:
+    file = image_file(message, self.max_side)
+    if file is None:
+      return None
+    data = await self.get(bot, file)
+    return f"data:image/jpeg;base64,{base64.b64encode(data).decode()}" if data else None
+
+  def describe(self) -> str:
+    return (
+      f"{len(self.images)} images, {self.size / 1024 / 1024:.1f}/{self.max_bytes / 1024 / 1024:.0f} MiB, "
+      f"{self.hits} hits, {self.misses} misses"
+    )
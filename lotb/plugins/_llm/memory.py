@@ -0,0 +1,220 @@
+import hashlib
+from collections import OrderedDict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+import litellm
+import numpy as np
+
+from .tool_ranker import tokenize
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+  from .config import LLMConfig
+
+
+class EmbeddingProvider:
+  """turns texts into unit length float32 vectors, one row per text"""
+
+  dimensions: int
+
+  async def embed(self, texts: List[str]) -> np.ndarray:
+    raise NotImplementedError
+
+
+class HashingEmbeddings(EmbeddingProvider):
+  """local lexical embeddings: words and word pairs hashed into a fixed number of signed buckets, no model needed"""
+
+  def __init__(self, dimensions: int = 256):
+    self.dimensions = dimensions
+
+  def _bucket(self, feature: str) -> Tuple[int, float]:
+    digest = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+    return digest % self.dimensions, 1.0 if digest >> 63 else -1.0
+
+  async def embed(self, texts: List[str]) -> np.ndarray:
+    vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+    for row, text in enumerate(texts):
+      tokens = tokenize(text)
+      for feature in [*tokens, *(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))]:
+        bucket, sign = self._bucket(feature)
+        vectors[row, bucket] += sign
+    return normalize(vectors)
+
+
+class LiteLLMEmbeddings(EmbeddingProvider):
+  def __init__(self, model: str, api_key: Optional[str], dimensions: int):
+    self.model = model
+    self.api_key = api_key
+    self.dimensions = dimensions
+
+  async def embed(self, texts: List[str]) -> np.ndarray:
+    response = await litellm.aembedding(model=self.model, input=texts, api_key=self.api_key, dimensions=self.dimensions)
+    return normalize(np.array([item["embedding"] for item in response.data], dtype=np.float32))
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  return vectors / np.maximum(norms, 1e-12)
+
+
+# unit vectors are kept as int8, a quarter of the float32 size, cosine ranking barely moves at this precision
+QUANTIZATION_SCALE = 127
+# rows scored per block, bounds the float32 copy made while searching a large chat
+SEARCH_BLOCK = 8192
+
+
+def quantize(vectors: np.ndarray) -> np.ndarray:
+  return np.clip(np.rint(vectors * QUANTIZATION_SCALE), -QUANTIZATION_SCALE, QUANTIZATION_SCALE).astype(np.int8)
+
+
+class ChatIndex:
+  """int8 embeddings of one chat in a preallocated matrix grown geometrically, so appending a turn is amortized o(1)"""
+
+  def __init__(self, dimensions: int, ids: Optional[np.ndarray] = None, vectors: Optional[np.ndarray] = None):
+    size = 0 if ids is None else len(ids)
+    capacity = max(64, size)
+    self.ids = np.zeros(capacity, dtype=np.int64)
+    self.vectors = np.zeros((capacity, dimensions), dtype=np.int8)
+    if ids is not None and vectors is not None:
+      self.ids[:size] = ids
+      self.vectors[:size] = quantize(vectors)
+    self.size = size
+
+  def add(self, ids: np.ndarray, vectors: np.ndarray):
+    needed = self.size + len(ids)
+    if needed > len(self.ids):
+      capacity = max(needed, len(self.ids) * 3 // 2)
+      self.ids = np.resize(self.ids, capacity)
+      grown = np.zeros((capacity, self.vectors.shape[1]), dtype=np.int8)
+      grown[: self.size] = self.vectors[: self.size]
+      self.vectors = grown
+    self.ids[self.size : needed] = ids
+    self.vectors[self.size : needed] = quantize(vectors)
+    self.size = needed
+
+  def search(self, query: np.ndarray, top_k: int, exclude_recent: int = 0) -> List[Tuple[int, float]]:
+    """ids and cosine scores of the best matches, the newest exclude_recent turns are already in the prompt"""
+    candidates = self.size - exclude_recent
+    if candidates <= 0 or top_k <= 0:
+      return []
+    query = query.astype(np.float32) / QUANTIZATION_SCALE
+    scores = np.empty(candidates, dtype=np.float32)
+    for start in range(0, candidates, SEARCH_BLOCK):
+      stop = min(start + SEARCH_BLOCK, candidates)
+      scores[start:stop] = self.vectors[start:stop].astype(np.float32) @ query
+    if candidates > top_k:
+      best = np.argpartition(scores, -top_k)[-top_k:]
+    else:
+      best = np.arange(candidates)
+    best = best[np.argsort(-scores[best])]
+    return [(int(self.ids[i]), float(scores[i])) for i in best]
+
+  @property
+  def nbytes(self) -> int:
+    return self.ids.nbytes + self.vectors.nbytes
+
+
+class RetrievalMemory:
+  """long term memory of every chat: past turns are embedded once, stored in sqlite and searched in memory"""
+
+  def __init__(self, plugin: "PluginBase", config: "LLMConfig", provider: Optional[EmbeddingProvider] = None):
+    self.plugin = plugin
+    self.config = config
+    if provider is None:
+      if config.memory_embedding_model:
+        provider = LiteLLMEmbeddings(config.memory_embedding_model, config.apikey, config.memory_dimensions)
+      else:
+        provider = HashingEmbeddings(config.memory_dimensions)
+    self.provider = provider
+    self.indexes: "OrderedDict[int, ChatIndex]" = OrderedDict()
+
+  def create_table(self):
+    self.plugin.create_table("""
+            CREATE TABLE IF NOT EXISTS llm_memory (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+    self.plugin.execute_query("CREATE INDEX IF NOT EXISTS llm_memory_chat_idx ON llm_memory (chat_id)")
+    self.plugin.execute_query("CREATE INDEX IF NOT EXISTS llm_memory_timestamp_idx ON llm_memory (timestamp)")
+
+  def _index(self, chat_id: int) -> ChatIndex:
+    if chat_id in self.indexes:
+      self.indexes.move_to_end(chat_id)
+      return self.indexes[chat_id]
+
+    ids, vectors = np.zeros(0, dtype=np.int64), np.zeros((0, self.provider.dimensions), dtype=np.float32)
+    if self.plugin.db_cursor:
+      self.plugin.db_cursor.execute("SELECT id, embedding FROM llm_memory WHERE chat_id = ? ORDER BY id", (chat_id,))
+      rows = self.plugin.db_cursor.fetchall()
+      # rows embedded with another dimension (provider changed) are skipped
+      rows = [row for row in rows if len(row[1]) == self.provider.dimensions * 4]
+      if rows:
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+    index = ChatIndex(self.provider.dimensions, ids, vectors)
+    self.indexes[chat_id] = index
+    while len(self.indexes) > self.config.memory_max_chats:
+      self.indexes.popitem(last=False)
+    return index
+
+  async def remember(self, user_id: int, chat_id: int, turns: List[Tuple[str, str]]):
+    """embed and store (role, content) turns, a failure only costs the memory of these turns"""
+    turns = [(role, content) for role, content in turns if content.strip()]
+    if not turns or not self.plugin.connection:
+      return
+    try:
+      vectors = await self.provider.embed([content for _, content in turns])
+      cursor = self.plugin.connection.cursor()
+      ids = []
+      for (role, content), vector in zip(turns, vectors):
+        cursor.execute(
+          "INSERT INTO llm_memory (user_id, chat_id, role, content, embedding) VALUES (?, ?, ?, ?, ?)",
+          (user_id, chat_id, role, content, vector.tobytes()),
+        )
+        ids.append(cursor.lastrowid)
+      self.plugin.connection.commit()
+    except Exception as e:
+      # best effort, rate limits, timeouts or a full disk must not cost the answer that was just given
+      self.plugin.log_warning(f"failed to store {len(turns)} turns in the llm memory: {e}")
+      self.plugin.connection.rollback()
+      return
+    if chat_id in self.indexes:
+      self.indexes[chat_id].add(np.array(ids, dtype=np.int64), vectors)
+
+  async def recall(self, chat_id: int, query: str, exclude_recent: int = 0) -> List[str]:
+    """the most relevant earlier turns of the chat, oldest first, none when the memory is unavailable"""
+    try:
+      index = self._index(chat_id)
+      if index.size <= exclude_recent or not self.plugin.db_cursor:
+        return []
+      vector = (await self.provider.embed([query]))[0]
+      matches = [
+        match
+        for match in index.search(vector, self.config.memory_top_k, exclude_recent)
+        if match[1] >= self.config.memory_min_score
+      ]
+      if not matches:
+        return []
+      ids = sorted(match_id for match_id, _ in matches)
+      self.plugin.db_cursor.execute(
+        f"SELECT role, content FROM llm_memory WHERE id IN ({', '.join('?' for _ in ids)}) ORDER BY id", ids
+      )
+      return [f"{role}: {content}" for role, content in self.plugin.db_cursor.fetchall()]
+    except Exception as e:
+      # the query is answered without the memory rather than not at all
+      self.plugin.log_warning(f"failed to recall from the llm memory: {e}")
+      return []
+
+  def describe(self) -> str:
+    turns = sum(index.size for index in self.indexes.values())
+    size = sum(index.nbytes for index in self.indexes.values())
+    return f"{len(self.indexes)} chats loaded, {turns} turns, {size / 1024 / 1024:.1f} MiB"
@@ -0,0 +1,70 @@
+import json
+from functools import lru_cache
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from litellm.utils import supports_prompt_caching
+
+EPHEMERAL = {"type": "ephemeral"}
+
+
+def canonical_tools(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  """tools sorted by name with their schema keys sorted, so the serialized prefix only changes with the catalog"""
+  canonical = [json.loads(json.dumps(tool, sort_keys=True)) for tool in tools]
+  return sorted(canonical, key=lambda tool: tool.get("function", {}).get("name", ""))
+
+
+def canonical_resources(resources: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  return sorted(resources, key=lambda resource: (str(resource.get("name", "")), str(resource.get("uri", ""))))
+
+
+@lru_cache(maxsize=64)
+def supports_cache_control(model: Optional[str]) -> bool:
+  try:
+    return bool(model) and supports_prompt_caching(model or "")
+  except Exception:
+    return False
+
+
+def with_cache_control(
+  messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[List[Dict[str, Any]]]]:
+  """copies marking the end of the tools and of the system prompt as cache breakpoints, litellm drops the markers
+  for providers that cache automatically"""
+  marked = list(messages)
+  if marked and marked[0].get("role") == "system" and isinstance(marked[0].get("content"), str):
+    marked[0] = {**marked[0], "content": [{"type": "text", "text": marked[0]["content"], "cache_control": EPHEMERAL}]}
+  if tools:
+    tools = [*tools[:-1], {**tools[-1], "cache_control": EPHEMERAL}]
+  return marked, tools
+
+
+def cached_tokens(response: Any) -> int:
+  usage = getattr(response, "usage", None)
+  details = getattr(usage, "prompt_tokens_details", None)
+  value = getattr(details, "cached_tokens", None)
+  return value if isinstance(value, int) else 0
+
+
+class PromptCacheStats:
+  def __init__(self):
+    self.prompt_tokens = 0
+    self.cached_tokens = 0
+
+  def record(self, response: Any) -> Tuple[int, int]:
+    prompt = getattr(getattr(response, "usage", None), "prompt_tokens", None)
+    prompt = prompt if isinstance(prompt, int) else 0
+    cached = cached_tokens(response)
+    self.prompt_tokens += prompt
+    self.cached_tokens += cached
+    return cached, prompt
+
+  @property
+  def hit_rate(self) -> float:
+    return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+  def describe(self) -> str:
+    return f"{self.cached_tokens}/{self.prompt_tokens} prompt tokens cached ({self.hit_rate:.0%})"
@@ -61,3 +61,15 @@ class SystemPromptBuilder:
 
   def build(self) -> str:
     return self.template.format(capabilities_summary=self._capabilities)
+
+
+CONVERSATION_SUMMARY_PROMPT = """
+Summarize the following chat excerpt in a few short sentences, in the language it is written in.
+Keep names, numbers, decisions and open questions, drop greetings and small talk.
+Answer with the summary only.
+"""
+
+PARTIAL_ANSWER_PROMPT = """
+The tool budget for this request is spent, no more tools can be called.
+Answer now with the information gathered so far, and say briefly what could not be checked.
+"""
@@ -0,0 +1,237 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any
+from typing import AsyncIterator
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+
+import litellm
+
+from .media import model_supports_vision
+from .usage import UsageTracker
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+  from .config import LLMConfig
+
+# provider side errors that may succeed on a second attempt, anything else goes straight to the next model
+RETRYABLE_ERRORS = (
+  asyncio.TimeoutError,
+  litellm.exceptions.Timeout,
+  litellm.exceptions.RateLimitError,
+  litellm.exceptions.APIConnectionError,
+  litellm.exceptions.ServiceUnavailableError,
+  litellm.exceptions.InternalServerError,
+)
+
+
+async def chunk_timeout(stream: Any, timeout: float) -> AsyncIterator[Any]:
+  """pass the chunks of a stream through, failing when the next one takes longer than timeout"""
+  iterator = stream.__aiter__()
+  try:
+    while True:
+      try:
+        chunk = await asyncio.wait_for(anext(iterator), timeout=timeout)
+      except StopAsyncIteration:
+        return
+      yield chunk
+  finally:
+    if hasattr(iterator, "aclose"):
+      await iterator.aclose()
+
+
+class LatencyStats:
+  def __init__(self, window: int = 100):
+    self.samples: Deque[float] = deque(maxlen=window)
+    self.failures = 0
+
+  def record(self, seconds: float):
+    self.samples.append(seconds)
+
+  def percentile(self, fraction: float) -> Optional[float]:
+    if not self.samples:
+      return None
+    ordered = sorted(self.samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+  def describe(self) -> str:
+    if not self.samples:
+      return f"no samples, {self.failures} failures"
+    return (
+      f"p50 {self.percentile(0.5):.2f}s, p95 {self.percentile(0.95):.2f}s, "
+      f"{len(self.samples)} samples, {self.failures} failures"
+    )
+
+
+class ModelRoute:
+  def __init__(
+    self,
+    model: Optional[str],
+    api_key: Optional[str],
+    timeout: Optional[float] = None,
+    retries: int = 0,
+    backoff: float = 1.0,
+    api_base: Optional[str] = None,
+  ):
+    self.model = model
+    self.api_key = api_key
+    self.api_base = api_base
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+
+  @classmethod
+  def from_config(cls, entry: Dict[str, Any], defaults: "ModelRoute") -> "ModelRoute":
+    timeout = entry.get("timeout", defaults.timeout)
+    return cls(
+      model=entry["model"],
+      api_key=entry.get("apikey", defaults.api_key),
+      timeout=float(timeout) if timeout is not None else None,
+      retries=int(entry.get("retries", defaults.retries)),
+      backoff=float(entry.get("retry_backoff", defaults.backoff)),
+      api_base=entry.get("api_base", defaults.api_base),
+    )
+
+
+class ModelRouter:
+  """timeouts, retries and an ordered fallback list around llm_completion, optionally hedging the primary model"""
+
+  def __init__(self, plugin: "PluginBase", config: "LLMConfig", usage: Optional[UsageTracker] = None):
+    self.plugin = plugin
+    self.config = config
+    self.usage = usage
+    self.primary = ModelRoute(
+      config.model,
+      config.apikey,
+      timeout=config.timeout,
+      retries=config.retries,
+      backoff=config.retry_backoff,
+      api_base=config.api_base,
+    )
+    self.fallbacks = [
+      ModelRoute.from_config(entry, self.primary) for entry in config.fallback_models if entry.get("model")
+    ]
+    self.cheap = ModelRoute.from_config(config.cheap_model, self.primary) if config.cheap_model else None
+    self.vision = ModelRoute.from_config(config.vision_model, self.primary) if config.vision_model else None
+    self.compaction = ModelRoute.from_config(config.compaction_model, self.primary) if config.compaction_model else None
+    self.stats: Dict[Optional[str], LatencyStats] = {}
+
+  def latency(self, model: Optional[str]) -> LatencyStats:
+    return self.stats.setdefault(model, LatencyStats())
+
+  def is_cheap_query(self, query: str) -> bool:
+    return self.cheap is not None and len(query) <= self.config.cheap_max_chars
+
+  def routes(self, prefer_cheap: bool = False, vision: bool = False, compaction: bool = False) -> List[ModelRoute]:
+    routes = [self.primary, *self.fallbacks]
+    if vision:
+      # only models that read images, the configured vision model first
+      return [route for route in [self.vision, *routes] if route and model_supports_vision(route.model)]
+    if prefer_cheap and self.cheap:
+      routes.insert(0, self.cheap)
+    if compaction and self.compaction:
+      routes.insert(0, self.compaction)
+    return routes
+
+  def supports_vision(self) -> bool:
+    return bool(self.routes(vision=True))
+
+  def hedge_delay(self, route: ModelRoute) -> Optional[float]:
+    stats = self.latency(route.model)
+    if not self.config.hedge or len(stats.samples) < self.config.hedge_min_samples:
+      return None
+    return stats.percentile(0.95)
+
+  async def _attempt(self, route: ModelRoute, messages: List[Dict[str, Any]], **kwargs):
+    started = time.monotonic()
+    if route.api_base:
+      kwargs["api_base"] = route.api_base
+    call = self.plugin.llm_completion(messages=messages, model=route.model, api_key=route.api_key, **kwargs)
+    try:
+      response: Any = await (asyncio.wait_for(call, timeout=route.timeout) if route.timeout else call)
+    except Exception:
+      self.latency(route.model).failures += 1
+      raise
+    self.latency(route.model).record(time.monotonic() - started)
+    if kwargs.get("stream") and route.timeout:
+      # the timeout above only covers opening the stream, a provider stalling mid answer is cut off as well
+      response = chunk_timeout(response, route.timeout)
+    if self.usage:
+      if kwargs.get("stream"):
+        return self.usage.meter_stream(response, route.model, messages, started)
+      self.usage.record(route.model, response, time.monotonic() - started)
+    return response
+
+  async def _call(self, route: ModelRoute, messages: List[Dict[str, Any]], **kwargs):
+    for attempt in range(route.retries + 1):
+      try:
+        return await self._attempt(route, messages, **kwargs)
+      except RETRYABLE_ERRORS as e:
+        if attempt == route.retries:
+          raise
+        delay = route.backoff * 2**attempt
+        self.plugin.log_warning(f"{route.model} failed ({type(e).__name__}), retry {attempt + 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+  async def _hedged(
+    self, primary: ModelRoute, backup: ModelRoute, delay: float, messages, launched: List[ModelRoute], **kwargs
+  ):
+    primary_task = asyncio.create_task(self._call(primary, messages, **kwargs))
+    done, _ = await asyncio.wait([primary_task], timeout=delay)
+    if done:
+      return primary_task.result()
+
+    self.plugin.log_info(f"{primary.model} slower than its p95 ({delay:.2f}s), hedging on {backup.model}")
+    launched.append(backup)
+    pending = {primary_task, asyncio.create_task(self._call(backup, messages, **kwargs))}
+    error: Optional[BaseException] = None
+    try:
+      while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+          if task.exception() is None:
+            return task.result()
+          error = task.exception()
+    finally:
+      for task in pending:
+        task.cancel()
+    raise error or RuntimeError("hedged request failed")
+
+  async def completion(
+    self,
+    messages: List[Dict[str, Any]],
+    prefer_cheap: bool = False,
+    vision: bool = False,
+    compaction: bool = False,
+    **kwargs,
+  ):
+    if self.config.temperature is not None:
+      kwargs.setdefault("temperature", self.config.temperature)
+
+    routes = self.routes(prefer_cheap, vision, compaction)
+    last_error: Optional[BaseException] = None
+    # routes already raced by a hedge, a primary failing before the hedge delay leaves its backup untried
+    launched: List[ModelRoute] = []
+    for index, route in enumerate(routes):
+      if route in launched:
+        continue
+      try:
+        delay = self.hedge_delay(route) if index + 1 < len(routes) and not kwargs.get("stream") else None
+        if delay is not None:
+          return await self._hedged(route, routes[index + 1], delay, messages, launched, **kwargs)
+        return await self._call(route, messages, **kwargs)
+      except Exception as e:
+        last_error = e
+        untried = [candidate for candidate in routes[index + 1 :] if candidate not in launched]
+        if untried:
+          self.plugin.log_warning(f"{route.model} failed: {e}, falling back to {untried[0].model}")
+    raise last_error or RuntimeError("no model configured")
+
+  def describe(self) -> str:
+    routes = [*self.routes(prefer_cheap=True), *(route for route in (self.vision, self.compaction) if route)]
+    lines = [f"{route.model}: {self.latency(route.model).describe()}" for route in routes]
+    return "\n".join(f"• {line}" for line in lines)
@@ -1,13 +1,27 @@
 import re
+from typing import Any
 from typing import Callable
 from typing import Dict
+from typing import List
 from typing import TYPE_CHECKING
 
 from telegram import Update
 from telegram.ext import ContextTypes
+from telegram.ext import JobQueue
 
+from .admission import AdmissionController
+from .compaction import HistoryCompactor
+from .context import ContextBuilder
 from .history import ConversationHistory
+from .media import IMAGE_TOKENS
+from .media import MediaCache
+from .memory import RetrievalMemory
 from .prompts import SIMPLE_LLM_ROLE
+from .router import ModelRouter
+from .streaming import stream_deltas
+from .streaming import StreamingReply
+from .usage import usage_scope
+from .usage import UsageTracker
 
 if TYPE_CHECKING:
   from lotb.common.plugin_class import PluginBase
@@ -18,11 +32,35 @@ class SimpleLLMHandler:
   def __init__(self, plugin: "PluginBase", config: "LLMConfig"):
     self.plugin = plugin
     self.config = config
-    self.history = ConversationHistory(plugin, config.max_history)
+    self.history = ConversationHistory(
+      plugin,
+      config.history_limit,
+      max_conversations=config.history_cache_size,
+      flush_interval=config.history_flush_interval,
+    )
+    self.usage = UsageTracker(plugin, flush_interval=config.history_flush_interval)
+    self.router = ModelRouter(plugin, config, self.usage)
+    self.admission = AdmissionController(
+      plugin,
+      max_concurrent=config.max_concurrent_requests,
+      per_user=config.user_concurrency,
+      per_chat=config.chat_concurrency,
+      max_queue=config.queue_size,
+      supersede=config.supersede,
+    )
+    self.context_builder = ContextBuilder(plugin, config, self.router)
+    self.memory = RetrievalMemory(plugin, config) if config.memory else None
+    self.compactor = HistoryCompactor(plugin, config, self.history, self.router) if config.compaction else None
+    self.media = MediaCache(plugin, config.media_cache_bytes, config.vision_max_side, config.vision_quality)
     self.pattern_actions: Dict[str, Callable] = {}
 
   def initialize(self):
     self.history.create_table()
+    if self.memory:
+      self.memory.create_table()
+    self.usage.create_table()
+    if self.config.response_cache:
+      self.plugin.enable_llm_cache(self.config.response_cache_ttl, self.config.response_cache_max_entries)
 
     if self.config.friendly_name:
       trigger_pattern = rf"(?i)^\b{re.escape(self.config.friendly_name)}\b[\s,:!?]*"
@@ -30,6 +68,12 @@ class SimpleLLMHandler:
       self.plugin.pattern_actions.update(self.pattern_actions)
       self.plugin.log_info(f"LLM trigger enabled with name: {self.config.friendly_name}")
 
+  def set_job_queue(self, job_queue: JobQueue):
+    self.history.set_job_queue(job_queue)
+    self.usage.set_job_queue(job_queue)
+    if self.compactor:
+      self.compactor.set_job_queue(job_queue)
+
   async def handle_trigger(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
       return
@@ -53,31 +97,51 @@ class SimpleLLMHandler:
 
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
+    with usage_scope(user_id, chat_id):
+      await self.admission.run(update, context, lambda: self._answer(update, context, user_id, chat_id, query))
 
+  async def _answer(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int, query: str):
     try:
       quoted_text = ""
-      if update.message and update.message.reply_to_message and update.message.reply_to_message.text:
-        quoted_text = f"\n\nQuoted message:\n{update.message.reply_to_message.text}"
+      quoted = update.message.reply_to_message if update.message else None
+      if quoted and (quoted.text or quoted.caption):
+        quoted_text = quoted.text or quoted.caption or ""
+      images = await self._images(context, quoted)
 
       history = self.history.get_conversation_history(user_id, chat_id)
-      messages = [
-        {"role": "system", "content": SIMPLE_LLM_ROLE},
-        *history,
-        {"role": "user", "content": f"{query}{quoted_text}"},
-      ]
+      recalled = await self.memory.recall(chat_id, query, self.config.max_history) if self.memory else []
+      messages = await self.context_builder.assemble(
+        SIMPLE_LLM_ROLE,
+        history,
+        query,
+        quoted_text,
+        reserved=IMAGE_TOKENS * len(images),
+        recalled=recalled,
+        images=images,
+        compacted=self.history.get_memory(user_id, chat_id),
+      )
+
+      prefer_cheap = self.router.is_cheap_query(query) and not quoted_text and not images
+      if self.config.streaming:
+        response_content = await self.stream_completion(update, context, messages, prefer_cheap, bool(images))
+        await self._save_turn(user_id, chat_id, query, response_content)
+        return
 
       await self.plugin.send_typing_action(update, context)
-      response = await self.plugin.llm_completion(
+      # the same question means something else after other turns, only a prompt made of the system prompt and the
+      # question alone (no history, memory or image) is looked up in the response cache
+      standalone = len(messages) == 2 and not images
+      response = await self.router.completion(
         messages=messages,
-        model=self.config.model,
-        api_key=self.config.apikey,
+        prefer_cheap=prefer_cheap,
+        vision=bool(images),
+        cache=self.config.response_cache and standalone,
       )
 
       if response.choices and hasattr(response.choices[0], "message") and response.choices[0].message:
         response_content = response.choices[0].message.content or ""
-        self.history.save_message(user_id, chat_id, "user", query)
-        self.history.save_message(user_id, chat_id, "assistant", response_content)
         await self.plugin.reply_message(update, context, response_content)
+        await self._save_turn(user_id, chat_id, query, response_content)
       else:
         await self.plugin.reply_message(update, context, "LLM error: Invalid response format")
 
@@ -85,6 +149,46 @@ class SimpleLLMHandler:
       await self.plugin.reply_message(update, context, f"LLM error: {str(e)}")
       self.plugin.log_error(f"LLM query failed: {str(e)}")
 
+  async def _images(self, context: ContextTypes.DEFAULT_TYPE, quoted) -> List[str]:
+    """the quoted photo or image document as a data url, only when a configured model can read it"""
+    if not self.config.vision or not self.router.supports_vision():
+      return []
+    url = await self.media.data_url(context.bot, quoted)
+    if url:
+      self.plugin.log_info(f"image attached to the query, media cache: {self.media.describe()}")
+    return [url] if url else []
+
+  async def _save_turn(self, user_id: int, chat_id: int, query: str, response: str):
+    self.history.save_message(user_id, chat_id, "user", query)
+    self.history.save_message(user_id, chat_id, "assistant", response)
+    if self.compactor:
+      self.compactor.schedule(user_id, chat_id)
+    if self.memory:
+      await self.memory.remember(user_id, chat_id, [("user", query), ("assistant", response)])
+
+  async def stream_completion(
+    self,
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    messages: List[Dict[str, Any]],
+    prefer_cheap: bool = False,
+    vision: bool = False,
+  ) -> str:
+    async with StreamingReply(self.plugin, update, context, self.config.stream_edit_interval) as reply:
+      response = await self.router.completion(messages=messages, prefer_cheap=prefer_cheap, vision=vision, stream=True)
+      async for delta in stream_deltas(response):
+        await reply.append(delta)
+      await reply.finish()
+    return reply.text
+
+  async def show_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_user or not update.effective_chat:
+      return
+    user_id = update.effective_user.id
+    # totals of other users and chats are only shown to the admins
+    report = self.usage.report(user_id, update.effective_chat.id, include_top=user_id in self.plugin.admin_ids)
+    await self.plugin.reply_message(update, context, report)
+
   async def execute(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await self.plugin.intercept_patterns(update, context, self.pattern_actions):
       return
@@ -105,4 +209,8 @@ class SimpleLLMHandler:
       await self.plugin.reply_message(update, context, "Please provide a query")
       return
 
+    if query.lower() == "stats":
+      await self.show_stats(update, context)
+      return
+
     await self.process_query(update, context, query)
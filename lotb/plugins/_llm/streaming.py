@@ -0,0 +1,143 @@
+import asyncio
+import time
+from typing import Any
+from typing import AsyncIterator
+from typing import Optional
+from typing import TYPE_CHECKING
+
+from telegram import Message
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.error import RetryAfter
+from telegram.ext import ContextTypes
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+
+def cut_point(text: str, limit: int) -> int:
+  """last newline (or space) before the limit, a hard cut only when there is none"""
+  for separator in ("\n", " "):
+    if (cut := text.rfind(separator, 0, limit)) > 0:
+      return cut
+  return limit
+
+
+async def stream_deltas(response: Any) -> AsyncIterator[str]:
+  """text deltas of a litellm streaming response"""
+  async for chunk in response:
+    if chunk.choices and (content := getattr(chunk.choices[0].delta, "content", None)):
+      yield content
+
+
+class StreamingReply:
+  """reply that grows while the completion streams, edits are throttled and long answers spill over"""
+
+  def __init__(
+    self,
+    plugin: "PluginBase",
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    edit_interval: float = 1.5,
+    typing_interval: float = 4.0,
+    max_length: int = TELEGRAM_MAX_MESSAGE_LENGTH,
+  ):
+    self.plugin = plugin
+    self.update = update
+    self.context = context
+    self.edit_interval = edit_interval
+    self.typing_interval = typing_interval
+    self.max_length = max_length
+    self.text = ""
+    # text already delivered in full by the previous (sealed) messages
+    self.sealed = 0
+    self.message: Optional[Message] = None
+    self.shown = ""
+    self.next_edit = 0.0
+    self.edits = 0
+    self._typing_task: Optional[asyncio.Task] = None
+
+  async def __aenter__(self) -> "StreamingReply":
+    self._typing_task = asyncio.create_task(self._keep_typing())
+    return self
+
+  async def __aexit__(self, *exc):
+    self._stop_typing()
+
+  async def _keep_typing(self):
+    # the telegram typing indicator lasts about five seconds, keep it alive until the first token shows up
+    while True:
+      try:
+        await self.plugin.send_typing_action(self.update, self.context)
+      except Exception as e:
+        self.plugin.log_debug(f"typing action failed: {e}")
+      await asyncio.sleep(self.typing_interval)
+
+  def _stop_typing(self):
+    if self._typing_task:
+      self._typing_task.cancel()
+      self._typing_task = None
+
+  async def append(self, delta: str):
+    self.text += delta
+    if time.monotonic() >= self.next_edit:
+      await self.flush()
+
+  def reset(self):
+    """drop the text streamed so far that was not sealed yet, the next turn overwrites it"""
+    self.text = self.text[: self.sealed]
+
+  async def flush(self, final: bool = False):
+    if not self.text[self.sealed :].strip():
+      return
+    self._stop_typing()
+
+    # a full message is sealed with its last edit and the rest continues in a new one
+    while len(pending := self.text[self.sealed :]) > self.max_length:
+      cut = cut_point(pending, self.max_length)
+      await self._show(pending[:cut], final=True)
+      self.sealed += cut
+      while self.sealed < len(self.text) and self.text[self.sealed] in "\n ":
+        self.sealed += 1
+      self.message = None
+      self.shown = ""
+    await self._show(self.text[self.sealed :], final)
+
+  async def _show(self, text: str, final: bool = True):
+    # telegram trims trailing whitespace, editing only to add a space would fail as "not modified"
+    text = text.rstrip()
+    if not text or text == self.shown:
+      return
+    try:
+      if self.message is None:
+        self.message = await self.update.message.reply_text(text) if self.update.message else None
+      else:
+        await self.message.edit_text(text)
+        self.edits += 1
+      self.shown = text
+    except RetryAfter as e:
+      self.plugin.log_warning(f"telegram rate limit hit while streaming: {e}")
+      retry_after = e.retry_after
+      seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+      self.next_edit = time.monotonic() + seconds
+      if final:
+        await asyncio.sleep(self.next_edit - time.monotonic())
+        await self._show(text, final)
+      return
+    except BadRequest as e:
+      # "message is not modified" and similar, the next edit carries the full text anyway
+      self.plugin.log_debug(f"streaming edit skipped: {e}")
+    self.next_edit = time.monotonic() + self.edit_interval
+
+  async def finish(self, text: Optional[str] = None):
+    """deliver the final text, replacing what was streamed when it differs (errors, post processing)"""
+    self._stop_typing()
+    if text is not None and text != self.text:
+      if not text.startswith(self.text[: self.sealed]):
+        self.sealed = 0
+        self.message = None
+        self.shown = ""
+      self.text = text
+    await self.flush(final=True)
@@ -1,25 +1,35 @@
+import asyncio
 import json
 from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import TYPE_CHECKING
 
 from mcp import ClientSession
 from pydantic import AnyUrl
 from pydantic import parse_obj_as
 
+from .cache import cache_key
+from .cache import ResultCache
 from .mcp_manager import MCPSessionManager
 
 if TYPE_CHECKING:
   from lotb.common.plugin_class import PluginBase
+  from .budget import LoopBudget
   from .mcp_manager import MCPManager
 
 
 class ToolHandler:
-  def __init__(self, plugin: "PluginBase", mcp_manager: "MCPManager"):
+  def __init__(self, plugin: "PluginBase", mcp_manager: "MCPManager", cache: Optional[ResultCache] = None):
     self.plugin = plugin
     self.mcp = mcp_manager
+    self.cache = cache or ResultCache(ttl=0)
+
+  @property
+  def session_manager(self) -> "MCPSessionManager":
+    return self.mcp.session_manager
 
   @MCPSessionManager.with_session("reading resource", "")
   async def read_resource_from_session(self, session: ClientSession, server_cfg: Dict[str, Any], uri: str) -> str:
@@ -38,7 +48,8 @@ class ToolHandler:
       return "\n".join(content_parts)
     return str(result)
 
-  @MCPSessionManager.with_session("calling tool", "")
+  # tool calls may have side effects, never replay them on a new session
+  @MCPSessionManager.with_session("calling tool", "", retries=0)
   async def call_tool_from_session(
     self, session: ClientSession, server_cfg: Dict[str, Any], tool_name: str, tool_args: Dict[str, Any]
   ) -> str:
@@ -54,17 +65,34 @@ class ToolHandler:
         return getattr(result.content, "text", str(result.content))
     return str(result)
 
+  @staticmethod
+  def _failed(content: str) -> bool:
+    return content.startswith(("error", "tool call failed"))
+
+  @classmethod
+  def _cacheable(cls, content: str) -> bool:
+    return bool(content) and not cls._failed(content)
+
   async def read_resource(self, uri: str) -> str:
     server_cfg = self.mcp.resource_to_server_map.get(uri)
     if not server_cfg:
       return f"error: no server found for resource '{uri}'"
 
+    key = cache_key(server_cfg.get("name", "unknown"), uri)
+    if (cached := self.cache.get(key)) is not None:
+      self.plugin.log_debug(f"resource {uri} served from cache")
+      return cached
+
     try:
-      return await self.read_resource_from_session(server_cfg, uri)
+      content = await self.read_resource_from_session(server_cfg, uri)
     except Exception as e:
       self.plugin.log_warning(f"failed to read resource {uri}: {e}")
       return f"error reading resource: {e}"
 
+    if self._cacheable(content):
+      self.cache.set(key, content, server_cfg.get("cache_ttl"))
+    return content
+
   async def call_tool(self, tool_name: str, tool_args: Dict[str, Any]) -> str:
     server_cfg = self.mcp.tool_to_server_map.get(tool_name)
     if not server_cfg:
@@ -73,14 +101,25 @@ class ToolHandler:
       )
       return f"error: No server found for tool '{tool_name}'"
 
+    # only tools the server config marks as cacheable are idempotent, anything else may have side effects
+    key = None
+    if tool_name in server_cfg.get("cacheable_tools", []):
+      key = cache_key(server_cfg.get("name", "unknown"), tool_name, tool_args)
+      if (cached := self.cache.get(key)) is not None:
+        self.plugin.log_info(f"tool '{tool_name}' served from cache")
+        return cached
+
     try:
       tool_result = await self.call_tool_from_session(server_cfg, tool_name, tool_args)
       self.plugin.log_info(f"tool '{tool_name}' returned: {tool_result[:200]}...")
-      return tool_result
     except Exception as e:
       self.plugin.log_warning(f"tool call failed: {e}")
       return f"tool call failed: {e}"
 
+    if key and self._cacheable(tool_result):
+      self.cache.set(key, tool_result, server_cfg.get("cache_ttl"))
+    return tool_result
+
   async def create_resource_tools(self, resources: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     resource_tools = []
 
@@ -110,6 +149,56 @@ class ToolHandler:
         return tool["_resource_uri"]
     return None
 
+  def is_idempotent(self, tool_name: str) -> bool:
+    """resources and the tools the server config marks as cacheable can be called again safely"""
+    if tool_name.startswith("read_resource_"):
+      return True
+    server_cfg = self.mcp.tool_to_server_map.get(tool_name) or {}
+    return tool_name in server_cfg.get("cacheable_tools", [])
+
+  async def execute_tool_calls(
+    self,
+    tool_calls,
+    messages: List[Dict[str, Any]],
+    tools: List[Dict[str, Any]],
+    max_concurrency: int = 4,
+    timeout: float = 30.0,
+    retries: int = 0,
+    budget: Optional["LoopBudget"] = None,
+  ) -> List[Optional[str]]:
+    """run the tool calls of one assistant turn concurrently, tool messages are appended in the original order.
+    no call outlives the loop budget, failed idempotent calls are retried while it has time left"""
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def attempt(tool_call) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+      replies: List[Dict[str, Any]] = []
+      limit = budget.clip(timeout) if budget else timeout
+      try:
+        result = await asyncio.wait_for(self.execute_tool_call(tool_call, replies, tools), timeout=limit)
+      except asyncio.TimeoutError:
+        self.plugin.log_warning(f"tool '{tool_call.function.name}' timed out after {round(limit, 2)}s")
+        replies = [
+          {"role": "tool", "tool_call_id": tool_call.id, "content": f"error: tool timed out after {round(limit, 2)}s"}
+        ]
+        result = None
+      return result, replies
+
+    async def run(tool_call) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+      async with semaphore:
+        result, replies = await attempt(tool_call)
+        for retry in range(retries):
+          out_of_time = budget is not None and budget.remaining() == 0
+          if result is not None or out_of_time or not self.is_idempotent(tool_call.function.name):
+            break
+          self.plugin.log_info(f"retrying tool '{tool_call.function.name}', attempt {retry + 2}")
+          result, replies = await attempt(tool_call)
+      return result, replies
+
+    outcomes = await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+    for _, replies in outcomes:
+      messages.extend(replies)
+    return [result for result, _ in outcomes]
+
   async def execute_tool_call(
     self, tool_call, messages: List[Dict[str, Any]], tools: List[Dict[str, Any]]
   ) -> Optional[str]:
@@ -145,11 +234,11 @@ class ToolHandler:
       content = await self.read_resource(resource_uri)
 
     messages.append({"role": "tool", "tool_call_id": tool_call.id, "content": content})
-    return "continue"
+    return None if self._failed(content) else "continue"
 
   async def _handle_mcp_tool(
     self, tool_name: str, tool_args: Dict[str, Any], tool_call, messages: List[Dict[str, Any]]
   ) -> Optional[str]:
     content = await self.call_tool(tool_name, tool_args)
     messages.append({"role": "tool", "tool_call_id": tool_call.id, "content": content})
-    return "continue" if not content.startswith("error") else None
+    return None if self._failed(content) else "continue"
@@ -0,0 +1,72 @@
+import json
+import math
+import re
+from collections import Counter
+from typing import Any
+from typing import Dict
+from typing import List
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+  "a an and any are as at be by can do for from how i in is it me my of on or please some that the this to what "
+  "when where which who with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+  # snake_case and kebab-case names are split on the separators, so "get_weather" matches "weather"
+  return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def tool_text(tool: Dict[str, Any]) -> str:
+  function = tool.get("function", {})
+  parameters = function.get("parameters", {}).get("properties", {})
+  parameter_text = " ".join(f"{name} {spec.get('description', '')}" for name, spec in parameters.items())
+  return f"{function.get('name', '')} {function.get('description', '')} {parameter_text}"
+
+
+def estimate_tokens(tools: List[Dict[str, Any]]) -> int:
+  """rough prompt cost of the tool schemas, about four characters per token"""
+  return sum(len(json.dumps(tool.get("function", {}))) for tool in tools) // 4
+
+
+class ToolRanker:
+  """offline bm25 index over the tool names, descriptions and parameters"""
+
+  def __init__(self, tools: List[Dict[str, Any]], k1: float = 1.5, b: float = 0.75):
+    self.tools = tools
+    self.k1 = k1
+    self.b = b
+    self.documents = [Counter(tokenize(tool_text(tool))) for tool in tools]
+    self.lengths = [sum(document.values()) for document in self.documents]
+    self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+    document_frequency: Counter = Counter()
+    for document in self.documents:
+      document_frequency.update(document.keys())
+    total = len(self.documents)
+    self.idf = {term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+
+  def scores(self, query: str) -> List[float]:
+    terms = [term for term in set(tokenize(query)) if term in self.idf]
+    scores = []
+    for document, length in zip(self.documents, self.lengths):
+      norm = self.k1 * (1 - self.b + self.b * length / self.average_length) if self.average_length else self.k1
+      scores.append(
+        sum(
+          self.idf[term] * document[term] * (self.k1 + 1) / (document[term] + norm)
+          for term in terms
+          if term in document
+        )
+      )
+    return scores
+
+  def select(self, query: str, top_k: int) -> List[Dict[str, Any]]:
+    """the top_k most relevant tools in catalog order, every tool when nothing in the query matches"""
+    if top_k <= 0 or len(self.tools) <= top_k:
+      return self.tools
+
+    scores = self.scores(query)
+    ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])[:top_k]
+    if not ranked:
+      return self.tools
+    return [self.tools[i] for i in sorted(ranked)]
@@ -0,0 +1,221 @@
+import sqlite3
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+import litellm
+from telegram.ext import ContextTypes
+from telegram.ext import JobQueue
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+
+# (user_id, chat_id) of the request being answered, completions made on its behalf are charged to it
+REQUEST_SCOPE: ContextVar[Tuple[Optional[int], Optional[int]]] = ContextVar("llm_request_scope", default=(None, None))
+
+ROLLUP_COLUMNS = ("requests", "prompt_tokens", "completion_tokens", "tool_calls", "cached", "latency_ms", "cost")
+
+
+@contextmanager
+def usage_scope(user_id: Optional[int], chat_id: Optional[int]) -> Iterator[None]:
+  token = REQUEST_SCOPE.set((user_id, chat_id))
+  try:
+    yield
+  finally:
+    REQUEST_SCOPE.reset(token)
+
+
+def _count(value: Any) -> int:
+  return value if isinstance(value, int) else 0
+
+
+class UsageTracker:
+  """append only log of the completions written in batches, per user, chat and model totals kept up to date alongside"""
+
+  def __init__(self, plugin: "PluginBase", flush_batch: int = 32, flush_interval: float = 10.0):
+    self.plugin = plugin
+    self.flush_batch = flush_batch
+    self.flush_interval = flush_interval
+    self._pending: List[Tuple[Any, ...]] = []
+
+  def create_table(self):
+    self.plugin.create_table("""
+            CREATE TABLE IF NOT EXISTS llm_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                model TEXT,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                tool_calls INTEGER NOT NULL,
+                cached INTEGER NOT NULL,
+                latency_ms INTEGER NOT NULL,
+                ttft_ms INTEGER,
+                cost REAL NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+    self.plugin.execute_query("CREATE INDEX IF NOT EXISTS llm_usage_timestamp_idx ON llm_usage (timestamp)")
+    self.plugin.create_table("""
+            CREATE TABLE IF NOT EXISTS llm_usage_rollup (
+                scope TEXT NOT NULL,
+                scope_id TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                tool_calls INTEGER NOT NULL DEFAULT 0,
+                cached INTEGER NOT NULL DEFAULT 0,
+                latency_ms INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (scope, scope_id)
+            )
+        """)
+
+  def set_job_queue(self, job_queue: JobQueue):
+    if self.flush_interval > 0:
+      job_queue.run_repeating(self._flush_job, interval=self.flush_interval, first=self.flush_interval)
+
+  async def _flush_job(self, context: ContextTypes.DEFAULT_TYPE):
+    self.flush()
+
+  def record(self, model: Optional[str], response: Any, latency: float, ttft: Optional[float] = None):
+    usage = getattr(response, "usage", None)
+    choices = getattr(response, "choices", None) or []
+    message = getattr(choices[0], "message", None) if choices else None
+    cached = bool(getattr(response, "_hidden_params", {}).get("cache_hit"))
+    cost = 0.0
+    if response is not None and not cached:
+      try:
+        cost = float(litellm.completion_cost(completion_response=response, model=model))
+      except Exception:
+        # models missing from the litellm price list are only counted in tokens
+        cost = 0.0
+    user_id, chat_id = REQUEST_SCOPE.get()
+    self._pending.append(
+      (
+        user_id,
+        chat_id,
+        model,
+        _count(getattr(usage, "prompt_tokens", 0)),
+        _count(getattr(usage, "completion_tokens", 0)),
+        len(getattr(message, "tool_calls", None) or []) if message is not None else 0,
+        int(cached),
+        int(latency * 1000),
+        int(ttft * 1000) if ttft is not None else None,
+        cost,
+      )
+    )
+    if len(self._pending) >= self.flush_batch:
+      self.flush()
+
+  async def meter_stream(
+    self, stream: Any, model: Optional[str], messages: List[Dict[str, Any]], started: float
+  ) -> AsyncIterator[Any]:
+    """pass the chunks through, the usage is recorded once the stream ends with the time to the first chunk"""
+    chunks = []
+    ttft = None
+    try:
+      async for chunk in stream:
+        if ttft is None:
+          ttft = time.monotonic() - started
+        chunks.append(chunk)
+        yield chunk
+    finally:
+      response = None
+      try:
+        response = litellm.stream_chunk_builder(chunks, messages=messages) if chunks else None
+      except Exception as e:
+        self.plugin.log_debug(f"could not rebuild the streamed response for accounting: {e}")
+      self.record(model, response, time.monotonic() - started, ttft)
+
+  def _rollups(self, pending: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+    totals: Dict[Tuple[str, str], List[float]] = defaultdict(lambda: [0] * len(ROLLUP_COLUMNS))
+    for user_id, chat_id, model, prompt, completion, tool_calls, cached, latency_ms, _, cost in pending:
+      for scope, scope_id in (("user", user_id), ("chat", chat_id), ("model", model)):
+        if scope_id is None:
+          continue
+        total = totals[(scope, str(scope_id))]
+        for index, value in enumerate((1, prompt, completion, tool_calls, cached, latency_ms, cost)):
+          total[index] += value
+    return [(scope, scope_id, *total) for (scope, scope_id), total in totals.items()]
+
+  def flush(self) -> None:
+    """append the buffered records and fold them into the rollups, in one transaction"""
+    if not self._pending or not self.plugin.connection:
+      return
+
+    pending, self._pending = self._pending, []
+    updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in ROLLUP_COLUMNS)
+    try:
+      cursor = self.plugin.connection.cursor()
+      cursor.executemany(
+        "INSERT INTO llm_usage (user_id, chat_id, model, prompt_tokens, completion_tokens, tool_calls, cached, "
+        "latency_ms, ttft_ms, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        pending,
+      )
+      cursor.executemany(
+        f"INSERT INTO llm_usage_rollup (scope, scope_id, {', '.join(ROLLUP_COLUMNS)}) "
+        f"VALUES (?, ?, {', '.join('?' for _ in ROLLUP_COLUMNS)}) "
+        f"ON CONFLICT (scope, scope_id) DO UPDATE SET {updates}",
+        self._rollups(pending),
+      )
+      self.plugin.connection.commit()
+    except sqlite3.Error as e:
+      self.plugin.log_error(f"failed to persist llm usage: {e}")
+      self.plugin.connection.rollback()
+      self._pending = pending + self._pending
+
+  def totals(self, scope: str, scope_id: Any) -> Optional[Dict[str, Any]]:
+    self.flush()
+    if not self.plugin.db_cursor:
+      return None
+    self.plugin.db_cursor.execute(
+      f"SELECT {', '.join(ROLLUP_COLUMNS)} FROM llm_usage_rollup WHERE scope = ? AND scope_id = ?",
+      (scope, str(scope_id)),
+    )
+    row = self.plugin.db_cursor.fetchone()
+    return dict(zip(ROLLUP_COLUMNS, row)) if row else None
+
+  def top(self, scope: str, limit: int = 5) -> List[Tuple[str, Dict[str, Any]]]:
+    self.flush()
+    if not self.plugin.db_cursor:
+      return []
+    self.plugin.db_cursor.execute(
+      f"SELECT scope_id, {', '.join(ROLLUP_COLUMNS)} FROM llm_usage_rollup WHERE scope = ? "
+      "ORDER BY cost DESC, prompt_tokens + completion_tokens DESC LIMIT ?",
+      (scope, limit),
+    )
+    return [(row[0], dict(zip(ROLLUP_COLUMNS, row[1:]))) for row in self.plugin.db_cursor.fetchall()]
+
+  @staticmethod
+  def format_totals(totals: Optional[Dict[str, Any]]) -> str:
+    if not totals:
+      return "no requests yet"
+    average = totals["latency_ms"] / totals["requests"] / 1000 if totals["requests"] else 0.0
+    return (
+      f"{totals['requests']} requests, {totals['prompt_tokens']} prompt + {totals['completion_tokens']} completion "
+      f"tokens, {totals['tool_calls']} tool calls, {totals['cached']} cached, avg {average:.2f}s, ${totals['cost']:.4f}"
+    )
+
+  def report(self, user_id: int, chat_id: int, include_top: bool = False) -> str:
+    sections = [
+      "📊 LLM usage",
+      f"• you: {self.format_totals(self.totals('user', user_id))}",
+      f"• this chat: {self.format_totals(self.totals('chat', chat_id))}",
+    ]
+    if not include_top:
+      return "\n".join(sections)
+    for scope, title in (("model", "Models"), ("chat", "Top chats"), ("user", "Top users")):
+      if rows := self.top(scope):
+        sections.append(f"\n{title}:")
+        sections.extend(f"• {scope_id}: {self.format_totals(totals)}" for scope_id, totals in rows)
+    return "\n".join(sections)
@@ -0,0 +1,7 @@
+from .endpoints import AlertmanagerEndpoint
+from .render import AlertRenderer
+from .render import AlertThrottle
+from .state import AlertStateTracker
+from .webhook import AlertWebhookReceiver
+
+__all__ = ["AlertmanagerEndpoint", "AlertRenderer", "AlertThrottle", "AlertStateTracker", "AlertWebhookReceiver"]
@@ -0,0 +1,61 @@
+import time
+from datetime import datetime
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+DEFAULT_TIMEOUT = 10.0
+
+
+class AlertmanagerEndpoint:
+  def __init__(self, name: str, url: str, timeout: float = DEFAULT_TIMEOUT):
+    self.name = name
+    self.url = url.rstrip("/")
+    self.timeout = timeout
+    self.last_success: Optional[datetime] = None
+    self.last_error: Optional[str] = None
+    self.last_duration = 0.0
+    self.alert_count = 0
+    self.consecutive_failures = 0
+
+  @property
+  def healthy(self) -> bool:
+    return self.last_success is not None and self.consecutive_failures == 0
+
+  def record_success(self, alert_count: int, started: float):
+    self.last_success = datetime.now()
+    self.last_duration = time.monotonic() - started
+    self.alert_count = alert_count
+    self.last_error = None
+    self.consecutive_failures = 0
+
+  def record_failure(self, error: str, started: float):
+    self.last_duration = time.monotonic() - started
+    self.last_error = error
+    self.consecutive_failures += 1
+
+  def describe(self) -> str:
+    if self.last_success is None and self.last_error is None:
+      return f"⏳ {self.name}: not polled yet"
+    if self.healthy:
+      return f"✅ {self.name}: {self.alert_count} alerts in {self.last_duration:.2f}s"
+    last_ok = self.last_success.strftime("%Y-%m-%d %H:%M") if self.last_success else "never"
+    return f"❌ {self.name}: {self.last_error} ({self.consecutive_failures} failures, last ok {last_ok})"
+
+
+def parse_endpoints(plugin_config: Dict[str, Any]) -> List[AlertmanagerEndpoint]:
+  """build the endpoint list from `alertmanagers`, falling back to the single `prometheusUrl`"""
+  default_timeout = float(plugin_config.get("timeout", DEFAULT_TIMEOUT))
+  endpoints = [
+    AlertmanagerEndpoint(
+      name=entry.get("name") or entry["url"],
+      url=entry["url"],
+      timeout=float(entry.get("timeout", default_timeout)),
+    )
+    for entry in plugin_config.get("alertmanagers", [])
+    if entry.get("url")
+  ]
+  if not endpoints and plugin_config.get("prometheusUrl"):
+    endpoints.append(AlertmanagerEndpoint("default", plugin_config["prometheusUrl"], default_timeout))
+  return endpoints
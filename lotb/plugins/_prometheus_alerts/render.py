@@ -0,0 +1,186 @@
+import time
+from collections import defaultdict
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+from lotb.plugins._prometheus_alerts.state import alert_fingerprint
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+SEVERITY_EMOJIS = {"critical": "🚨", "warning": "⚠️", "info": "ℹ️"}
+
+GroupKey = Tuple[str, str, str]
+
+
+def _is_escaped(text: str, index: int) -> bool:
+  """true when the char at index is preceded by an odd number of backslashes"""
+  backslashes = 0
+  while index - backslashes - 1 >= 0 and text[index - backslashes - 1] == "\\":
+    backslashes += 1
+  return backslashes % 2 == 1
+
+
+def _open_code_span(text: str) -> bool:
+  return sum(1 for i, char in enumerate(text) if char == "`" and not _is_escaped(text, i)) % 2 == 1
+
+
+def split_line(line: str, limit: int) -> List[str]:
+  """hard split a single line, never cutting a markdownv2 escape sequence and keeping code spans balanced"""
+  chunks = []
+  while len(line) > limit:
+    cut = limit - 1
+    # never leave a dangling backslash at the end of a chunk
+    while cut > 1 and _is_escaped(line, cut):
+      cut -= 1
+    chunk, line = line[:cut], line[cut:]
+    if _open_code_span(chunk):
+      chunk += "`"
+      line = "`" + line
+    chunks.append(chunk)
+  chunks.append(line)
+  return chunks
+
+
+def pack_messages(parts: List[str], limit: int = TELEGRAM_MAX_MESSAGE_LENGTH, separator: str = "\n\n") -> List[str]:
+  """pack the rendered parts in as few messages as possible, splitting on line boundaries only when needed"""
+  messages: List[str] = []
+  current = ""
+  for part in parts:
+    candidate = f"{current}{separator}{part}" if current else part
+    if len(candidate) <= limit:
+      current = candidate
+      continue
+    if current:
+      messages.append(current)
+      current = ""
+    if len(part) <= limit:
+      current = part
+      continue
+
+    for line in part.split("\n"):
+      for piece in split_line(line, limit):
+        candidate = f"{current}\n{piece}" if current else piece
+        if len(candidate) <= limit:
+          current = candidate
+        else:
+          messages.append(current)
+          current = piece
+  if current:
+    messages.append(current)
+  return messages
+
+
+class AlertThrottle:
+  """suppress repeated notifications for the same alert within the window, the newest suppressed state change of an
+  alert is deferred and delivered once its window expires, so it arrives late but is never lost"""
+
+  def __init__(self, window_seconds: float):
+    self.window_seconds = window_seconds
+    self.last_sent: Dict[Tuple[Any, ...], float] = {}
+    # fingerprint -> resolved flag of the last notification, only kept while a window is open
+    self.notified: Dict[str, bool] = {}
+    self.deferred: Dict[str, Tuple[bool, Dict[str, Any]]] = {}
+
+  def allow(self, key: Tuple[Any, ...]) -> bool:
+    if self.window_seconds <= 0:
+      return True
+
+    now = time.monotonic()
+    self.last_sent = {k: sent for k, sent in self.last_sent.items() if now - sent < self.window_seconds}
+    if key in self.last_sent:
+      return False
+    self.last_sent[key] = now
+    return True
+
+  def filter(self, alerts: List[Dict[str, Any]], resolved: bool = False) -> List[Dict[str, Any]]:
+    """the alerts to notify now, the throttled ones that change what the chat last saw are deferred"""
+    allowed = []
+    for alert in alerts:
+      fingerprint = alert_fingerprint(alert)
+      if self.allow((resolved, fingerprint)):
+        self.notified[fingerprint] = resolved
+        self.deferred.pop(fingerprint, None)
+        allowed.append(alert)
+      elif self.notified.get(fingerprint) != resolved:
+        self.deferred[fingerprint] = (resolved, alert)
+      else:
+        # back to the state the chat already shows, nothing left to deliver
+        self.deferred.pop(fingerprint, None)
+    open_windows = {key[-1] for key in self.last_sent}
+    self.notified = {
+      fingerprint: state
+      for fingerprint, state in self.notified.items()
+      if fingerprint in self.deferred or fingerprint in open_windows
+    }
+    return allowed
+
+  def due(self) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """deferred firing and resolved alerts whose window expired, they count as notified"""
+    firing: List[Dict[str, Any]] = []
+    resolved: List[Dict[str, Any]] = []
+    for fingerprint, (is_resolved, alert) in list(self.deferred.items()):
+      if self.allow((is_resolved, fingerprint)):
+        del self.deferred[fingerprint]
+        self.notified[fingerprint] = is_resolved
+        (resolved if is_resolved else firing).append(alert)
+    return firing, resolved
+
+
+class AlertRenderer:
+  def __init__(self, plugin: "PluginBase", max_length: int = TELEGRAM_MAX_MESSAGE_LENGTH):
+    self.plugin = plugin
+    self.max_length = max_length
+
+  def group(self, alerts: List[Dict[str, Any]]) -> Dict[GroupKey, List[Dict[str, Any]]]:
+    grouped: Dict[GroupKey, List[Dict[str, Any]]] = defaultdict(list)
+    for alert in alerts:
+      labels = alert.get("labels", {})
+      key = (
+        labels.get("alertname", "Unknown"),
+        labels.get("severity", "Unknown"),
+        alert.get("annotations", {}).get("description", "No description"),
+      )
+      grouped[key].append(alert)
+    return grouped
+
+  def render_group(self, key: GroupKey, group: List[Dict[str, Any]], resolved: bool = False) -> str:
+    alert_name, severity, description = key
+    if resolved:
+      severity_emoji, title = "✅", "Resolved"
+    else:
+      severity_emoji, title = SEVERITY_EMOJIS.get(severity.lower(), "❓"), "Alert"
+
+    merged_labels: Dict[str, set] = defaultdict(set)
+    for alert in group:
+      for label, value in alert.get("labels", {}).items():
+        if label not in ("alertname", "severity"):
+          merged_labels[label].add(value)
+
+    formatted_labels = []
+    for label, values in merged_labels.items():
+      if len(values) == 1:
+        formatted_labels.append(f"  • `{self._escape_code(label)}`: `{self._escape_code(next(iter(values)))}`")
+      else:
+        formatted_labels.append(f"  • `{self._escape_code(label)}`:")
+        formatted_labels.extend(f"    ◦ `{self._escape_code(value)}`" for value in sorted(values))
+
+    return (
+      f"{severity_emoji} *{title}*: `{self.plugin.escape_markdown(alert_name)}`\n"
+      f"*Severity*: `{self.plugin.escape_markdown(severity)}`\n"
+      f"*Description*: {self.plugin.escape_markdown(description)}\n"
+      "*Labels*:\n" + "\n".join(formatted_labels)
+    )
+
+  def render(self, grouped: Dict[GroupKey, List[Dict[str, Any]]], resolved: bool = False) -> List[str]:
+    parts = [self.render_group(key, group, resolved) for key, group in grouped.items()]
+    return pack_messages(parts, self.max_length)
+
+  @staticmethod
+  def _escape_code(text: Any) -> str:
+    # inside code entities markdownv2 only requires ` and \ to be escaped
+    return str(text).replace("\\", "\\\\").replace("`", "\\`")
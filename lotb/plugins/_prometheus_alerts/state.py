@@ -0,0 +1,161 @@
+import hashlib
+import json
+import sqlite3
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+
+
+def alert_fingerprint(alert: Dict[str, Any]) -> str:
+  """alertmanager fingerprint, or a stable hash of the labels when the source does not provide one"""
+  if fingerprint := alert.get("fingerprint"):
+    return str(fingerprint)
+  labels = json.dumps(alert.get("labels", {}), sort_keys=True)
+  return hashlib.sha256(labels.encode()).hexdigest()[:16]
+
+
+DEFAULT_SOURCE = "default"
+
+
+class AlertStateTracker:
+  def __init__(self, plugin: "PluginBase", sources: Optional[List[str]] = None):
+    self.plugin = plugin
+    self.all_sources = set(sources or [DEFAULT_SOURCE])
+    self.active: Dict[str, Dict[str, Any]] = {}
+    # alertmanager endpoints currently reporting each alert, an alert resolves when none of them does
+    self.sources: Dict[str, Set[str]] = {}
+    self._pending_upserts: Dict[str, Dict[str, Any]] = {}
+    self._pending_deletes: Set[str] = set()
+
+  def create_table(self):
+    self.plugin.create_table("""
+        CREATE TABLE IF NOT EXISTS alert_state (
+            fingerprint TEXT PRIMARY KEY,
+            alert_name TEXT,
+            alert_severity TEXT,
+            alert_description TEXT,
+            alert_labels TEXT,
+            starts_at TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+  def load(self):
+    if not self.plugin.db_cursor:
+      return
+
+    self.plugin.db_cursor.execute("SELECT fingerprint, alert_description, alert_labels, starts_at FROM alert_state")
+    for fingerprint, description, labels, starts_at in self.plugin.db_cursor.fetchall():
+      self.active[fingerprint] = {
+        "fingerprint": fingerprint,
+        "labels": json.loads(labels) if labels else {},
+        "annotations": {"description": description},
+        "startsAt": starts_at,
+      }
+      self.sources[fingerprint] = set(self.all_sources)
+    self.plugin.log_info(f"loaded {len(self.active)} active alerts from the database")
+
+  def _mark_firing(self, fingerprint: str, alert: Dict[str, Any], sources: Set[str]):
+    self.active[fingerprint] = {
+      "fingerprint": fingerprint,
+      "labels": alert.get("labels", {}),
+      "annotations": alert.get("annotations", {}),
+      "startsAt": alert.get("startsAt", "Unknown"),
+    }
+    self.sources[fingerprint] = set(sources)
+    self._pending_upserts[fingerprint] = self.active[fingerprint]
+    self._pending_deletes.discard(fingerprint)
+
+  def _mark_resolved(self, fingerprint: str) -> Dict[str, Any]:
+    alert = self.active.pop(fingerprint)
+    self.sources.pop(fingerprint, None)
+    self._pending_upserts.pop(fingerprint, None)
+    self._pending_deletes.add(fingerprint)
+    return alert
+
+  def reconcile(
+    self, alerts: List[Dict[str, Any]], source: str = DEFAULT_SOURCE
+  ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """compare a full snapshot of the alerts active on one source with the known state, returns (firing, resolved)"""
+    firing = []
+    seen = set()
+    for alert in alerts:
+      fingerprint = alert_fingerprint(alert)
+      if fingerprint in seen:
+        continue
+      seen.add(fingerprint)
+      if fingerprint not in self.active:
+        self._mark_firing(fingerprint, alert, {source})
+        firing.append(alert)
+      else:
+        self.sources[fingerprint].add(source)
+
+    resolved = []
+    for fingerprint in list(self.active):
+      if fingerprint in seen:
+        continue
+      reporting = self.sources.get(fingerprint, set())
+      reporting.discard(source)
+      if not reporting:
+        resolved.append(self._mark_resolved(fingerprint))
+    return firing, resolved
+
+  def update(self, alerts: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """apply a partial update where every alert carries its own status (webhook payloads), returns (firing, resolved)"""
+    firing = []
+    resolved = []
+    for alert in alerts:
+      fingerprint = alert_fingerprint(alert)
+      if alert.get("status") == "resolved":
+        if fingerprint in self.active:
+          resolved.append(self._mark_resolved(fingerprint))
+      elif fingerprint not in self.active:
+        # the pushing cluster is unknown, every source has to stop reporting it before polling resolves it
+        self._mark_firing(fingerprint, alert, self.all_sources)
+        firing.append(alert)
+    return firing, resolved
+
+  def persist(self):
+    if not self._pending_upserts and not self._pending_deletes:
+      return
+    if not self.plugin.connection:
+      return
+
+    rows = [
+      (
+        fingerprint,
+        alert["labels"].get("alertname", "Unknown"),
+        alert["labels"].get("severity", "Unknown"),
+        alert["annotations"].get("description", "No description"),
+        json.dumps(alert["labels"], sort_keys=True),
+        alert["startsAt"],
+      )
+      for fingerprint, alert in self._pending_upserts.items()
+    ]
+    try:
+      cursor = self.plugin.connection.cursor()
+      cursor.executemany(
+        "INSERT OR REPLACE INTO alert_state "
+        "(fingerprint, alert_name, alert_severity, alert_description, alert_labels, starts_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+      )
+      cursor.executemany(
+        "DELETE FROM alert_state WHERE fingerprint = ?", [(fingerprint,) for fingerprint in self._pending_deletes]
+      )
+      self.plugin.connection.commit()
+      self.plugin.log_info(f"persisted alert state: {len(rows)} firing, {len(self._pending_deletes)} resolved")
+    except sqlite3.Error as e:
+      self.plugin.log_error(f"failed to persist alert state: {e}")
+      self.plugin.connection.rollback()
+      return
+
+    self._pending_upserts.clear()
+    self._pending_deletes.clear()
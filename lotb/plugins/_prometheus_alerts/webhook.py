@@ -0,0 +1,119 @@
+import asyncio
+import hmac
+import json
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from lotb.common.plugin_class import PluginBase
+
+HTTP_REASONS = {
+  200: "OK",
+  400: "Bad Request",
+  401: "Unauthorized",
+  404: "Not Found",
+  405: "Method Not Allowed",
+  408: "Request Timeout",
+  413: "Payload Too Large",
+  500: "Internal Server Error",
+}
+
+
+class AlertWebhookReceiver:
+  """minimal http endpoint for the alertmanager webhook_config receiver, no extra dependencies needed"""
+
+  def __init__(
+    self,
+    plugin: "PluginBase",
+    handler: Callable[[Dict[str, Any]], Awaitable[None]],
+    host: str = "0.0.0.0",
+    port: int = 9095,
+    path: str = "/alertmanager",
+    token: Optional[str] = None,
+    max_body_size: int = 1024 * 1024,
+    request_timeout: float = 10.0,
+  ):
+    self.plugin = plugin
+    self.handler = handler
+    self.host = host
+    self.port = port
+    self.path = path
+    self.token = token
+    self.max_body_size = max_body_size
+    self.request_timeout = request_timeout
+    self.server: Optional[asyncio.base_events.Server] = None
+
+  async def start(self):
+    self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+    self.port = self.server.sockets[0].getsockname()[1]
+    self.plugin.log_info(f"alertmanager webhook listening on {self.host}:{self.port}{self.path}")
+
+  async def stop(self):
+    if self.server:
+      self.server.close()
+      await self.server.wait_closed()
+      self.server = None
+
+  async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+      status = await asyncio.wait_for(self._handle_request(reader), timeout=self.request_timeout)
+    except asyncio.TimeoutError:
+      status = 408
+    except (ValueError, UnicodeDecodeError, asyncio.IncompleteReadError) as e:
+      self.plugin.log_warning(f"invalid webhook request: {e}")
+      status = 400
+    except Exception as e:
+      self.plugin.log_error(f"webhook handler failed: {e}")
+      status = 500
+
+    body = json.dumps({"status": HTTP_REASONS[status]}).encode()
+    writer.write(
+      f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+      f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+      + body
+    )
+    try:
+      await writer.drain()
+    finally:
+      writer.close()
+
+  async def _read_head(self, reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str]]:
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    method, target, _ = request_line.split(" ", 2)
+    headers = {}
+    while line := (await reader.readline()).decode("latin-1").strip():
+      key, value = line.split(":", 1)
+      headers[key.strip().lower()] = value.strip()
+    return method, target.split("?", 1)[0], headers
+
+  def _is_authorized(self, headers: Dict[str, str]) -> bool:
+    if not self.token:
+      return True
+    return hmac.compare_digest(headers.get("authorization", ""), f"Bearer {self.token}")
+
+  async def _handle_request(self, reader: asyncio.StreamReader) -> int:
+    method, path, headers = await self._read_head(reader)
+    if path != self.path:
+      return 404
+    if method != "POST":
+      return 405
+    if not self._is_authorized(headers):
+      self.plugin.log_warning("unauthorized alertmanager webhook request")
+      return 401
+
+    length = int(headers.get("content-length", 0))
+    if length > self.max_body_size:
+      return 413
+
+    payload = json.loads(await reader.readexactly(length))
+    if not isinstance(payload, dict) or not isinstance(payload.get("alerts"), list):
+      raise ValueError("payload is not an alertmanager webhook message")
+
+    self.plugin.log_info(f"received {len(payload['alerts'])} alerts from webhook ({payload.get('status', 'unknown')})")
+    await self.handler(payload)
+    return 200
@@ -1,6 +1,10 @@
+from typing import List
+
 from telegram import Update
 from telegram.ext import ContextTypes
+from telegram.ext import JobQueue
 
+from lotb.common.maintenance import RetentionPolicy
 from lotb.common.plugin_class import PluginBase
 from lotb.plugins._llm.assistant import AssistantHandler
 from lotb.plugins._llm.config import LLMConfig
@@ -40,6 +44,24 @@ class Plugin(PluginBase):
     self.handler.initialize()
     self.log_info(self.config_handler.get_info())
 
+  def set_job_queue(self, job_queue: JobQueue):
+    if self.handler:
+      self.handler.set_job_queue(job_queue)
+
+  async def shutdown(self):
+    if self.handler:
+      self.handler.history.flush()
+      self.handler.usage.flush()
+
+  def retention_policies(self) -> List[RetentionPolicy]:
+    # the rollups keep the lifetime totals, only the raw usage log is pruned
+    return [
+      RetentionPolicy("llm", "timestamp", days=30),
+      RetentionPolicy("llm_compacted", "timestamp", days=30),
+      RetentionPolicy("llm_usage", "timestamp", days=90),
+      RetentionPolicy("llm_memory", "timestamp", days=365),
+    ]
+
   async def execute(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
     if self.handler:
       await self.handler.execute(update, context)
@@ -1,145 +1,200 @@
-from collections import defaultdict
+import asyncio
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 import httpx
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.ext import JobQueue
 
+from lotb.common.maintenance import RetentionPolicy
 from lotb.common.plugin_class import PluginBase
+from lotb.plugins._prometheus_alerts.endpoints import AlertmanagerEndpoint
+from lotb.plugins._prometheus_alerts.endpoints import parse_endpoints
+from lotb.plugins._prometheus_alerts.render import AlertRenderer
+from lotb.plugins._prometheus_alerts.render import AlertThrottle
+from lotb.plugins._prometheus_alerts.state import AlertStateTracker
+from lotb.plugins._prometheus_alerts.webhook import AlertWebhookReceiver
 
 
 class Plugin(PluginBase):
   def __init__(self):
-    super().__init__("prometheus_alerts", "Fetch and send prometheus alerts", require_auth=False)
+    super().__init__(
+      "prometheus_alerts", "Fetch and send prometheus alerts, /prometheus_alerts status for health", require_auth=False
+    )
     self.job_queue = None
+    self.webhook = None
+    self.webhook_context = None
 
   def initialize(self):
     plugin_config = self.config.get(f"plugins.{self.name}", {})
-    self.prometheusUrl = plugin_config.get("prometheusUrl")
+    self.endpoints = parse_endpoints(plugin_config)
     self.alert_interval = plugin_config.get("alert_interval", 120)
     self.chat_id = plugin_config.get("chatid")
 
-    if not self.prometheusUrl or not self.chat_id:
-      raise ValueError("Prometheus URL and chat ID must be specified in the configuration.")
+    if not self.endpoints or not self.chat_id:
+      raise ValueError("Prometheus URL (or alertmanagers) and chat ID must be specified in the configuration.")
+
+    self.renderer = AlertRenderer(self)
+    self.throttle = AlertThrottle(float(plugin_config.get("throttle_window", 5)) * 60)
+    self.send_resolved = str(plugin_config.get("send_resolved", True)).lower() not in ("false", "0", "no")
+
+    self.state = AlertStateTracker(self, [endpoint.name for endpoint in self.endpoints])
+    self.state.create_table()
+    self.state.load()
+
+    if str(plugin_config.get("webhook", False)).lower() in ("true", "1", "yes"):
+      self.webhook = AlertWebhookReceiver(
+        self,
+        self.handle_webhook,
+        host=plugin_config.get("webhook_host", "0.0.0.0"),
+        port=int(plugin_config.get("webhook_port", 9095)),
+        path=plugin_config.get("webhook_path", "/alertmanager"),
+        token=plugin_config.get("webhook_token"),
+      )
+      # alerts are pushed, polling is only a reconciliation pass for missed webhooks and resolutions
+      self.alert_interval = plugin_config.get("reconcile_interval", self.alert_interval)
 
-    self.create_table("""
-        CREATE TABLE IF NOT EXISTS alerts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            alert_name TEXT,
-            alert_severity TEXT,
-            alert_description TEXT,
-            alert_labels TEXT,
-            alert_hash TEXT UNIQUE,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+    self.log_info(f"Prometheus Alerts plugin initialized with endpoints: {', '.join(e.url for e in self.endpoints)}")
 
-    self.log_info(f"Prometheus Alerts plugin initialized with URL: {self.prometheusUrl}")
+  def retention_policies(self) -> List[RetentionPolicy]:
+    # alert_state only holds the active alerts, the legacy hash based table is pruned until it is empty
+    return [RetentionPolicy("alerts", "timestamp", days=30)]
 
   def set_job_queue(self, job_queue: JobQueue):
     self.job_queue = job_queue
-    self.job_queue.run_repeating(self.fetch_and_store_alerts, interval=self.alert_interval * 60, first=0)
+    self.job_queue.run_repeating(self.fetch_and_store_alerts, interval=float(self.alert_interval) * 60, first=0)
     self.log_info(f"Job queue set to fetch alerts every {self.alert_interval} minutes")
+    if self.throttle.window_seconds > 0:
+      interval = min(60.0, self.throttle.window_seconds)
+      self.job_queue.run_repeating(self.send_deferred_alerts, interval=interval, first=interval)
+    if self.webhook:
+      self.job_queue.run_once(self.start_webhook, when=0)
+
+  async def start_webhook(self, context: ContextTypes.DEFAULT_TYPE):
+    if not self.webhook:
+      return
+    self.webhook_context = context
+    try:
+      await self.webhook.start()
+    except OSError as e:
+      self.log_error(f"Failed to start alertmanager webhook: {e}")
+
+  async def handle_webhook(self, payload):
+    firing, resolved = self.state.update(payload.get("alerts", []))
+    self.state.persist()
+    self.log_info(f"webhook: {len(firing)} new alerts, {len(resolved)} resolved, {len(self.state.active)} active")
+    if not self.webhook_context:
+      return
+    try:
+      await self.notify(self.webhook_context, firing, resolved)
+    except Exception as e:
+      self.log_error(f"Failed to send webhook alerts: {e}")
+
+  async def fetch_prometheus_alerts(
+    self, endpoint: Optional[AlertmanagerEndpoint] = None, client: Optional[httpx.AsyncClient] = None
+  ):
+    endpoint = endpoint or self.endpoints[0]
+    if client is None:
+      async with httpx.AsyncClient() as client:
+        return await self.fetch_prometheus_alerts(endpoint, client)
+
+    response = await client.get(f"{endpoint.url}/api/v2/alerts", timeout=endpoint.timeout)
+    self.log_info(f"Received response status code from {endpoint.name}: {response.status_code}")
+    response.raise_for_status()
+    alerts = response.json()
+    self.log_debug(f"Response content from {endpoint.name}: {alerts}")
+    return alerts
+
+  def store_alerts(self, alerts, source: Optional[str] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    firing, resolved = self.state.reconcile(alerts, source or self.endpoints[0].name)
+    self.state.persist()
+    self.log_info(f"{len(firing)} new alerts, {len(resolved)} resolved, {len(self.state.active)} active")
+    return firing, resolved
+
+  async def send_alerts(self, context: ContextTypes.DEFAULT_TYPE, alerts, resolved: bool = False):
+    if not alerts:
+      self.log_info(f"No {'resolved' if resolved else 'new'} alerts to send.")
+      return
 
-  async def fetch_prometheus_alerts(self):
-    async with httpx.AsyncClient() as client:
-      response = await client.get(f"{self.prometheusUrl}/api/v2/alerts")
-      self.log_info(f"Received response status code: {response.status_code}")
-      response.raise_for_status()
-      self.log_info(f"Response content: {response.json()}")
-      return response.json()
-
-  def store_alerts(self, alerts):
-    new_alerts = []
-    for alert in alerts:
-      self.log_info(alert)
-      labels = alert.get("labels", {})
-      alert_name = labels.get("alertname", "Unknown")
-      alert_severity = labels.get("severity", "Unknown")
-      alert_description = alert.get("annotations", {}).get("description", "No description")
-      alert_active = alert.get("startsAt", "Unknown")
-
-      alert_hash = hash(f"{alert_name}{alert_severity}{alert_description}{alert_active}{str(labels)}")
-      self.log_info(f"Name: {alert_name}, hash: {alert_hash}")
-
+    # throttled per alert, a group can hold a new instance next to one notified a minute ago
+    allowed = self.throttle.filter(alerts, resolved)
+    if not allowed:
+      self.log_info(f"All {len(alerts)} alerts throttled, nothing to send.")
+      return
+    await self.deliver(context, allowed, resolved)
+
+  async def send_deferred_alerts(self, context: ContextTypes.DEFAULT_TYPE):
+    """state changes held back by the throttle, sent once their window expired"""
+    firing, resolved = self.throttle.due()
+    if firing:
+      await self.deliver(context, firing)
+    if resolved:
+      await self.deliver(context, resolved, resolved=True)
+
+  async def deliver(self, context: ContextTypes.DEFAULT_TYPE, alerts, resolved: bool = False):
+    grouped_alerts = self.renderer.group(alerts)
+    messages = self.renderer.render(grouped_alerts, resolved)
+    sent = 0
+    for message in messages:
       try:
-        cursor = self.connection.cursor()
-        cursor.execute("SELECT COUNT(*) FROM alerts WHERE alert_hash = ?", (alert_hash,))
-        count = cursor.fetchone()[0]
-
-        if count == 0:
-          self.log_info(f"Alert does not exist, storing it with hash: {alert_hash}")
-          cursor.execute(
-            "INSERT INTO alerts (alert_name, alert_severity, alert_description, alert_labels, alert_hash) VALUES (?, ?, ?, ?, ?)",
-            (alert_name, alert_severity, alert_description, str(labels), alert_hash),
-          )
-          self.connection.commit()
-          new_alerts.append(alert)
-          self.log_info(f"Stored alert: {alert_name}")
-        else:
-          self.log_info(f"Alert already exists: {alert_name}")
+        await context.bot.send_message(chat_id=self.chat_id, text=message, parse_mode="MarkdownV2")
+        sent += 1
       except Exception as e:
-        self.log_error(f"Error storing alert: {e}")
-
-    return new_alerts
-
-  async def send_alerts(self, context: ContextTypes.DEFAULT_TYPE, alerts):
-    if not alerts:
-      self.log_info("No new alerts to send.")
+        self.log_error(f"Failed to send alert message ({len(message)} chars): {e}")
+    self.log_info(
+      f"Sent {len(grouped_alerts)} grouped alerts in {sent}/{len(messages)} messages to chat ID {self.chat_id}"
+    )
+
+  async def notify(self, context: ContextTypes.DEFAULT_TYPE, firing, resolved):
+    await self.send_alerts(context, firing)
+    if self.send_resolved:
+      await self.send_alerts(context, resolved, resolved=True)
+
+  async def poll_endpoint(
+    self, context: ContextTypes.DEFAULT_TYPE, endpoint: AlertmanagerEndpoint, client: httpx.AsyncClient
+  ):
+    started = time.monotonic()
+    try:
+      alerts = await asyncio.wait_for(self.fetch_prometheus_alerts(endpoint, client), timeout=endpoint.timeout)
+    except asyncio.TimeoutError:
+      endpoint.record_failure(f"timeout after {endpoint.timeout}s", started)
+      self.log_warning(f"Alertmanager {endpoint.name} timed out after {endpoint.timeout}s")
+      return
+    except Exception as e:
+      endpoint.record_failure(str(e) or type(e).__name__, started)
+      self.log_error(f"Failed to fetch alerts from {endpoint.name}: {e}")
       return
 
-    # super ugly way to group alerts by name, severity, and description
-    # TODO: refactor this to be less ugly and more readable
-    grouped_alerts = defaultdict(list)
-    for alert in alerts:
-      key = (
-        alert.get("labels", {}).get("alertname", "Unknown"),
-        alert.get("labels", {}).get("severity", "Unknown"),
-        alert.get("annotations", {}).get("description", "No description"),
-      )
-      grouped_alerts[key].append(alert)
-
-    alert_messages = []
-    for (alert_name, severity, description), group in grouped_alerts.items():
-      severity_emoji = {"critical": "🚨", "warning": "⚠️", "info": "ℹ️"}.get(severity.lower(), "❓")
-
-      merged_labels = defaultdict(set)
-      for alert in group:
-        for key, value in alert.get("labels", {}).items():
-          if key not in ("alertname", "severity"):
-            merged_labels[key].add(value)
-
-      formatted_labels = []
-      for key, values in merged_labels.items():
-        if len(values) == 1:
-          formatted_labels.append(f"  • `{key}`: `{next(iter(values))}`")
-        else:
-          formatted_labels.append(f"  • `{key}`:")
-          for value in values:
-            formatted_labels.append(f"    ◦ `{value}`")
-
-      group_message = (
-        f"{severity_emoji} *Alert*: `{self.escape_markdown(alert_name)}`\n"
-        f"*Severity*: `{self.escape_markdown(severity)}`\n"
-        f"*Description*: {self.escape_markdown(description)}\n"
-        "*Labels*:\n" + "\n".join(formatted_labels)
-      )
-      alert_messages.append(group_message)
-
-    message = "\n\n".join(alert_messages)
-    await context.bot.send_message(chat_id=self.chat_id, text=message, parse_mode="MarkdownV2")
-    self.log_info(f"Sent {len(alert_messages)} grouped alerts to chat ID {self.chat_id}")
+    endpoint.record_success(len(alerts), started)
+    # every endpoint is reconciled and notified on its own, a slow region never delays the others
+    firing, resolved = self.store_alerts(alerts, endpoint.name)
+    await self.notify(context, firing, resolved)
 
   async def fetch_and_store_alerts(self, context: ContextTypes.DEFAULT_TYPE):
     try:
-      alerts = await self.fetch_prometheus_alerts()
-      self.log_info(f"Fetched alerts: {alerts}")
-      self.log_info("1 {alerts}")
-      new_alerts = self.store_alerts(alerts)
-      self.log_info("2 {new_alerts}")
-      await self.send_alerts(context, new_alerts)
+      async with httpx.AsyncClient() as client:
+        await asyncio.gather(*(self.poll_endpoint(context, endpoint, client) for endpoint in self.endpoints))
     except Exception as e:
       self.log_error(f"Failed to fetch and store alerts: {e}")
 
+  async def show_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = [endpoint.describe() for endpoint in self.endpoints]
+    webhook = f"listening on port {self.webhook.port}" if self.webhook and self.webhook.server else "disabled"
+    status = (
+      "📡 Alertmanager status\n\n"
+      + "\n".join(lines)
+      + f"\n\nactive alerts: {len(self.state.active)}\nwebhook: {webhook}"
+      + f"\npolling every {self.alert_interval} minutes"
+    )
+    await self.reply_message(update, context, status)
+
   async def execute(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args and context.args[0] == "status":
+      await self.show_status(update, context)
+      return
     await self.reply_message(update, context, "The plugin is running in background.")
@@ -9,6 +9,7 @@ from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.ext import JobQueue
 
+from lotb.common.maintenance import RetentionPolicy
 from lotb.common.plugin_class import PluginBase
 
 
@@ -40,16 +41,29 @@ class Plugin(PluginBase):
             article_id TEXT,
             title TEXT,
             link TEXT,
-            published TIMESTAMP
+            published TIMESTAMP,
+            seen TIMESTAMP
         )
         """
     self.db_cursor.execute(query)
+    columns = [row[1] for row in self.db_cursor.execute("PRAGMA table_info(articles)").fetchall()]
+    if columns and "seen" not in columns:
+      # tables created before the column existed, their articles count as seen now
+      self.db_cursor.execute("ALTER TABLE articles ADD COLUMN seen TIMESTAMP")
+      self.db_cursor.execute("UPDATE articles SET seen = CURRENT_TIMESTAMP WHERE seen IS NULL")
+    self.db_cursor.execute("DROP INDEX IF EXISTS articles_published_idx")
+    self.db_cursor.execute("CREATE INDEX IF NOT EXISTS articles_seen_idx ON articles (seen)")
     self.connection.commit()
 
+  def retention_policies(self) -> List[RetentionPolicy]:
+    # the rows are the only record of what was sent, they go once the article has left the feed for a year,
+    # pruning on published would drop old articles still listed and send them again
+    return [RetentionPolicy("articles", "seen", days=365)]
+
   def get_last_articles_sorted(self, feed_url: str, num_articles: int) -> List[Any]:
     feed = feedparser.parse(feed_url)
     sorted_entries = sorted(feed.entries, key=lambda entry: parser.parse(entry.published))
-    last_articles = sorted_entries[:num_articles]
+    last_articles = sorted_entries[-num_articles:]
     return last_articles
 
   async def check_feeds(self, context: ContextTypes.DEFAULT_TYPE):
@@ -59,6 +73,7 @@ class Plugin(PluginBase):
       feed_url = feed["url"]
       self.log_info(f"Checking feed: {feed_name}")
       feed_data = self.get_last_articles_sorted(feed_url, 5)
+      listed = []
       for entry in feed_data:
         article_id = entry.id
         if not self.article_exists(feed_name, article_id):
@@ -66,16 +81,28 @@ class Plugin(PluginBase):
           message = f"New article from {feed_name}: {entry.title}\n{entry.link}"
           await context.bot.send_message(chat_id=self.chat_id, text=message)
           self.log_info(f"Sent new article: {entry.title}")
+        else:
+          listed.append(article_id)
+      self.mark_seen(feed_name, listed)
 
   def article_exists(self, feed_name, article_id):
     query = "SELECT 1 FROM articles WHERE feed_name = ? AND article_id = ?"
     self.db_cursor.execute(query, (feed_name, article_id))
     return self.db_cursor.fetchone() is not None
 
+  def mark_seen(self, feed_name, article_ids):
+    """articles still listed in the feed are kept by the retention policy"""
+    if not article_ids:
+      return
+    placeholders = ", ".join("?" for _ in article_ids)
+    query = f"UPDATE articles SET seen = CURRENT_TIMESTAMP WHERE feed_name = ? AND article_id IN ({placeholders})"
+    self.db_cursor.execute(query, (feed_name, *article_ids))
+    self.connection.commit()
+
   def save_article(self, feed_name, entry):
     query = """
-        INSERT INTO articles (feed_name, article_id, title, link, published)
-        VALUES (?, ?, ?, ?, ?)
+        INSERT INTO articles (feed_name, article_id, title, link, published, seen)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
         """
     self.db_cursor.execute(query, (feed_name, entry.id, entry.title, entry.link, datetime(*entry.published_parsed[:6])))
     self.connection.commit()
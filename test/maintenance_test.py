@@ -0,0 +1,127 @@
+import asyncio
+import sqlite3
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+from lotb.common.maintenance import DatabaseMaintenance
+from lotb.common.maintenance import RetentionPolicy
+
+
+@pytest.fixture
+def database(tmp_path):
+  path = str(tmp_path / "lotb.db")
+  connection = sqlite3.connect(path)
+  connection.execute("CREATE TABLE articles (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, published TIMESTAMP)")
+  connection.executemany(
+    "INSERT INTO articles (title, published) VALUES (?, datetime('now', ?))",
+    [("old" * 200, "-400 days")] * 1200 + [("new", "-1 days")] * 10,
+  )
+  connection.commit()
+  connection.close()
+  return path
+
+
+def make_maintenance(database, plugins, maintenance_config=None):
+  config = MagicMock()
+  config.get.side_effect = lambda key, default=None: {
+    "core.database": database,
+    "core.maintenance": maintenance_config or {},
+  }.get(key, default)
+  return DatabaseMaintenance(config, plugins)
+
+
+def make_plugin(*policies):
+  plugin = MagicMock()
+  plugin.retention_policies.return_value = list(policies)
+  return plugin
+
+
+def test_retention_policy_rejects_invalid_identifiers():
+  with pytest.raises(ValueError):
+    RetentionPolicy("articles; DROP TABLE llm", "published")
+
+
+def test_collect_policies_config_override():
+  plugins = {
+    "rssfeed": make_plugin(RetentionPolicy("articles", "published", days=365)),
+    "prometheus_alerts": make_plugin(RetentionPolicy("alerts", "timestamp", days=30)),
+  }
+  maintenance = make_maintenance(":memory:", plugins, {"retention": {"articles": "7", "alerts": 0}})
+
+  policies = maintenance.collect_policies()
+
+  assert len(policies) == 1
+  assert policies[0].table == "articles"
+  assert policies[0].days == 7
+
+
+@pytest.mark.asyncio
+async def test_run_prunes_in_batches_and_reclaims_space(database):
+  plugins = {"rssfeed": make_plugin(RetentionPolicy("articles", "published", days=365))}
+  maintenance = make_maintenance(database, plugins, {"batch_size": 500})
+
+  report = await maintenance.run()
+  maintenance.close()
+
+  assert report["deleted"] == {"articles": 1200}
+  assert report["reclaimed"] > 0
+  connection = sqlite3.connect(database)
+  assert connection.execute("SELECT COUNT(*) FROM articles").fetchone()[0] == 10
+  assert connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+@pytest.mark.asyncio
+async def test_run_skips_missing_tables(database):
+  plugins = {"llm": make_plugin(RetentionPolicy("llm", "timestamp", days=30))}
+  maintenance = make_maintenance(database, plugins)
+
+  report = await maintenance.run()
+
+  assert report["deleted"] == {"llm": 0}
+
+
+def test_set_job_queue_skips_memory_database():
+  job_queue = MagicMock()
+  maintenance = make_maintenance(":memory:", {})
+  maintenance.set_job_queue(job_queue)
+  job_queue.run_repeating.assert_not_called()
+
+
+def test_set_job_queue_schedules(database):
+  job_queue = MagicMock()
+  maintenance = make_maintenance(database, {}, {"interval": "12"})
+  maintenance.set_job_queue(job_queue)
+  job_queue.run_repeating.assert_called_once_with(maintenance.run, interval=12 * 3600, first=60)
+
+
+@pytest.mark.asyncio
+async def test_run_works_off_the_event_loop(database):
+  plugins = {"rssfeed": make_plugin(RetentionPolicy("articles", "published", days=365))}
+  maintenance = make_maintenance(database, plugins, {"batch_size": 100})
+  threads = set()
+  prune_table = maintenance.prune_table
+
+  def recording_prune_table(policy):
+    threads.add(threading.get_ident())
+    return prune_table(policy)
+
+  maintenance.prune_table = recording_prune_table
+  ticks = 0
+
+  async def ticker():
+    nonlocal ticks
+    while True:
+      ticks += 1
+      await asyncio.sleep(0)
+
+  task = asyncio.create_task(ticker())
+  report = await maintenance.run()
+  task.cancel()
+
+  assert report["deleted"] == {"articles": 1200}
+  assert threads and threading.get_ident() not in threads
+  assert ticks > 0
+  # the connection belongs to the worker thread, it is closed with the run
+  assert maintenance.connection is None
@@ -1,15 +1,20 @@
 import logging
+import sqlite3
 from unittest.mock import AsyncMock
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
 import httpx
+import litellm
 import pytest
 from telegram import Update
 from telegram.ext import ContextTypes
 
+from lotb.common.llm_cache import LLMResponseCache
+from lotb.common.llm_cache import response_cache_key
 from lotb.common.plugin_class import PluginBase
 from lotb.common.plugin_class import SecurityValidator
+from lotb.common.security import RuleSet
 
 
 class MockPlugin(PluginBase):
@@ -58,6 +63,32 @@ def test_security_validator_llm_validate_tool_name_blocked(security_validator):
   assert "blocked" in msg
 
 
+def test_security_validator_reports_the_matching_rule(security_validator):
+  is_valid, msg = security_validator.validate_user_input("click <a onclick=steal()>here</a>")
+  assert not is_valid
+  assert msg.endswith("on\\w+=")
+  assert security_validator.validate_user_input("x" * 100_000) == (True, "")
+
+
+def test_security_validator_caches_tool_verdicts(security_validator):
+  assert security_validator.validate_catalog(["get_data", "drop_table", "run_CMD"]) == ["drop_table", "run_CMD"]
+  security_validator._blocked_tools = RuleSet([])
+  assert security_validator.llm_validate_tool_name("drop_table")[0] is False
+  assert security_validator.llm_validate_tool_name("exec_shell")[0] is True
+
+
+def test_security_validator_is_shared_per_rule_set():
+  first = MockPlugin()
+  second = MockPlugin()
+  assert first.security_validator is second.security_validator
+  custom = SecurityValidator.from_config({"blocked_tool_patterns": ["^pay"], "suspicious_content_patterns": []})
+  assert custom is SecurityValidator.from_config({"blocked_tool_patterns": ["^pay"], "suspicious_content_patterns": []})
+  assert custom is not first.security_validator
+  assert custom.llm_validate_tool_name("pay_invoice")[0] is False
+  assert custom.llm_validate_tool_name("exec_shell")[0] is True
+  assert custom.validate_user_input("<script>alert(1)</script>") == (True, "")
+
+
 def test_plugin_base_escape_markdown():
   text = "Hello _world_ *with* [markdown]"
   escaped = PluginBase.escape_markdown(None, text)
@@ -258,6 +289,60 @@ async def test_plugin_base_llm_completion_default_model(mock_acompletion, mock_p
   mock_acompletion.assert_called()
 
 
+@pytest.mark.asyncio
+@patch("litellm.acompletion")
+async def test_plugin_base_llm_completion_response_cache(mock_acompletion, mock_plugin):
+  mock_acompletion.return_value = litellm.ModelResponse(
+    model="test-model",
+    choices=[{"message": {"role": "assistant", "content": "42"}}],
+    usage={"prompt_tokens": 30, "completion_tokens": 12, "total_tokens": 42},
+  )
+  mock_plugin.connection = sqlite3.connect(":memory:")
+  mock_plugin.enable_llm_cache(ttl=60, max_entries=10)
+
+  first = await mock_plugin.llm_completion(
+    [{"role": "user", "content": "What is  the answer?"}], "test-model", cache=True
+  )
+  second = await mock_plugin.llm_completion(
+    [{"role": "user", "content": "What is the answer? "}], "test-model", cache=True
+  )
+  await mock_plugin.llm_completion([{"role": "user", "content": "what is the answer?"}], "other-model", cache=True)
+  await mock_plugin.llm_completion([{"role": "user", "content": "what is the answer?"}], "test-model")
+
+  assert first.choices[0].message.content == second.choices[0].message.content == "42"
+  assert second._hidden_params["cache_hit"] and not first._hidden_params.get("cache_hit")
+  assert mock_acompletion.call_count == 3
+  assert mock_plugin.llm_cache.stats() == {
+    "hits": 1,
+    "misses": 2,
+    "hit_rate": 1 / 3,
+    "saved_tokens": 42,
+    "entries": 2,
+  }
+
+
+def test_response_cache_key_normalizes_whitespace_only():
+  key = response_cache_key("m", [{"role": "user", "content": "What is  LOTB?"}], {})
+  assert key == response_cache_key("m", [{"role": "user", "content": " What is LOTB?\n"}], {})
+  assert key != response_cache_key("m", [{"role": "user", "content": "what is lotb?"}], {})
+
+
+def test_llm_response_cache_expiry_and_size_limit():
+  cache = LLMResponseCache(sqlite3.connect(":memory:"), ttl=60, max_entries=2)
+  cache.create_table()
+  response = litellm.ModelResponse(model="m", choices=[{"message": {"role": "assistant", "content": "hi"}}])
+  for key in ("a", "b", "c"):
+    cache.set(key, "m", response)
+
+  assert cache.get("a") is None
+  assert cache.get("c").choices[0].message.content == "hi"
+
+  cache.ttl = -1
+  cache.set("d", "m", response)
+  assert cache.get("d") is None
+  assert cache.stats()["entries"] == 2
+
+
 @pytest.mark.asyncio
 async def test_plugin_base_execute_not_implemented(mock_update, mock_context):
   plugin = PluginBase("test", "test plugin")
@@ -1,11 +1,43 @@
+import asyncio
+import io
 import json
 from unittest.mock import AsyncMock
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
+import anyio
+import litellm
+import numpy as np
 import pytest
-
+from PIL import Image
+
+from benchmarks.standins import MCPStandin
+from benchmarks.standins import OpenAIStandin
+from lotb.plugins._llm.admission import AdmissionController
+from lotb.plugins._llm.budget import LoopBudget
+from lotb.plugins._llm.cache import cache_key
+from lotb.plugins._llm.cache import ResultCache
+from lotb.plugins._llm.compaction import HistoryCompactor
+from lotb.plugins._llm.config import LLMConfig
+from lotb.plugins._llm.context import ContextBuilder
+from lotb.plugins._llm.context import count_tokens
+from lotb.plugins._llm.history import ConversationHistory
+from lotb.plugins._llm.mcp_manager import MCPManager
+from lotb.plugins._llm.media import MediaCache
+from lotb.plugins._llm.memory import ChatIndex
+from lotb.plugins._llm.memory import HashingEmbeddings
+from lotb.plugins._llm.memory import normalize
+from lotb.plugins._llm.memory import RetrievalMemory
+from lotb.plugins._llm.prompt_cache import canonical_tools
+from lotb.plugins._llm.prompt_cache import with_cache_control
+from lotb.plugins._llm.prompts import PARTIAL_ANSWER_PROMPT
 from lotb.plugins._llm.prompts import SIMPLE_LLM_ROLE
+from lotb.plugins._llm.router import ModelRouter
+from lotb.plugins._llm.streaming import stream_deltas
+from lotb.plugins._llm.streaming import StreamingReply
+from lotb.plugins._llm.tool_handler import ToolHandler
+from lotb.plugins._llm.tool_ranker import ToolRanker
+from lotb.plugins._llm.usage import usage_scope
 from lotb.plugins.llm import Plugin
 
 
@@ -79,11 +111,33 @@ async def test_simple_llm_success(mock_update, mock_context, simple_plugin):
       messages=[{"role": "system", "content": SIMPLE_LLM_ROLE}, {"role": "user", "content": "hello my dear assistant"}],
       model="closed-ai-gpt44",
       api_key="soon-I-will-be-leaked",
+      cache=False,
     )
     mock_typing.assert_called_once_with(mock_update, mock_context)
     mock_update.message.reply_text.assert_called_once_with("Hello Boss, how is going?")
 
 
+@pytest.mark.asyncio
+async def test_simple_llm_caches_only_questions_without_history(mock_update, mock_context, simple_plugin):
+  simple_plugin.handler.config.response_cache = True
+  mock_update.message.text = "/llm what is the capital of italy?"
+
+  with (
+    patch(
+      "lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=summary_response("Rome"))
+    ) as mock_llm,
+    patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()),
+  ):
+    await simple_plugin.execute(mock_update, mock_context)
+    assert mock_llm.call_args.kwargs["cache"] is True
+
+    # a follow up depends on the turns before it
+    mock_update.message.text = "/llm and of france?"
+    await simple_plugin.execute(mock_update, mock_context)
+    assert len(mock_llm.call_args.kwargs["messages"]) > 2
+    assert mock_llm.call_args.kwargs["cache"] is False
+
+
 @pytest.mark.asyncio
 async def test_simple_llm_api_error(mock_update, mock_context, simple_plugin):
   mock_update.message.text = "/llm hello my dear assistant"
@@ -126,6 +180,7 @@ async def test_simple_llm_with_quoted_message(mock_update, mock_context, simple_
       ],
       model="closed-ai-gpt44",
       api_key="soon-I-will-be-leaked",
+      cache=False,
     )
 
 
@@ -334,16 +389,122 @@ async def test_assistant_blocked_input(assistant_plugin, mock_update, mock_conte
 @pytest.mark.asyncio
 async def test_assistant_ensure_tools_loaded(assistant_plugin):
   with (
-    patch.object(assistant_plugin.handler.mcp, "load_all_tools", new_callable=AsyncMock) as mock_tools,
-    patch.object(assistant_plugin.handler.mcp, "load_all_resources", new_callable=AsyncMock) as mock_resources,
+    patch.object(assistant_plugin.handler.mcp, "list_tools", new_callable=AsyncMock) as mock_tools,
+    patch.object(assistant_plugin.handler.mcp, "list_resources", new_callable=AsyncMock) as mock_resources,
     patch.object(assistant_plugin.handler.tool_handler, "create_resource_tools", new_callable=AsyncMock) as mock_create,
   ):
     mock_tools.return_value = []
     mock_resources.return_value = []
     mock_create.return_value = []
     await assistant_plugin.handler._ensure_tools_loaded()
-    mock_tools.assert_called()
-    mock_resources.assert_called()
+    assert mock_tools.call_count == 2
+    assert mock_resources.call_count == 2
+
+
+def fake_tool(name):
+  return {"type": "function", "function": {"name": name, "description": name}}
+
+
+def slow_server_listing(slow_server, delay):
+  async def list_tools(server):
+    if server["name"] == slow_server:
+      await asyncio.sleep(delay)
+    return [fake_tool(f"{server['name']}_tool")]
+
+  return list_tools
+
+
+@pytest.mark.asyncio
+async def test_assistant_discovery_returns_partial_results(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.config.discovery_wait = 0.2
+  with (
+    patch.object(handler.mcp, "list_tools", side_effect=slow_server_listing("mcp-server-avengers", 30)),
+    patch.object(handler.mcp, "list_resources", new=AsyncMock(return_value=[])),
+  ):
+    tools = await handler._ensure_tools_loaded()
+
+    assert [tool["function"]["name"] for tool in tools] == ["free-money-mcp-server_tool"]
+    assert handler.discovery_in_progress
+    assert "free-money-mcp-server_tool" in handler.capabilities_summary
+    handler._discovery_task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_mcp_discovery_skips_servers_past_timeout(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.mcp.discovery_timeout = 0.2
+  with (
+    patch.object(handler.mcp, "list_tools", side_effect=slow_server_listing("free-money-mcp-server", 30)),
+    patch.object(handler.mcp, "list_resources", new=AsyncMock(return_value=[])),
+  ):
+    await handler.start_discovery()
+
+  assert [tool["function"]["name"] for tool in handler.tools] == ["mcp-server-avengers_tool"]
+  assert not handler.discovery_in_progress
+  assert list(handler.mcp.tool_to_server_map) == ["mcp-server-avengers_tool"]
+
+
+@pytest.mark.asyncio
+async def test_assistant_catalog_refresh_applies_only_changes(assistant_plugin, mock_context):
+  handler = assistant_plugin.handler
+  catalogs = {
+    "free-money-mcp-server": [fake_tool("pay"), fake_tool("refund")],
+    "mcp-server-avengers": [fake_tool("assemble")],
+  }
+
+  async def list_tools(server):
+    return catalogs[server["name"]]
+
+  with (
+    patch.object(handler.mcp, "list_tools", side_effect=list_tools),
+    patch.object(handler.mcp, "list_resources", new=AsyncMock(return_value=[])),
+    patch.object(handler, "_generate_capabilities_summary", wraps=handler._generate_capabilities_summary) as summary,
+  ):
+    await handler.start_discovery()
+    assert summary.call_count == 2
+    version = handler.mcp.catalog_version
+
+    await handler.refresh_catalog(mock_context)
+    assert summary.call_count == 2
+    assert handler.mcp.catalog_version == version
+
+    catalogs["free-money-mcp-server"] = [fake_tool("pay"), fake_tool("invest")]
+    await handler.refresh_catalog(mock_context)
+    assert summary.call_count == 3
+    assert sorted(handler.mcp.tool_to_server_map) == ["assemble", "invest", "pay"]
+    assert [tool["function"]["name"] for tool in handler.tools] == ["assemble", "invest", "pay"]
+    assert "invest" in handler.capabilities_summary and "refund" not in handler.capabilities_summary
+
+    catalogs["mcp-server-avengers"] = None
+    await handler.refresh_catalog(mock_context)
+    assert summary.call_count == 3
+    assert handler.mcp.tool_to_server_map["assemble"]["name"] == "mcp-server-avengers"
+
+
+@pytest.mark.asyncio
+async def test_mcp_discovery_loads_servers_concurrently():
+  async with MCPStandin(tools=2, name="first") as first, MCPStandin(tools=3, name="second") as second:
+    manager = MCPManager(MagicMock(), [first.server_cfg, second.server_cfg])
+    loaded = []
+
+    async def on_server_loaded(server):
+      loaded.append(server["name"])
+
+    await manager.discover(on_server_loaded)
+    tools, resources = manager.catalog()
+
+    assert sorted(loaded) == ["first", "second"]
+    assert [tool["function"]["name"] for tool in tools] == [
+      "first_tool_0",
+      "first_tool_1",
+      "second_tool_0",
+      "second_tool_1",
+      "second_tool_2",
+    ]
+    assert len(resources) == 4
+    assert manager.tool_to_server_map["second_tool_2"]["name"] == "second"
+    await manager.session_manager.close()
 
 
 @pytest.mark.asyncio
@@ -443,6 +604,59 @@ async def test_assistant_llm_conversation_with_tool_calls(assistant_plugin):
   assert response == "final answer"
 
 
+def make_tool_call(call_id, name="slow_tool"):
+  tool_call = MagicMock()
+  tool_call.function.name = name
+  tool_call.function.arguments = json.dumps({"delay": call_id})
+  tool_call.id = call_id
+  return tool_call
+
+
+@pytest.mark.asyncio
+async def test_tool_handler_runs_tool_calls_concurrently_in_order(assistant_plugin):
+  handler = assistant_plugin.handler.tool_handler
+  running = 0
+  peak = 0
+
+  async def call_tool(tool_name, tool_args):
+    nonlocal running, peak
+    running += 1
+    peak = max(peak, running)
+    await asyncio.sleep(0.05 * (5 - int(tool_args["delay"])))
+    running -= 1
+    return f"result {tool_args['delay']}"
+
+  handler.call_tool = call_tool
+  messages = []
+  results = await handler.execute_tool_calls(
+    [make_tool_call(str(i)) for i in range(5)], messages, [], max_concurrency=3
+  )
+
+  assert results == ["continue"] * 5
+  assert [m["tool_call_id"] for m in messages] == ["0", "1", "2", "3", "4"]
+  assert [m["content"] for m in messages] == [f"result {i}" for i in range(5)]
+  assert peak == 3
+
+
+@pytest.mark.asyncio
+async def test_tool_handler_tool_call_timeout(assistant_plugin):
+  handler = assistant_plugin.handler.tool_handler
+
+  async def call_tool(tool_name, tool_args):
+    await asyncio.sleep(0 if tool_args["delay"] == "fast" else 10)
+    return "done"
+
+  handler.call_tool = call_tool
+  messages = []
+  results = await handler.execute_tool_calls(
+    [make_tool_call("slow"), make_tool_call("fast")], messages, [], timeout=0.1
+  )
+
+  assert results == [None, "continue"]
+  assert messages[0] == {"role": "tool", "tool_call_id": "slow", "content": "error: tool timed out after 0.1s"}
+  assert messages[1]["content"] == "done"
+
+
 @pytest.mark.asyncio
 async def test_assistant_llm_conversation_max_iterations(assistant_plugin):
   messages = [{"role": "user", "content": "test"}]
@@ -559,7 +773,10 @@ async def test_history_truncation(simple_plugin, mock_update):
   history.save_message(user_id, chat_id, "user", long_content)
 
   retrieved = history.get_conversation_history(user_id, chat_id)
-  assert len(retrieved[0]["content"]) == 2000
+  assert len(retrieved[0]["content"]) == 3000
+
+  history.save_message(user_id, chat_id, "user", "x" * (history.max_chars + 1))
+  assert len(history.get_conversation_history(user_id, chat_id)[-1]["content"]) == history.max_chars
 
 
 @pytest.mark.asyncio
@@ -603,6 +820,7 @@ async def test_tool_handler_read_resource_content_types(assistant_plugin):
     mock_content_blob.blob = "trophy_image_blob"
     del mock_content_blob.text
     mock_result.contents = [mock_content_blob, mock_content]
+    handler.cache.clear()
     res = await handler.read_resource("juve://stadium")
     assert res == "Forza Juve"
 
@@ -611,6 +829,7 @@ async def test_tool_handler_read_resource_content_types(assistant_plugin):
     del mock_content_other.blob
     mock_content_other.__str__.return_value = "scudetto"
     mock_result.contents = [mock_content_other]
+    handler.cache.clear()
     res = await handler.read_resource("juve://stadium")
     assert res == "scudetto"
 
@@ -700,3 +919,1119 @@ async def test_assistant_handler_process_query_error(assistant_plugin, mock_upda
     await assistant_plugin.handler.process_query(mock_update, mock_context, "query")
     mock_update.message.reply_text.assert_called()
     assert "something went wrong" in mock_update.message.reply_text.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_mcp_session_pool_reuses_and_multiplexes_sessions():
+  async with MCPStandin(tools=2) as standin:
+    manager = MCPManager(MagicMock(), [standin.server_cfg])
+    handler = ToolHandler(manager.plugin, manager)
+
+    tools = await manager.list_tools(standin.server_cfg)
+    connection = manager.session_manager.connection_for(standin.server_cfg)
+    first_session = connection.session
+
+    results = await asyncio.gather(
+      *(handler.call_tool_from_session(standin.server_cfg, "standin_tool_1", {"query": f"q{i}"}) for i in range(10))
+    )
+
+    assert len(tools) == 2
+    assert results == [f"tool 1 answered: q{i}" for i in range(10)]
+    assert connection.session is first_session
+    assert connection.reconnects == 0
+    await manager.session_manager.close()
+
+
+@pytest.mark.asyncio
+async def test_mcp_session_pool_reconnects_dead_sessions():
+  async with MCPStandin(tools=1) as standin:
+    manager = MCPManager(MagicMock(), [standin.server_cfg])
+    await manager.list_tools(standin.server_cfg)
+    connection = manager.session_manager.connection_for(standin.server_cfg)
+
+    connection._task.cancel()
+    await asyncio.wait([connection._task])
+    assert not connection.alive
+
+    tools = await manager.list_tools(standin.server_cfg)
+    assert len(tools) == 1
+    assert connection.alive
+    assert connection.reconnects == 1
+    await manager.session_manager.close()
+
+
+@pytest.mark.asyncio
+async def test_mcp_session_pool_survives_call_failures():
+  async with MCPStandin(tools=1, latency=0.3) as standin:
+    manager = MCPManager(MagicMock(), [standin.server_cfg])
+    handler = ToolHandler(manager.plugin, manager)
+    await manager.list_tools(standin.server_cfg)
+    connection = manager.session_manager.connection_for(standin.server_cfg)
+    session = connection.session
+
+    # one call timing out must not tear down the other one in flight on the same session
+    slow = asyncio.wait_for(handler.call_tool_from_session(standin.server_cfg, "standin_tool_0", {"query": "a"}), 0.05)
+    results = await asyncio.gather(
+      slow, handler.call_tool_from_session(standin.server_cfg, "standin_tool_0", {"query": "b"}), return_exceptions=True
+    )
+    assert isinstance(results[0], asyncio.TimeoutError)
+    assert results[1] == "tool 0 answered: b"
+
+    for error in (asyncio.TimeoutError(), ValueError("handler bug")):
+      with pytest.raises(type(error)):
+        async with manager.session_manager.session_context(standin.server_cfg):
+          raise error
+    assert connection.session is session and connection.reconnects == 0
+
+    with pytest.raises(anyio.BrokenResourceError):
+      async with manager.session_manager.session_context(standin.server_cfg):
+        raise anyio.BrokenResourceError()
+    assert not connection.alive
+    await manager.session_manager.close()
+
+
+@pytest.mark.asyncio
+async def test_mcp_session_pool_keepalive_drops_unresponsive_sessions():
+  async with MCPStandin(tools=1) as standin:
+    manager = MCPManager(MagicMock(), [standin.server_cfg])
+    await manager.list_tools(standin.server_cfg)
+    connection = manager.session_manager.connection_for(standin.server_cfg)
+
+    assert await connection.ping(timeout=5)
+    with patch.object(connection.session, "send_ping", new=AsyncMock(side_effect=ConnectionError("gone"))):
+      assert not await connection.ping(timeout=5)
+    assert not connection.alive
+    await manager.session_manager.close()
+
+
+@pytest.mark.asyncio
+async def test_mcp_session_pool_unreachable_server_returns_default():
+  manager = MCPManager(MagicMock(), [])
+  server_cfg = {"name": "nowhere", "url": "http://127.0.0.1:9", "auth_value": "token"}
+  manager.session_manager.connection_for(server_cfg).connect_timeout = 2
+
+  assert await manager.list_tools(server_cfg) is None
+
+
+def test_result_cache_ttl_lru_and_size_limits():
+  cache = ResultCache(ttl=60, max_entries=2, max_bytes=10)
+  cache.set(cache_key("server", "a", {"x": 1, "y": 2}), "aaaa")
+  assert cache.get(cache_key("server", "a", {"y": 2, "x": 1})) == "aaaa"
+
+  cache.set(cache_key("server", "b"), "bbbb")
+  cache.get(cache_key("server", "a", {"x": 1, "y": 2}))
+  cache.set(cache_key("server", "c"), "cccc")
+  assert cache.get(cache_key("server", "b")) is None
+  assert cache.evictions == 1
+
+  cache.set(cache_key("server", "d"), "dddddddd")
+  assert list(cache.entries) == [cache_key("server", "d")]
+  assert cache.size == 8
+
+  cache.set(cache_key("server", "e"), "e", ttl=-1)
+  assert cache.get(cache_key("server", "e")) is None
+  assert (cache.hits, cache.misses) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_tool_handler_caches_resources_and_cacheable_tools(assistant_plugin):
+  handler = assistant_plugin.handler.tool_handler
+  server = {"name": "calendar", "url": "http://test", "cacheable_tools": ["list_calendars"]}
+  handler.mcp.resource_to_server_map = {"calendar://today": server}
+  handler.mcp.tool_to_server_map = {"list_calendars": server, "create_event": server}
+
+  with (
+    patch.object(handler, "read_resource_from_session", new=AsyncMock(return_value="today")) as mock_read,
+    patch.object(handler, "call_tool_from_session", new=AsyncMock(return_value="done")) as mock_call,
+  ):
+    assert await handler.read_resource("calendar://today") == "today"
+    assert await handler.read_resource("calendar://today") == "today"
+    await handler.call_tool("list_calendars", {"a": 1, "b": 2})
+    await handler.call_tool("list_calendars", {"b": 2, "a": 1})
+    await handler.call_tool("create_event", {"a": 1})
+    await handler.call_tool("create_event", {"a": 1})
+
+  assert mock_read.call_count == 1
+  assert mock_call.call_count == 3
+  assert handler.cache.hits == 2
+  assert "2 hits" in handler.cache.describe()
+
+
+def described_tool(name, description):
+  return {"type": "function", "function": {"name": name, "description": description, "parameters": {}}}
+
+
+CATALOG = [
+  described_tool("get_weather", "current weather forecast for a city"),
+  described_tool("create_event", "add an event to the calendar"),
+  described_tool("list_events", "list the calendar events of a day"),
+  described_tool("send_email", "send an email message"),
+  described_tool("search_wiki", "search the wiki pages"),
+]
+
+
+def test_tool_ranker_selects_relevant_tools_in_catalog_order():
+  ranker = ToolRanker(CATALOG)
+
+  selected = ranker.select("what's on my calendar, any events tomorrow?", 2)
+  assert [tool["function"]["name"] for tool in selected] == ["create_event", "list_events"]
+  assert ranker.select("Weather in Turin", 2)[0]["function"]["name"] == "get_weather"
+  assert ranker.select("tell me a joke", 2) is CATALOG
+  assert ranker.select("weather", 0) is CATALOG
+
+
+@pytest.mark.asyncio
+async def test_assistant_falls_back_to_all_tools_for_unselected_tool(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.config.tool_top_k = 2
+  handler.tools = CATALOG
+  selected = handler.select_tools("weather in Turin", CATALOG)
+  assert [tool["function"]["name"] for tool in selected] == ["get_weather"]
+
+  asked_unselected = MagicMock()
+  asked_unselected.content = None
+  asked_unselected.tool_calls = [make_tool_call("1", name="send_email")]
+  final = MagicMock()
+  final.content = "done"
+  final.tool_calls = None
+  handler._get_llm_response = AsyncMock(side_effect=[(asked_unselected, None), (final, None)])
+
+  assert await handler._handle_llm_conversation([{"role": "user", "content": "weather in Turin"}], selected) == "done"
+  assert handler._get_llm_response.call_args_list[0].args[1] is selected
+  assert handler._get_llm_response.call_args_list[1].args[1] is CATALOG
+
+
+def test_assistant_sends_the_whole_catalog_when_the_prompt_is_cached(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.config.tool_top_k = 2
+
+  with patch("lotb.plugins._llm.assistant.supports_cache_control", return_value=True):
+    assert handler.select_tools("weather in Turin", CATALOG) is CATALOG
+    handler.config.prompt_caching = False
+    assert len(handler.select_tools("weather in Turin", CATALOG)) == 1
+
+
+def stream_chunk(text):
+  chunk = MagicMock()
+  chunk.choices = [MagicMock()]
+  chunk.choices[0].delta.content = text
+  return chunk
+
+
+def fake_stream(*texts):
+  async def stream():
+    for text in texts:
+      yield stream_chunk(text)
+
+  return stream()
+
+
+@pytest.mark.asyncio
+async def test_simple_llm_streaming_edits_reply(mock_update, mock_context, simple_plugin):
+  simple_plugin.config_handler.streaming = True
+  simple_plugin.config_handler.stream_edit_interval = 0
+  mock_update.message.text = "/llm tell me a story"
+  reply = MagicMock()
+  reply.edit_text = AsyncMock()
+  mock_update.message.reply_text = AsyncMock(return_value=reply)
+
+  with (
+    patch(
+      "lotb.common.plugin_class.PluginBase.llm_completion",
+      new=AsyncMock(return_value=fake_stream("Once ", "upon ", "a time")),
+    ) as mock_llm,
+    patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()),
+  ):
+    await simple_plugin.execute(mock_update, mock_context)
+
+  assert mock_llm.call_args.kwargs["stream"] is True
+  mock_update.message.reply_text.assert_called_once_with("Once")
+  assert reply.edit_text.call_args_list[-1].args[0] == "Once upon a time"
+  history = simple_plugin.handler.history.get_conversation_history(4815162342, 996699)
+  assert history[-1] == {"role": "assistant", "content": "Once upon a time"}
+
+
+@pytest.mark.asyncio
+async def test_streaming_reply_throttles_and_spills_long_answers(mock_update, mock_context, simple_plugin):
+  sent = []
+
+  async def reply_text(text):
+    message = MagicMock()
+    message.edit_text = AsyncMock(side_effect=lambda new_text: sent.__setitem__(sent.index(message_text), new_text))
+    message_text = text
+    sent.append(text)
+    return message
+
+  mock_update.message.reply_text = reply_text
+  with patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()) as typing:
+    async with StreamingReply(simple_plugin, mock_update, mock_context, edit_interval=60, max_length=20) as reply:
+      await asyncio.sleep(0)
+      typing.assert_called_once()
+      for word in ["alpha ", "beta ", "gamma ", "delta ", "epsilon ", "zeta"]:
+        await reply.append(word)
+      assert sent == ["alpha"]
+      await reply.finish()
+
+  assert sent == ["alpha beta gamma", "delta epsilon zeta"]
+  assert all(len(text) <= 20 for text in sent)
+
+
+@pytest.mark.asyncio
+async def test_assistant_streaming_recovers_tool_calls(assistant_plugin, mock_update, mock_context):
+  handler = assistant_plugin.handler
+  rebuilt = MagicMock()
+  rebuilt.choices = [MagicMock()]
+  rebuilt.choices[0].message.content = "sunny"
+  rebuilt.choices[0].message.tool_calls = None
+  reply = MagicMock()
+  reply.append = AsyncMock()
+
+  with (
+    patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=fake_stream("sun", "ny"))),
+    patch("litellm.stream_chunk_builder", return_value=rebuilt) as builder,
+  ):
+    message, error = await handler._get_llm_response([{"role": "user", "content": "weather?"}], None, reply)
+
+  assert error is None and message.content == "sunny"
+  assert [call.args[0] for call in reply.append.call_args_list] == ["sun", "ny"]
+  assert len(builder.call_args.args[0]) == 2
+
+
+@pytest.mark.asyncio
+async def test_history_write_behind_batches_and_trims(simple_plugin):
+  history = simple_plugin.handler.history
+  history.max_conversations = 1
+  cursor = simple_plugin.connection.cursor()
+
+  for i in range(5):
+    history.save_message(1, 1, "user" if i % 2 == 0 else "assistant", f"message{i}")
+  assert cursor.execute("SELECT COUNT(*) FROM llm").fetchone()[0] == 0
+
+  # loading a conversation from the database flushes the buffer first
+  history.save_message(2, 2, "user", "other chat")
+  assert cursor.execute("SELECT COUNT(*) FROM llm").fetchone()[0] == 3
+  assert list(history.conversations) == [(2, 2)]
+
+  assert [m["content"] for m in history.get_conversation_history(1, 1)] == ["message2", "message3", "message4"]
+  rows = cursor.execute("SELECT user_id, content FROM llm ORDER BY id").fetchall()
+  assert rows == [(1, "message2"), (1, "message3"), (1, "message4"), (2, "other chat")]
+
+  history.save_message(1, 1, "user", "message5")
+  await simple_plugin.shutdown()
+  assert cursor.execute("SELECT content FROM llm WHERE user_id = 1 ORDER BY id").fetchall() == [
+    ("message3",),
+    ("message4",),
+    ("message5",),
+  ]
+
+
+def summary_response(text):
+  response = MagicMock()
+  response.choices = [MagicMock()]
+  response.choices[0].message.content = text
+  return response
+
+
+@pytest.mark.asyncio
+async def test_context_builder_fills_budget_and_summarizes_older_turns(simple_plugin):
+  config = simple_plugin.config_handler
+  config.context_budget = 400
+  config.context_summary_tokens = 50
+  builder = ContextBuilder(simple_plugin, config)
+  history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "word " * 60} for i in range(6)]
+
+  with patch(
+    "lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=summary_response("earlier"))
+  ) as mock_llm:
+    messages = await builder.assemble("system prompt", history, "latest question", quoted="quoted text")
+    assert mock_llm.call_count == 1
+
+    assert messages[0] == {"role": "system", "content": "system prompt"}
+    assert messages[1] == {"role": "system", "content": "Summary of the earlier conversation: earlier"}
+    assert messages[-1] == {"role": "user", "content": "latest question\n\nQuoted message:\nquoted text"}
+    kept = messages[2:-1]
+    assert kept == history[-len(kept) :] and 0 < len(kept) < len(history)
+    assert sum(count_tokens(config.model, m["content"]) + 4 for m in messages) <= config.context_budget
+
+    # one more turn slides the window, only the newly dropped turn is summarized on top of the cached summary
+    history.append({"role": "user", "content": "turn 6 " + "word " * 60})
+    await builder.assemble("system prompt", history, "latest question")
+    assert mock_llm.call_count == 2
+    transcript = mock_llm.call_args.kwargs["messages"][1]["content"]
+    assert transcript.startswith("summary so far: earlier") and "turn 0" not in transcript
+
+
+@pytest.mark.asyncio
+async def test_context_builder_keeps_everything_within_budget(simple_plugin):
+  builder = ContextBuilder(simple_plugin, simple_plugin.config_handler)
+  history = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock()) as mock_llm:
+    messages = await builder.assemble("system prompt", history, "question")
+
+  mock_llm.assert_not_called()
+  assert messages == [{"role": "system", "content": "system prompt"}, *history, {"role": "user", "content": "question"}]
+
+
+def routing_config(**overrides):
+  return LLMConfig({"plugins.llm": {"model": "primary", "apikey": "key", **overrides}})
+
+
+def compaction_setup(plugin, **overrides):
+  config = routing_config(
+    compaction=True, compaction_tokens=200, compaction_keep_tokens=80, compaction_model="small", **overrides
+  )
+  history = ConversationHistory(plugin, config.history_limit, flush_interval=0)
+  return history, HistoryCompactor(plugin, config, history, ModelRouter(plugin, config))
+
+
+@pytest.mark.asyncio
+async def test_compaction_folds_old_turns_into_a_stored_memory(simple_plugin):
+  history, compactor = compaction_setup(simple_plugin)
+  for i in range(10):
+    history.save_message(1, 2, "user" if i % 2 == 0 else "assistant", f"turn {i} " + "word " * 20)
+  turns = history.get_conversation_history(1, 2)
+  compactor.schedule(1, 2)
+
+  with patch(
+    "lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=summary_response("the gist"))
+  ) as mock_llm:
+    await compactor.compact_pending()
+
+  assert mock_llm.call_args.kwargs["model"] == "small"
+  assert "turn 0" in mock_llm.call_args.kwargs["messages"][1]["content"]
+  kept = history.get_conversation_history(1, 2)
+  assert kept == turns[-len(kept) :] and 0 < len(kept) < len(turns)
+  assert kept[0]["role"] == "user"
+  assert history.get_memory(1, 2) == "the gist"
+  assert compactor.pending == set() and compactor.compactions == 1
+
+  # the memory and the remaining turns are what a fresh process loads
+  reloaded = ConversationHistory(simple_plugin, 200)
+  assert reloaded.get_conversation_history(1, 2) == kept
+  assert reloaded.get_memory(1, 2) == "the gist"
+
+  messages = await ContextBuilder(simple_plugin, compactor.config).assemble(
+    "system prompt", kept, "question", compacted=history.get_memory(1, 2)
+  )
+  assert messages[1] == {"role": "system", "content": "Memory of the earlier conversation: the gist"}
+
+  history.clear_history(1, 2)
+  assert ConversationHistory(simple_plugin, 200).get_memory(1, 2) == ""
+
+
+@pytest.mark.asyncio
+async def test_compaction_extends_the_memory_and_skips_short_conversations(simple_plugin):
+  history, compactor = compaction_setup(simple_plugin)
+  history.save_message(1, 2, "user", "short question")
+  history.save_message(1, 2, "assistant", "short answer")
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock()) as mock_llm:
+    assert not await compactor.compact(1, 2)
+  mock_llm.assert_not_called()
+
+  history.memories[(1, 2)] = "older gist"
+  for i in range(10):
+    history.save_message(1, 2, "user" if i % 2 == 0 else "assistant", f"turn {i} " + "word " * 20)
+  with patch(
+    "lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=summary_response("newer gist"))
+  ) as mock_llm:
+    assert await compactor.compact(1, 2)
+  assert mock_llm.call_args.kwargs["messages"][1]["content"].startswith("summary so far: older gist")
+  assert history.get_memory(1, 2) == "newer gist"
+
+
+@pytest.mark.asyncio
+async def test_compaction_keeps_the_turns_when_it_fails_or_races(simple_plugin):
+  history, compactor = compaction_setup(simple_plugin)
+  for i in range(10):
+    history.save_message(1, 2, "user" if i % 2 == 0 else "assistant", f"turn {i} " + "word " * 20)
+  turns = history.get_conversation_history(1, 2)
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(side_effect=RuntimeError("down"))):
+    assert not await compactor.compact(1, 2)
+  assert history.get_conversation_history(1, 2) == turns and compactor.failures == 1
+
+  async def cleared_meanwhile(*args, **kwargs):
+    history.clear_history(1, 2)
+    return summary_response("stale gist")
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(side_effect=cleared_meanwhile)):
+    assert not await compactor.compact(1, 2)
+  assert history.get_memory(1, 2) == "" and history.get_conversation_history(1, 2) == []
+
+
+@pytest.mark.asyncio
+async def test_router_retries_then_falls_back(simple_plugin):
+  config = routing_config(
+    timeout=0.05, retries=1, retry_backoff=0.01, fallback_models=[{"model": "backup", "apikey": "other"}]
+  )
+  router = ModelRouter(simple_plugin, config)
+
+  async def completion(messages, model, api_key, **kwargs):
+    if model == "primary":
+      await asyncio.sleep(1)
+    return summary_response(f"{model} with {api_key}")
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(side_effect=completion)) as mock_llm:
+    response = await router.completion(messages=[{"role": "user", "content": "hi"}])
+
+  assert response.choices[0].message.content == "backup with other"
+  assert [call.kwargs["model"] for call in mock_llm.call_args_list] == ["primary", "primary", "backup"]
+  assert router.latency("primary").failures == 2
+  assert len(router.latency("backup").samples) == 1
+
+
+@pytest.mark.asyncio
+async def test_router_does_not_retry_bad_requests(simple_plugin):
+  router = ModelRouter(simple_plugin, routing_config(retries=3, retry_backoff=0.01))
+  error = litellm.exceptions.BadRequestError("bad", model="primary", llm_provider="openai")
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(side_effect=error)) as mock_llm:
+    with pytest.raises(litellm.exceptions.BadRequestError):
+      await router.completion(messages=[{"role": "user", "content": "hi"}], temperature=0.2)
+
+  assert mock_llm.call_count == 1
+  assert mock_llm.call_args.kwargs["temperature"] == 0.2
+
+
+@pytest.mark.asyncio
+async def test_router_times_out_a_stalled_stream(simple_plugin):
+  router = ModelRouter(simple_plugin, routing_config(timeout=0.05))
+  closed = asyncio.Event()
+
+  async def stalling():
+    try:
+      yield stream_chunk("first")
+      await asyncio.sleep(1)
+      yield stream_chunk("never")
+    finally:
+      closed.set()
+
+  received = []
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=stalling())):
+    stream = await router.completion(messages=[{"role": "user", "content": "hi"}], stream=True)
+    with pytest.raises(asyncio.TimeoutError):
+      async for delta in stream_deltas(stream):
+        received.append(delta)
+
+  assert received == ["first"]
+  assert closed.is_set()
+
+
+@pytest.mark.asyncio
+async def test_router_hedges_after_p95(simple_plugin):
+  router = ModelRouter(simple_plugin, routing_config(hedge=True, hedge_min_samples=5, fallback_models=["backup"]))
+  for _ in range(5):
+    router.latency("primary").record(0.02)
+  cancelled = asyncio.Event()
+
+  async def completion(messages, model, api_key, **kwargs):
+    if model == "primary":
+      try:
+        await asyncio.sleep(1)
+      except asyncio.CancelledError:
+        cancelled.set()
+        raise
+    return summary_response(model)
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(side_effect=completion)):
+    response = await router.completion(messages=[{"role": "user", "content": "hi"}])
+    await asyncio.sleep(0)
+
+  assert response.choices[0].message.content == "backup"
+  assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_router_falls_back_when_the_hedged_primary_fails_fast(simple_plugin):
+  router = ModelRouter(simple_plugin, routing_config(hedge=True, hedge_min_samples=5, fallback_models=["backup"]))
+  for _ in range(5):
+    router.latency("primary").record(0.5)
+  error = litellm.exceptions.BadRequestError("bad", model="primary", llm_provider="openai")
+
+  async def completion(messages, model, api_key, **kwargs):
+    if model == "primary":
+      raise error
+    return summary_response(model)
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(side_effect=completion)) as mock_llm:
+    response = await router.completion(messages=[{"role": "user", "content": "hi"}])
+
+  assert response.choices[0].message.content == "backup"
+  assert [call.kwargs["model"] for call in mock_llm.call_args_list] == ["primary", "backup"]
+
+
+@pytest.mark.asyncio
+async def test_router_does_not_retry_a_backup_the_hedge_already_raced(simple_plugin):
+  router = ModelRouter(simple_plugin, routing_config(hedge=True, hedge_min_samples=5, fallback_models=["backup"]))
+  for _ in range(5):
+    router.latency("primary").record(0.01)
+
+  async def completion(messages, model, api_key, **kwargs):
+    await asyncio.sleep(0.05 if model == "primary" else 0)
+    raise RuntimeError(f"{model} down")
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(side_effect=completion)) as mock_llm:
+    with pytest.raises(RuntimeError):
+      await router.completion(messages=[{"role": "user", "content": "hi"}])
+
+  assert sorted(call.kwargs["model"] for call in mock_llm.call_args_list) == ["backup", "primary"]
+
+
+@pytest.mark.asyncio
+async def test_simple_mode_sends_short_queries_to_cheap_model(mock_update, mock_context, simple_plugin):
+  simple_plugin.config_handler.cheap_model = {"model": "tiny"}
+  simple_plugin.config_handler.temperature = 0.3
+  simple_plugin.handler.router = ModelRouter(simple_plugin, simple_plugin.config_handler)
+  mock_update.message.text = "/llm hi"
+  mock_update.message.reply_to_message = None
+
+  with (
+    patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()),
+    patch("lotb.common.plugin_class.PluginBase.reply_message", new=AsyncMock()),
+    patch(
+      "lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=summary_response("hey"))
+    ) as mock_llm,
+  ):
+    await simple_plugin.execute(mock_update, mock_context)
+    assert mock_llm.call_args.kwargs["model"] == "tiny"
+    assert mock_llm.call_args.kwargs["api_key"] == "soon-I-will-be-leaked"
+    assert mock_llm.call_args.kwargs["temperature"] == 0.3
+
+    mock_update.message.text = "/llm " + "a much longer question " * 20
+    await simple_plugin.execute(mock_update, mock_context)
+    assert mock_llm.call_args.kwargs["model"] == "closed-ai-gpt44"
+
+
+def user_update(user_id, chat_id):
+  update = MagicMock()
+  update.effective_user.id = user_id
+  update.effective_chat.id = chat_id
+  return update
+
+
+@pytest.mark.asyncio
+async def test_admission_queues_per_user_and_rejects_when_full(simple_plugin, mock_context):
+  admission = AdmissionController(simple_plugin, max_concurrent=4, per_user=1, per_chat=4, max_queue=1)
+  release = asyncio.Event()
+  finished = []
+
+  async def work(name):
+    await release.wait()
+    finished.append(name)
+
+  with patch("lotb.common.plugin_class.PluginBase.reply_message", new=AsyncMock()) as mock_reply:
+    first = asyncio.create_task(admission.run(user_update(1, 10), mock_context, lambda: work("first")))
+    second = asyncio.create_task(admission.run(user_update(1, 10), mock_context, lambda: work("second")))
+    other_user = asyncio.create_task(admission.run(user_update(2, 10), mock_context, lambda: work("other")))
+    await asyncio.sleep(0.01)
+    assert len(admission.running) == 2 and admission.depth == 1
+    assert mock_reply.call_args_list[0].args[2] == "queued, position 1"
+
+    await admission.run(user_update(1, 10), mock_context, lambda: work("rejected"))
+    assert mock_reply.call_args.args[2].startswith("too many requests")
+    assert admission.rejected == 1
+
+    release.set()
+    await asyncio.gather(first, second, other_user)
+
+  assert sorted(finished) == ["first", "other", "second"]
+  assert finished.index("second") > finished.index("first")
+  assert admission.depth == 0 and not admission.running
+
+
+@pytest.mark.asyncio
+async def test_admission_supersedes_the_pending_request(simple_plugin, mock_context):
+  admission = AdmissionController(simple_plugin, supersede=True)
+  started = asyncio.Event()
+  finished = []
+
+  async def slow():
+    started.set()
+    await asyncio.sleep(1)
+    finished.append("slow")
+
+  async def fast():
+    finished.append("fast")
+
+  with patch("lotb.common.plugin_class.PluginBase.reply_message", new=AsyncMock()):
+    first = asyncio.create_task(admission.run(user_update(1, 10), mock_context, slow))
+    await started.wait()
+    await admission.run(user_update(1, 10), mock_context, fast)
+    await first
+
+  assert finished == ["fast"]
+  assert not first.cancelled()
+  assert admission.superseded == 1 and not admission.running
+
+
+def usage_response(content="hello", prompt_tokens=10, completion_tokens=5):
+  return litellm.ModelResponse(
+    model="gpt-4o-mini",
+    choices=[{"message": {"role": "assistant", "content": content}}],
+    usage={
+      "prompt_tokens": prompt_tokens,
+      "completion_tokens": completion_tokens,
+      "total_tokens": prompt_tokens + completion_tokens,
+    },
+  )
+
+
+@pytest.mark.asyncio
+async def test_usage_is_logged_and_rolled_up(mock_update, mock_context, simple_plugin):
+  usage = simple_plugin.handler.usage
+  mock_update.message.text = "/llm a question that is long enough to be answered by the main model, not a cheap one"
+
+  with (
+    patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()),
+    patch("lotb.common.plugin_class.PluginBase.reply_message", new=AsyncMock()) as mock_reply,
+    patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=usage_response())),
+  ):
+    await simple_plugin.execute(mock_update, mock_context)
+    await simple_plugin.execute(mock_update, mock_context)
+    # rows are buffered until the batch fills or a flush
+    assert simple_plugin.db_cursor.execute("SELECT COUNT(*) FROM llm_usage").fetchone()[0] == 0
+
+    mock_update.message.text = "/llm stats"
+    await simple_plugin.execute(mock_update, mock_context)
+
+  report = mock_reply.call_args.args[2]
+  assert "you: 2 requests, 20 prompt + 10 completion tokens" in report
+  assert "this chat: 2 requests" in report
+  assert "Top users" not in report
+
+  rows = simple_plugin.db_cursor.execute("SELECT user_id, chat_id, model, prompt_tokens FROM llm_usage").fetchall()
+  assert rows == [(4815162342, 996699, "closed-ai-gpt44", 10)] * 2
+  assert usage.totals("model", "closed-ai-gpt44")["requests"] == 2
+
+  # the next batch is folded into the existing rollup rows
+  with usage_scope(4815162342, 1):
+    usage.record("closed-ai-gpt44", usage_response(prompt_tokens=1, completion_tokens=1), 0.5)
+  assert usage.totals("user", 4815162342)["prompt_tokens"] == 21
+  assert usage.totals("chat", 1)["requests"] == 1
+  assert "Top chats" in usage.report(4815162342, 996699, include_top=True)
+
+
+@pytest.mark.asyncio
+async def test_usage_of_streams_records_time_to_first_token(simple_plugin):
+  usage = simple_plugin.handler.usage
+  router = ModelRouter(simple_plugin, simple_plugin.config_handler, usage)
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=fake_stream("a", "b"))):
+    stream = await router.completion(messages=[{"role": "user", "content": "hi"}], stream=True)
+    assert [chunk async for chunk in stream]
+
+  usage.flush()
+  ttft, cached = simple_plugin.db_cursor.execute("SELECT ttft_ms, cached FROM llm_usage").fetchone()
+  assert ttft is not None and cached == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_index_grows_and_searches():
+  index = ChatIndex(4)
+  vectors = normalize(np.eye(4, dtype=np.float32)[[0, 1, 2, 3] * 30])
+  for offset in range(0, 120, 7):
+    index.add(np.arange(offset, min(offset + 7, 120)), vectors[offset : offset + 7])
+
+  assert index.size == 120 and len(index.ids) >= 120
+  matches = index.search(np.array([0, 0.1, 1, 0], dtype=np.float32), top_k=2, exclude_recent=4)
+  assert [match_id % 4 for match_id, _ in matches] == [2, 2]
+  assert all(match_id < 116 for match_id, _ in matches)
+  assert index.search(vectors[0], top_k=3, exclude_recent=120) == []
+
+
+@pytest.mark.asyncio
+async def test_retrieval_memory_recalls_older_turns(mock_update, mock_context, simple_plugin):
+  config = simple_plugin.config_handler
+  config.memory = True
+  config.max_history = 2
+  memory = RetrievalMemory(simple_plugin, config, HashingEmbeddings(64))
+  memory.create_table()
+  simple_plugin.handler.memory = memory
+  chat_id = mock_update.effective_chat.id
+
+  await memory.remember(1, chat_id, [("user", "my cat is called Pixel"), ("assistant", "nice name for a cat")])
+  await memory.remember(1, chat_id, [("user", "the weather is rainy"), ("assistant", "take an umbrella")])
+  await memory.remember(1, 42, [("user", "my cat is called Socks"), ("assistant", "ok")])
+  recalled = await memory.recall(chat_id, "what is my cat called?", exclude_recent=2)
+  assert recalled[0] == "user: my cat is called Pixel"
+  assert not any("Socks" in turn or "rainy" in turn for turn in recalled)
+
+  # a fresh instance rebuilds the chat index from the database
+  reloaded = RetrievalMemory(simple_plugin, config, HashingEmbeddings(64))
+  assert (await reloaded.recall(chat_id, "cat name Pixel"))[0] == "user: my cat is called Pixel"
+
+  mock_update.message.text = "/llm remind me what my cat is called, I forgot it again"
+  with (
+    patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()),
+    patch("lotb.common.plugin_class.PluginBase.reply_message", new=AsyncMock()),
+    patch(
+      "lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=usage_response("Pixel"))
+    ) as mock_llm,
+  ):
+    await simple_plugin.execute(mock_update, mock_context)
+
+  memory_message = next(m for m in mock_llm.call_args.kwargs["messages"] if "Relevant earlier" in m["content"])
+  assert "my cat is called Pixel" in memory_message["content"]
+  assert memory.indexes[chat_id].size == 6
+
+
+@pytest.mark.asyncio
+async def test_retrieval_memory_failures_do_not_cost_the_answer(mock_update, mock_context, simple_plugin):
+  config = simple_plugin.config_handler
+  provider = HashingEmbeddings(64)
+  memory = RetrievalMemory(simple_plugin, config, provider)
+  memory.create_table()
+  simple_plugin.handler.memory = memory
+  await memory.remember(1, 996699, [("user", "my cat is called Pixel"), ("assistant", "nice name")])
+
+  rate_limited = litellm.exceptions.RateLimitError("slow down", llm_provider="openai", model="embedder")
+  provider.embed = AsyncMock(side_effect=rate_limited)
+  assert await memory.recall(996699, "cat") == []
+  await memory.remember(1, 996699, [("user", "lost"), ("assistant", "turn")])
+  assert memory.indexes[996699].size == 2
+
+  mock_update.message.text = "/llm what is my cat called?"
+  with (
+    patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()),
+    patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=usage_response("Pixel"))),
+  ):
+    await simple_plugin.execute(mock_update, mock_context)
+  mock_update.message.reply_text.assert_called_once_with("Pixel")
+
+
+def test_chat_index_int8_scores_track_float_scores():
+  rng = np.random.default_rng(1)
+  vectors = normalize(rng.standard_normal((500, 64), dtype=np.float32))
+  index = ChatIndex(64, np.arange(500), vectors)
+  query = vectors[123]
+
+  assert index.vectors.dtype == np.int8 and index.nbytes < vectors.nbytes / 2
+  best_id, best_score = index.search(query, top_k=1)[0]
+  assert best_id == 123 and abs(best_score - 1.0) < 0.02
+  exact = vectors @ query
+  assert all(abs(score - exact[match_id]) < 0.02 for match_id, score in index.search(query, top_k=10))
+
+
+def test_canonical_tools_and_cache_control_markers():
+  tools = [
+    {"type": "function", "function": {"parameters": {"b": 1, "a": 2}, "name": "zeta"}},
+    {"function": {"name": "alpha", "description": "first"}, "type": "function"},
+  ]
+  canonical = canonical_tools(tools)
+  assert [tool["function"]["name"] for tool in canonical] == ["alpha", "zeta"]
+  assert json.dumps(canonical) == json.dumps(canonical_tools(list(reversed(tools))))
+  assert list(canonical[1]["function"]["parameters"]) == ["a", "b"]
+
+  messages = [{"role": "system", "content": "prompt"}, {"role": "user", "content": "hi"}]
+  marked, marked_tools = with_cache_control(messages, canonical)
+  assert marked[0]["content"] == [{"type": "text", "text": "prompt", "cache_control": {"type": "ephemeral"}}]
+  assert marked[1] is messages[1] and messages[0]["content"] == "prompt"
+  assert marked_tools is not None and marked_tools[-1]["cache_control"] == {"type": "ephemeral"}
+  assert "cache_control" not in canonical[-1]
+
+
+@pytest.mark.asyncio
+async def test_assistant_prompt_prefix_is_memoized_and_cache_hits_are_counted(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.config.model = "anthropic/claude-3-5-sonnet-20241022"
+  handler.tools = [fake_tool("alpha")]
+  first = handler._system_prompt()
+  handler.capabilities_summary = "changed without a catalog update"
+  assert handler._system_prompt() is first
+  handler.mcp.catalog_version += 1
+  assert "changed without a catalog update" in handler._system_prompt()
+
+  response = usage_response("done", prompt_tokens=1200)
+  response.usage.prompt_tokens_details = litellm.types.utils.PromptTokensDetailsWrapper(cached_tokens=1024)
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=response)) as mock_llm:
+    answer = await handler._handle_llm_conversation([{"role": "user", "content": "hi"}], handler.tools)
+
+  assert answer == "done"
+  sent = mock_llm.call_args.kwargs
+  assert sent["messages"][0]["content"][0]["cache_control"] == {"type": "ephemeral"}
+  assert sent["tools"][-1]["cache_control"] == {"type": "ephemeral"}
+  assert handler.prompt_cache.cached_tokens == 1024 and handler.prompt_cache.prompt_tokens == 1200
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("streaming", [False, True])
+async def test_assistant_end_to_end_against_standins(mock_update, mock_context, streaming):
+  async with OpenAIStandin(tool_rounds=1, answer="order 7 has shipped") as llm, MCPStandin(tools=3) as mcp:
+    config = MagicMock()
+    config.get.side_effect = lambda key, default=None: {
+      "plugins.llm": {
+        "model": "openai/standin",
+        "apikey": "standin",
+        "api_base": llm.api_base,
+        "assistant": True,
+        "mcpservers": [mcp.server_cfg],
+        "streaming": streaming,
+        "stream_edit_interval": 0,
+      },
+      "core.database": ":memory:",
+    }.get(key, default)
+    plugin = Plugin()
+    plugin.set_config(config)
+    plugin.initialize()
+    mock_update.message.text = "/llm where is order 7?"
+    mock_update.message.reply_text = AsyncMock(return_value=MagicMock(edit_text=AsyncMock()))
+    mock_context.bot.send_chat_action = AsyncMock()
+
+    await plugin.execute(mock_update, mock_context)
+
+    assert llm.requests == 2
+    assert mcp.calls == 1
+    sent = mock_update.message.reply_text.call_args.args[0]
+    edited = mock_update.message.reply_text.return_value.edit_text.call_args
+    assert (edited.args[0] if streaming and edited else sent) == "order 7 has shipped"
+    history = plugin.handler.history.get_conversation_history(4815162342, 996699)
+    assert history[-1] == {"role": "assistant", "content": "order 7 has shipped"}
+    await plugin.handler.mcp.session_manager.close()
+
+
+@pytest.mark.asyncio
+async def test_assistant_hides_blocked_tools_from_the_catalog(assistant_plugin):
+  handler = assistant_plugin.handler
+  catalogs = {"free-money-mcp-server": [fake_tool("pay"), fake_tool("delete_account")], "mcp-server-avengers": []}
+
+  async def list_tools(server):
+    return catalogs[server["name"]]
+
+  with (
+    patch.object(handler.mcp, "list_tools", side_effect=list_tools),
+    patch.object(handler.mcp, "list_resources", new=AsyncMock(return_value=[])),
+  ):
+    await handler.start_discovery()
+
+  assert [tool["function"]["name"] for tool in handler.tools] == ["pay"]
+  assert "delete_account" not in handler.capabilities_summary
+  assert assistant_plugin.security_validator._tool_verdicts["delete_account"][0] is False
+
+
+def tool_call_response(*names, tokens=15):
+  tool_calls = [
+    {"id": f"call_{i}", "type": "function", "function": {"name": name, "arguments": "{}"}}
+    for i, name in enumerate(names)
+  ]
+  return litellm.ModelResponse(
+    choices=[{"message": {"role": "assistant", "content": None, "tool_calls": tool_calls}}],
+    usage={"prompt_tokens": tokens - 5, "completion_tokens": 5, "total_tokens": tokens},
+  )
+
+
+def looping_llm(answer="partial answer", tokens=15):
+  # keeps asking for the lookup tool, answers only when no tools are offered
+  async def completion(messages, **kwargs):
+    return tool_call_response("lookup", tokens=tokens) if kwargs.get("tools") else usage_response(answer)
+
+  return completion
+
+
+@pytest.mark.asyncio
+async def test_loop_budget_last_completion_answers_without_tools(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.tool_handler.call_tool = AsyncMock(return_value="found it")
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", side_effect=looping_llm()) as mock_llm:
+    answer = await handler._handle_llm_conversation([{"role": "user", "content": "q"}], [fake_tool("lookup")])
+
+  assert answer == "partial answer"
+  assert mock_llm.call_count == handler.config.max_iterations == 3
+  last = mock_llm.call_args.kwargs
+  assert "tools" not in last and last["messages"][-1]["content"] == PARTIAL_ANSWER_PROMPT
+  assert handler.tool_handler.call_tool.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_loop_budget_stops_on_tokens_with_the_tool_results(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.config.max_loop_tokens = 100
+  handler.tool_handler.call_tool = AsyncMock(return_value="found it")
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", side_effect=looping_llm(tokens=150)) as mock_llm:
+    answer = await handler._handle_llm_conversation([{"role": "user", "content": "q"}], [fake_tool("lookup")])
+
+  assert mock_llm.call_count == 1
+  assert answer == "token budget of 100 spent, partial results:\nfound it"
+
+
+@pytest.mark.asyncio
+async def test_loop_budget_tool_call_limit_asks_for_an_answer(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.config.max_tool_calls = 1
+  handler.tool_handler.call_tool = AsyncMock(return_value="found it")
+
+  async def completion(messages, **kwargs):
+    return tool_call_response("lookup", "lookup") if kwargs.get("tools") else usage_response("answer from memory")
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", side_effect=completion) as mock_llm:
+    answer = await handler._handle_llm_conversation([{"role": "user", "content": "q"}], [fake_tool("lookup")])
+
+  assert answer == "answer from memory"
+  assert mock_llm.call_count == 2
+  handler.tool_handler.call_tool.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_loop_budget_deadline_reaches_the_tool_calls(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.config.max_loop_seconds = 0.2
+  handler.config.tool_timeout = 30
+
+  async def call_tool(tool_name, tool_args):
+    await asyncio.sleep(10)
+    return "too late"
+
+  handler.tool_handler.call_tool = call_tool
+  started = asyncio.get_running_loop().time()
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", side_effect=looping_llm()) as mock_llm:
+    answer = await handler._handle_llm_conversation([{"role": "user", "content": "q"}], [fake_tool("lookup")])
+
+  assert asyncio.get_running_loop().time() - started < 1
+  assert mock_llm.call_count == 1
+  assert answer.startswith("time budget of 0.2s spent, partial results:\nerror: tool timed out")
+
+
+@pytest.mark.asyncio
+async def test_tool_handler_retries_only_idempotent_tools(assistant_plugin):
+  handler = assistant_plugin.handler.tool_handler
+  handler.mcp.tool_to_server_map = {"lookup": {"name": "s", "cacheable_tools": ["lookup"]}, "pay": {"name": "s"}}
+  attempts = {"lookup": 0, "pay": 0}
+
+  async def call_tool_from_session(server_cfg, tool_name, tool_args):
+    attempts[tool_name] += 1
+    if attempts[tool_name] == 1:
+      raise ConnectionError("boom")
+    return "ok"
+
+  handler.call_tool_from_session = call_tool_from_session
+  messages = []
+  results = await handler.execute_tool_calls(
+    [make_tool_call("1", "lookup"), make_tool_call("2", "pay")], messages, [], retries=1
+  )
+
+  assert results == ["continue", None]
+  assert attempts == {"lookup": 2, "pay": 1}
+  assert [m["content"] for m in messages] == ["ok", "tool call failed: boom"]
+
+
+@pytest.mark.asyncio
+async def test_tool_handler_clips_timeouts_and_retries_to_the_budget(assistant_plugin):
+  handler = assistant_plugin.handler.tool_handler
+  handler.mcp.tool_to_server_map = {"lookup": {"name": "s", "cacheable_tools": ["lookup"]}}
+  attempts = 0
+
+  async def call_tool_from_session(server_cfg, tool_name, tool_args):
+    nonlocal attempts
+    attempts += 1
+    await asyncio.sleep(10)
+
+  handler.call_tool_from_session = call_tool_from_session
+  messages = []
+  results = await handler.execute_tool_calls(
+    [make_tool_call("1", "lookup")], messages, [], timeout=30, retries=3, budget=LoopBudget(max_seconds=0.1)
+  )
+
+  assert results == [None] and attempts == 1
+  assert messages[0]["content"].startswith("error: tool timed out after 0.1")
+
+
+@pytest.mark.asyncio
+async def test_assistant_skips_failed_tools_and_keeps_going(assistant_plugin):
+  handler = assistant_plugin.handler
+  handler.tool_handler.call_tool = AsyncMock(return_value="tool call failed: payment service down")
+  responses = [tool_call_response("pay"), usage_response("could not pay, the service is down")]
+
+  with patch("lotb.common.plugin_class.PluginBase.llm_completion", side_effect=responses) as mock_llm:
+    answer = await handler._handle_llm_conversation([{"role": "user", "content": "pay"}], [fake_tool("pay")])
+
+  assert answer == "could not pay, the service is down"
+  sent = mock_llm.call_args.kwargs["messages"]
+  assert sent[-1] == {"role": "tool", "tool_call_id": "call_0", "content": "tool call failed: payment service down"}
+
+
+def png_bytes(width, height):
+  output = io.BytesIO()
+  Image.new("RGBA", (width, height), (200, 30, 30, 255)).save(output, format="PNG")
+  return output.getvalue()
+
+
+def photo_message(unique_id="photo-1", width=2000, height=1000):
+  bot = MagicMock()
+  telegram_file = MagicMock(download_as_bytearray=AsyncMock(return_value=bytearray(png_bytes(width, height))))
+  bot.get_file = AsyncMock(return_value=telegram_file)
+  small = MagicMock(file_id="small", file_unique_id=unique_id, width=320, height=160)
+  large = MagicMock(file_id="large", file_unique_id=unique_id, width=width, height=height)
+  message = MagicMock(photo=(small, large), document=None, text=None, caption=None)
+  return bot, message
+
+
+@pytest.mark.asyncio
+async def test_media_cache_downloads_each_image_once(simple_plugin):
+  cache = MediaCache(simple_plugin, max_side=512)
+  bot, message = photo_message()
+
+  first, second = await asyncio.gather(cache.data_url(bot, message), cache.data_url(bot, message))
+  third = await cache.data_url(bot, message)
+
+  assert first == second == third and first.startswith("data:image/jpeg;base64,")
+  bot.get_file.assert_awaited_once_with("large")
+  with Image.open(io.BytesIO(cache.images["photo-1"])) as image:
+    assert image.format == "JPEG" and image.size == (512, 256)
+  assert cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_media_cache_evicts_least_recently_used(simple_plugin):
+  cache = MediaCache(simple_plugin, max_side=64)
+  for unique_id in ("a", "b"):
+    bot, message = photo_message(unique_id)
+    await cache.data_url(bot, message)
+  cache.max_bytes = cache.size
+  cache.images.move_to_end("a")
+  bot, message = photo_message("c")
+  await cache.data_url(bot, message)
+
+  assert list(cache.images) == ["a", "c"] and cache.size <= cache.max_bytes
+
+
+@pytest.mark.asyncio
+async def test_simple_llm_sends_quoted_photo_to_vision_model(mock_update, mock_context, simple_plugin):
+  simple_plugin.handler.router.primary.model = "gpt-4o"
+  bot, photo = photo_message()
+  mock_context.bot.get_file = bot.get_file
+  mock_update.message.text = "/llm what is this"
+  mock_update.message.reply_to_message = photo
+
+  with (
+    patch(
+      "lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=usage_response("a flag"))
+    ) as mock_llm,
+    patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()),
+  ):
+    await simple_plugin.execute(mock_update, mock_context)
+
+  content = mock_llm.call_args.kwargs["messages"][-1]["content"]
+  assert content[0] == {"type": "text", "text": "what is this"}
+  assert content[1]["image_url"]["url"].startswith("data:image/jpeg;base64,")
+  assert mock_llm.call_args.kwargs["model"] == "gpt-4o"
+  mock_update.message.reply_text.assert_called_with("a flag")
+
+
+@pytest.mark.asyncio
+async def test_simple_llm_ignores_photo_without_vision_model(mock_update, mock_context, simple_plugin):
+  bot, photo = photo_message()
+  mock_context.bot.get_file = bot.get_file
+  mock_update.message.text = "/llm what is this"
+  mock_update.message.reply_to_message = photo
+
+  with (
+    patch(
+      "lotb.common.plugin_class.PluginBase.llm_completion", new=AsyncMock(return_value=usage_response("no idea"))
+    ) as mock_llm,
+    patch("lotb.common.plugin_class.PluginBase.send_typing_action", new=AsyncMock()),
+  ):
+    await simple_plugin.execute(mock_update, mock_context)
+
+  assert mock_llm.call_args.kwargs["messages"][-1]["content"] == "what is this"
+  bot.get_file.assert_not_awaited()
@@ -1,11 +1,19 @@
+import asyncio
 import os
 from unittest.mock import AsyncMock
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
+import httpx
 import pytest
+import pytest_asyncio
 
 from lotb.common.config import Config
+from lotb.plugins._prometheus_alerts.endpoints import parse_endpoints
+from lotb.plugins._prometheus_alerts.render import AlertThrottle
+from lotb.plugins._prometheus_alerts.render import pack_messages
+from lotb.plugins._prometheus_alerts.state import alert_fingerprint
+from lotb.plugins._prometheus_alerts.webhook import AlertWebhookReceiver
 from lotb.plugins.prometheus_alerts import Plugin
 
 
@@ -56,38 +64,91 @@ async def test_fetch_prometheus_alerts(prometheus_alerts_plugin, mock_httpx):
   assert alerts == [{"alertname": "The house is on fire"}]
 
 
-@pytest.mark.asyncio
-async def test_store_alerts_new_alert(prometheus_alerts_plugin):
-  alert = {
-    "labels": {"alertname": "The house is on fire", "severity": "critical"},
+@pytest.fixture
+def stateful_plugin():
+  config = Config()
+  config.config = {
+    "core": {"database": ":memory:"},
+    "plugins": {
+      "prometheus_alerts": {"enabled": "true", "prometheusUrl": "http://prometheus:9093", "chatid": "4815162342"}
+    },
+  }
+  plugin = Plugin()
+  plugin.set_config(config)
+  plugin.initialize()
+  return plugin
+
+
+def make_alert(fingerprint, alertname="The house is on fire", instance="kitchen"):
+  return {
+    "fingerprint": fingerprint,
+    "labels": {"alertname": alertname, "severity": "critical", "instance": instance},
     "annotations": {"description": "But is is fine fire"},
     "startsAt": "2024-01-01T00:00:00Z",
   }
-  mock_cursor = MagicMock()
-  mock_cursor.fetchone.return_value = (0,)
-  prometheus_alerts_plugin.connection.cursor.return_value = mock_cursor
 
-  new_alerts = prometheus_alerts_plugin.store_alerts([alert])
 
-  assert len(new_alerts) == 1
-  mock_cursor.execute.assert_called()
+@pytest.mark.asyncio
+async def test_store_alerts_new_alert(stateful_plugin):
+  firing, resolved = stateful_plugin.store_alerts([make_alert("a1")])
+
+  assert len(firing) == 1
+  assert resolved == []
+  rows = stateful_plugin.connection.execute("SELECT fingerprint FROM alert_state").fetchall()
+  assert rows == [("a1",)]
 
 
 @pytest.mark.asyncio
-async def test_store_alerts_existing_alert(prometheus_alerts_plugin):
-  alert = {
-    "labels": {"alertname": "The house is on fire", "severity": "critical"},
-    "annotations": {"description": "But is is fine fire"},
-    "startsAt": "2024-01-01T00:00:00Z",
-  }
-  mock_cursor = MagicMock()
-  mock_cursor.fetchone.return_value = (1,)
-  prometheus_alerts_plugin.connection.cursor.return_value = mock_cursor
+async def test_store_alerts_existing_alert(stateful_plugin):
+  stateful_plugin.store_alerts([make_alert("a1")])
+  firing, resolved = stateful_plugin.store_alerts([make_alert("a1")])
+
+  assert firing == []
+  assert resolved == []
+
 
-  new_alerts = prometheus_alerts_plugin.store_alerts([alert])
+@pytest.mark.asyncio
+async def test_store_alerts_resolved_alert(stateful_plugin):
+  stateful_plugin.store_alerts([make_alert("a1"), make_alert("a2", instance="garage")])
+  firing, resolved = stateful_plugin.store_alerts([make_alert("a2", instance="garage")])
 
-  assert len(new_alerts) == 0
-  mock_cursor.execute.assert_called()
+  assert firing == []
+  assert [alert["fingerprint"] for alert in resolved] == ["a1"]
+  rows = stateful_plugin.connection.execute("SELECT fingerprint FROM alert_state").fetchall()
+  assert rows == [("a2",)]
+
+
+@pytest.mark.asyncio
+async def test_store_alerts_state_survives_restart(stateful_plugin):
+  stateful_plugin.store_alerts([make_alert("a1")])
+
+  stateful_plugin.state.active.clear()
+  stateful_plugin.state.load()
+  firing, resolved = stateful_plugin.store_alerts([make_alert("a1")])
+
+  assert firing == []
+  assert resolved == []
+  assert stateful_plugin.state.active["a1"]["labels"]["instance"] == "kitchen"
+
+
+@pytest.mark.asyncio
+async def test_store_alerts_fingerprint_fallback_is_stable(stateful_plugin):
+  alert = make_alert(None)
+  del alert["fingerprint"]
+
+  assert alert_fingerprint(alert) == alert_fingerprint(dict(alert, labels=dict(reversed(alert["labels"].items()))))
+  firing, _ = stateful_plugin.store_alerts([alert])
+  assert len(firing) == 1
+
+
+@pytest.mark.asyncio
+async def test_store_alerts_single_commit_per_poll(stateful_plugin):
+  stateful_plugin.connection = MagicMock()
+
+  stateful_plugin.store_alerts([make_alert(f"a{i}", instance=str(i)) for i in range(10)])
+  stateful_plugin.store_alerts([make_alert(f"a{i}", instance=str(i)) for i in range(10)])
+
+  stateful_plugin.connection.commit.assert_called_once()
 
 
 @pytest.mark.asyncio
@@ -112,6 +173,14 @@ async def test_send_alerts(prometheus_alerts_plugin, mock_context):
   assert "The house is on fire 2" in call_args["text"]
 
 
+@pytest.mark.asyncio
+async def test_send_resolved_alerts(prometheus_alerts_plugin, mock_context):
+  await prometheus_alerts_plugin.send_alerts(mock_context, [make_alert("a1")], resolved=True)
+
+  text = mock_context.bot.send_message.call_args[1]["text"]
+  assert "✅ *Resolved*" in text
+
+
 @pytest.mark.asyncio
 async def test_fetch_and_store_alerts(prometheus_alerts_plugin, mock_context, mock_httpx):
   mock_response = MagicMock()
@@ -119,16 +188,325 @@ async def test_fetch_and_store_alerts(prometheus_alerts_plugin, mock_context, mo
   mock_response.json.return_value = [{"alertname": "The house is on fire"}]
   mock_httpx.return_value.__aenter__.return_value.get.return_value = mock_response
 
-  prometheus_alerts_plugin.store_alerts = MagicMock(return_value=[{"alertname": "The house is on fire"}])
+  prometheus_alerts_plugin.store_alerts = MagicMock(
+    return_value=([{"alertname": "The house is on fire"}], [{"alertname": "The fire is out"}])
+  )
   prometheus_alerts_plugin.send_alerts = AsyncMock()
 
   await prometheus_alerts_plugin.fetch_and_store_alerts(mock_context)
 
   prometheus_alerts_plugin.store_alerts.assert_called_once()
-  prometheus_alerts_plugin.send_alerts.assert_called_once()
+  assert prometheus_alerts_plugin.send_alerts.call_count == 2
+  prometheus_alerts_plugin.send_alerts.assert_called_with(
+    mock_context, [{"alertname": "The fire is out"}], resolved=True
+  )
 
 
 @pytest.mark.asyncio
 async def test_execute(mock_update, mock_context, prometheus_alerts_plugin):
   await prometheus_alerts_plugin.execute(mock_update, mock_context)
   mock_update.message.reply_text.assert_called_once_with("The plugin is running in background.")
+
+
+@pytest_asyncio.fixture
+async def webhook_plugin(stateful_plugin, mock_context):
+  stateful_plugin.webhook = AlertWebhookReceiver(
+    stateful_plugin, stateful_plugin.handle_webhook, host="127.0.0.1", port=0, token="winter-is-coming"
+  )
+  await stateful_plugin.start_webhook(mock_context)
+  yield stateful_plugin
+  await stateful_plugin.webhook.stop()
+
+
+async def post_to_webhook(plugin, payload, token="winter-is-coming", path="/alertmanager"):
+  # fake alertmanager: same payload and auth header as a webhook_config receiver
+  async with httpx.AsyncClient() as client:
+    return await client.post(
+      f"http://127.0.0.1:{plugin.webhook.port}{path}", json=payload, headers={"Authorization": f"Bearer {token}"}
+    )
+
+
+def webhook_payload(status, *alerts):
+  return {
+    "version": "4",
+    "groupKey": '{}:{alertname="The house is on fire"}',
+    "status": status,
+    "receiver": "lotb",
+    "alerts": [dict(alert, status=status) for alert in alerts],
+  }
+
+
+@pytest.mark.asyncio
+async def test_webhook_firing_and_resolved(webhook_plugin, mock_context):
+  response = await post_to_webhook(webhook_plugin, webhook_payload("firing", make_alert("a1")))
+  assert response.status_code == 200
+  assert "a1" in webhook_plugin.state.active
+  assert "*Alert*" in mock_context.bot.send_message.call_args[1]["text"]
+
+  response = await post_to_webhook(webhook_plugin, webhook_payload("firing", make_alert("a1")))
+  assert response.status_code == 200
+  assert mock_context.bot.send_message.call_count == 1
+
+  response = await post_to_webhook(webhook_plugin, webhook_payload("resolved", make_alert("a1")))
+  assert response.status_code == 200
+  assert webhook_plugin.state.active == {}
+  assert "*Resolved*" in mock_context.bot.send_message.call_args[1]["text"]
+
+
+@pytest.mark.asyncio
+async def test_webhook_rejects_invalid_requests(webhook_plugin, mock_context):
+  response = await post_to_webhook(webhook_plugin, webhook_payload("firing", make_alert("a1")), token="wrong")
+  assert response.status_code == 401
+
+  response = await post_to_webhook(webhook_plugin, webhook_payload("firing", make_alert("a1")), path="/nope")
+  assert response.status_code == 404
+
+  response = await post_to_webhook(webhook_plugin, {"not": "alertmanager"})
+  assert response.status_code == 400
+
+  mock_context.bot.send_message.assert_not_called()
+
+
+def test_webhook_enabled_from_config(mock_db):
+  config = Config()
+  config.config = {
+    "core": {"database": "test.db"},
+    "plugins": {
+      "prometheus_alerts": {
+        "prometheusUrl": "http://prometheus:9093",
+        "chatid": "4815162342",
+        "webhook": True,
+        "webhook_port": "9999",
+        "reconcile_interval": 360,
+      }
+    },
+  }
+  plugin = Plugin()
+  plugin.set_config(config)
+  plugin.initialize()
+  job_queue = MagicMock()
+  plugin.set_job_queue(job_queue)
+
+  assert plugin.webhook.port == 9999
+  job_queue.run_repeating.assert_any_call(plugin.fetch_and_store_alerts, interval=360 * 60, first=0)
+  job_queue.run_once.assert_called_once_with(plugin.start_webhook, when=0)
+
+
+def test_fractional_alert_interval(prometheus_alerts_plugin):
+  prometheus_alerts_plugin.alert_interval = "0.5"
+  job_queue = MagicMock()
+  prometheus_alerts_plugin.set_job_queue(job_queue)
+
+  job_queue.run_repeating.assert_any_call(prometheus_alerts_plugin.fetch_and_store_alerts, interval=30, first=0)
+
+
+def test_pack_messages_under_limit():
+  parts = ["a" * 1500, "b" * 1500, "c" * 1500, "d" * 100]
+  messages = pack_messages(parts, limit=4096)
+
+  assert len(messages) == 2
+  assert all(len(message) <= 4096 for message in messages)
+  assert messages[1].startswith("c")
+
+
+def test_pack_messages_never_splits_escape_sequences():
+  line = "x" * 9 + "\\." * 20
+  messages = pack_messages([line], limit=10)
+
+  assert "".join(messages) == line
+  for message in messages:
+    assert len(message) <= 10
+    trailing = len(message) - len(message.rstrip("\\"))
+    assert trailing % 2 == 0
+
+
+def test_pack_messages_keeps_code_spans_balanced():
+  messages = pack_messages(["  • `" + "v" * 30 + "`"], limit=12)
+
+  for message in messages:
+    assert len(message) <= 12
+    assert message.count("`") % 2 == 0
+
+
+@pytest.mark.asyncio
+async def test_send_alerts_storm_is_split(prometheus_alerts_plugin, mock_context):
+  alerts = [make_alert(f"a{i}", alertname=f"Fire in room {i}", instance="x" * 200) for i in range(60)]
+
+  await prometheus_alerts_plugin.send_alerts(mock_context, alerts)
+
+  assert mock_context.bot.send_message.call_count > 1
+  texts = [call[1]["text"] for call in mock_context.bot.send_message.call_args_list]
+  assert all(len(text) <= 4096 for text in texts)
+  assert all(f"Fire in room {i}" in "".join(texts) for i in range(60))
+
+
+@pytest.mark.asyncio
+async def test_send_alerts_failed_message_does_not_drop_others(prometheus_alerts_plugin, mock_context):
+  alerts = [make_alert(f"a{i}", alertname=f"Fire in room {i}", instance="x" * 200) for i in range(60)]
+  mock_context.bot.send_message.side_effect = [Exception("Bad Request"), None, None, None, None, None]
+
+  await prometheus_alerts_plugin.send_alerts(mock_context, alerts)
+
+  assert mock_context.bot.send_message.call_count > 1
+
+
+@pytest.mark.asyncio
+async def test_send_alerts_throttles_flapping_group(prometheus_alerts_plugin, mock_context):
+  prometheus_alerts_plugin.throttle = AlertThrottle(300)
+
+  await prometheus_alerts_plugin.send_alerts(mock_context, [make_alert("a1")])
+  await prometheus_alerts_plugin.send_alerts(mock_context, [make_alert("a1")], resolved=True)
+  await prometheus_alerts_plugin.send_alerts(mock_context, [make_alert("a1")])
+
+  assert mock_context.bot.send_message.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_send_alerts_throttle_lets_new_instances_through(prometheus_alerts_plugin, mock_context):
+  prometheus_alerts_plugin.throttle = AlertThrottle(300)
+
+  await prometheus_alerts_plugin.send_alerts(mock_context, [make_alert("h1", "HighCPU", "h1")])
+  await prometheus_alerts_plugin.send_alerts(
+    mock_context, [make_alert("h1", "HighCPU", "h1"), make_alert("h2", "HighCPU", "h2")]
+  )
+
+  assert mock_context.bot.send_message.call_count == 2
+  text = mock_context.bot.send_message.call_args.kwargs["text"]
+  assert "`h2`" in text and "`h1`" not in text
+
+
+@pytest.mark.asyncio
+async def test_send_alerts_defers_throttled_state_changes(prometheus_alerts_plugin, mock_context):
+  prometheus_alerts_plugin.throttle = AlertThrottle(60)
+  job_queue = MagicMock()
+  prometheus_alerts_plugin.set_job_queue(job_queue)
+  job_queue.run_repeating.assert_any_call(prometheus_alerts_plugin.send_deferred_alerts, interval=60, first=60)
+
+  with patch("lotb.plugins._prometheus_alerts.render.time.monotonic", return_value=0):
+    await prometheus_alerts_plugin.send_alerts(mock_context, [make_alert("a1")])
+    await prometheus_alerts_plugin.send_alerts(mock_context, [make_alert("a1")], resolved=True)
+    # fires again within the window: held back instead of lost, the chat still shows it resolved
+    await prometheus_alerts_plugin.send_alerts(mock_context, [make_alert("a1")])
+    await prometheus_alerts_plugin.send_deferred_alerts(mock_context)
+  assert mock_context.bot.send_message.call_count == 2
+
+  with patch("lotb.plugins._prometheus_alerts.render.time.monotonic", return_value=61):
+    await prometheus_alerts_plugin.send_deferred_alerts(mock_context)
+    await prometheus_alerts_plugin.send_deferred_alerts(mock_context)
+  assert mock_context.bot.send_message.call_count == 3
+  assert "*Alert*" in mock_context.bot.send_message.call_args.kwargs["text"]
+
+
+def test_throttle_drops_deferred_state_the_chat_already_shows():
+  throttle = AlertThrottle(60)
+  with patch("lotb.plugins._prometheus_alerts.render.time.monotonic", return_value=0):
+    assert throttle.filter([make_alert("a1")]) and throttle.filter([make_alert("a1")], resolved=True)
+    assert throttle.filter([make_alert("a1")]) == []
+    assert throttle.filter([make_alert("a1")], resolved=True) == []
+  with patch("lotb.plugins._prometheus_alerts.render.time.monotonic", return_value=61):
+    assert throttle.due() == ([], [])
+    assert throttle.filter([make_alert("a2")]) and set(throttle.notified) == {"a2"}
+
+
+def test_throttle_disabled_and_expiry():
+  assert all(AlertThrottle(0).allow(("k",)) for _ in range(3))
+
+  throttle = AlertThrottle(60)
+  with patch("lotb.plugins._prometheus_alerts.render.time.monotonic", side_effect=[0, 30, 61]):
+    assert throttle.allow(("k",))
+    assert not throttle.allow(("k",))
+    assert throttle.allow(("k",))
+
+
+@pytest.fixture
+def multi_plugin(stateful_plugin):
+  stateful_plugin.endpoints = parse_endpoints(
+    {
+      "alertmanagers": [
+        {"name": "eu", "url": "http://am-eu:9093/"},
+        {"name": "us", "url": "http://am-us:9093", "timeout": 0.2},
+      ]
+    }
+  )
+  stateful_plugin.state.all_sources = {"eu", "us"}
+  return stateful_plugin
+
+
+def fake_alertmanagers(responses, delays=None):
+  async def fetch(endpoint, client):
+    await asyncio.sleep((delays or {}).get(endpoint.name, 0))
+    result = responses[endpoint.name]
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  return fetch
+
+
+def test_parse_endpoints_fallback_to_single_url():
+  endpoints = parse_endpoints({"prometheusUrl": "http://prometheus:9093", "timeout": "3"})
+  assert [(e.name, e.url, e.timeout) for e in endpoints] == [("default", "http://prometheus:9093", 3.0)]
+
+
+@pytest.mark.asyncio
+async def test_multi_endpoint_dedup_by_fingerprint(multi_plugin, mock_context):
+  multi_plugin.fetch_prometheus_alerts = fake_alertmanagers(
+    {"eu": [make_alert("a1"), make_alert("a2")], "us": [make_alert("a1"), make_alert("a3")]}
+  )
+
+  await multi_plugin.fetch_and_store_alerts(mock_context)
+
+  assert set(multi_plugin.state.active) == {"a1", "a2", "a3"}
+  texts = "".join(call[1]["text"] for call in mock_context.bot.send_message.call_args_list)
+  assert texts.count("🚨") <= 2
+  assert multi_plugin.state.sources["a1"] == {"eu", "us"}
+
+
+@pytest.mark.asyncio
+async def test_multi_endpoint_resolves_only_when_all_sources_drop(multi_plugin, mock_context):
+  multi_plugin.fetch_prometheus_alerts = fake_alertmanagers({"eu": [make_alert("a1")], "us": [make_alert("a1")]})
+  await multi_plugin.fetch_and_store_alerts(mock_context)
+
+  multi_plugin.fetch_prometheus_alerts = fake_alertmanagers({"eu": [], "us": [make_alert("a1")]})
+  await multi_plugin.fetch_and_store_alerts(mock_context)
+  assert "a1" in multi_plugin.state.active
+
+  multi_plugin.fetch_prometheus_alerts = fake_alertmanagers({"eu": [], "us": []})
+  await multi_plugin.fetch_and_store_alerts(mock_context)
+  assert multi_plugin.state.active == {}
+
+
+@pytest.mark.asyncio
+async def test_multi_endpoint_failure_keeps_alerts_and_reports_health(multi_plugin, mock_context, mock_update):
+  multi_plugin.fetch_prometheus_alerts = fake_alertmanagers({"eu": [make_alert("a1")], "us": [make_alert("a2")]})
+  await multi_plugin.fetch_and_store_alerts(mock_context)
+
+  multi_plugin.fetch_prometheus_alerts = fake_alertmanagers(
+    {"eu": [make_alert("a1")], "us": httpx.ConnectError("boom")}
+  )
+  await multi_plugin.fetch_and_store_alerts(mock_context)
+  assert "a2" in multi_plugin.state.active
+
+  mock_context.args = ["status"]
+  await multi_plugin.execute(mock_update, mock_context)
+  status = mock_update.message.reply_text.call_args[0][0]
+  assert "✅ eu: 1 alerts" in status
+  assert "❌ us: boom (1 failures" in status
+  assert "active alerts: 2" in status
+
+
+@pytest.mark.asyncio
+async def test_multi_endpoint_slow_region_does_not_delay_others(multi_plugin, mock_context):
+  sent_at = []
+  mock_context.bot.send_message.side_effect = lambda **kwargs: sent_at.append(asyncio.get_running_loop().time())
+  multi_plugin.fetch_prometheus_alerts = fake_alertmanagers(
+    {"eu": [make_alert("a1")], "us": [make_alert("a2", alertname="Slow fire")]}, delays={"us": 5}
+  )
+
+  started = asyncio.get_running_loop().time()
+  await multi_plugin.fetch_and_store_alerts(mock_context)
+
+  assert len(sent_at) == 1
+  assert sent_at[0] - started < 0.2
+  assert "timeout" in multi_plugin.endpoints[1].last_error
+  assert "a2" not in multi_plugin.state.active
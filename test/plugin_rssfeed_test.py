@@ -107,3 +107,55 @@ async def test_check_feeds_existing_article_feed2(mock_context, mock_feedparser,
 async def test_execute(mock_update, mock_context, rssfeed_plugin):
   await rssfeed_plugin.execute(mock_update, mock_context)
   mock_update.message.reply_text.assert_called_once_with("RSS Feed Reader is running in the background.")
+
+
+@pytest.fixture
+def rssfeed_plugin_with_db():
+  config = Config()
+  config.config = {
+    "core": {"database": ":memory:"},
+    "plugins": {
+      "rssfeed": {
+        "enabled": "true",
+        "chatid": "4815162342",
+        "feeds": [{"name": "San-ti-feed", "url": "https://youarebugs.alien"}],
+      }
+    },
+  }
+  plugin = Plugin()
+  plugin.set_config(config)
+  plugin.initialize()
+  return plugin
+
+
+@pytest.mark.asyncio
+async def test_check_feeds_keeps_articles_still_listed(mock_context, mock_feedparser, rssfeed_plugin_with_db):
+  plugin = rssfeed_plugin_with_db
+  entries = [
+    MagicMock(
+      id=str(day),
+      title=f"Article {day}",
+      link=f"http://example.com/{day}",
+      published=f"2020-01-{day:02d}T00:00:00Z",
+      published_parsed=(2020, 1, day, 0, 0, 0),
+    )
+    for day in range(1, 8)
+  ]
+  mock_feedparser.return_value.entries = entries
+
+  await plugin.check_feeds(mock_context)
+  # the newest five, oldest first
+  sent = [call.kwargs["text"].split(": ")[1].split("\n")[0] for call in mock_context.bot.send_message.call_args_list]
+  assert sent == [f"Article {day}" for day in range(3, 8)]
+
+  # years old by publication, but still in the feed: the retention column is refreshed, nothing is sent again
+  plugin.db_cursor.execute("UPDATE articles SET seen = datetime('now', '-400 days')")
+  mock_context.bot.send_message.reset_mock()
+  await plugin.check_feeds(mock_context)
+  mock_context.bot.send_message.assert_not_called()
+
+  policy = plugin.retention_policies()[0]
+  plugin.db_cursor.execute(
+    f"SELECT COUNT(*) FROM articles WHERE {policy.column} < datetime('now', ?)", (f"-{policy.days} days",)
+  )
+  assert plugin.db_cursor.fetchone()[0] == 0